@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+''' wifi/bluetooth coexistence policy
+The Pi Zero W's wifi and bluetooth share a radio (and antenna);
+wifi traffic can delay bluetooth controller reports, but usually doesn't.
+Rather than always turning wifi off, it's only blocked while the controllers'
+links measurably suffer: report jitter (SEE: metrics.Jitter) or bluetooth RTT
+(SEE: tools.l2ping.LinkMonitor) past a threshold.
+'''
+
+import time
+import logging
+
+from asopimx.metrics import Metrics
+from asopimx.governor import Governor
+from asopimx.tools.rfkill import Monitor, Op, Type
+
+_logger = logging.getLogger(__name__)
+
+class Coexistence:
+    ''' keeps wifi up unless the controllers' links degrade
+    wifi is blocked once readings have been over threshold for `hold` consecutive checks
+    and restored once they've stayed under threshold * restore for `release` checks
+    (and it's been blocked at least min_blocked seconds; doubled, up to max_blocked,
+    each time degradation comes straight back after restoring)
+    thresholds are in seconds
+    '''
+    def __init__(self, reactor, radio, jitter=.004, rtt=.04, restore=.5, interval=1,
+            hold=3, release=15, min_blocked=30, max_blocked=600):
+        self.reactor = reactor
+        self.idx = radio.idx # (wlan) rfkill device
+        self.jitter = jitter
+        self.rtt = rtt
+        self.restore = restore
+        self.hold = hold
+        self.release = release
+        self.min_blocked = min_blocked
+        self.max_blocked = max_blocked
+        self.blocked_for = min_blocked
+        self.blocked = False # by us
+        self.blocked_on = None
+        self.restored_on = None
+        self.streak = 0
+        self.manual = False # someone else switched it; hands off
+        self.metrics = Metrics()
+        self.rfkill = Monitor()
+        self.rfkill.subscribe(self.radio_changed)
+        self.timer = Governor().manage(reactor.call_every(interval, self.check))
+
+    def readings(self, now):
+        ''' worst (jitter, rtt) across active devices '''
+        jitter = max((j.jitter for j in self.metrics.jitters.values()
+            if j.last is not None and now - j.last < 1), default=0.0)
+        rtt = max((v for (name, device), v in self.metrics.gauges.items()
+            if name == 'bt_rtt_p95'), default=0.0)
+        return jitter, rtt
+
+    def check(self):
+        if self.manual:
+            return
+        now = time.monotonic()
+        jitter, rtt = self.readings(now)
+        self.metrics.gauge('report_jitter', jitter)
+        if self.blocked:
+            calm = jitter < self.jitter * self.restore and rtt < self.rtt * self.restore
+            self.streak = self.streak + 1 if calm else 0
+            if self.streak >= self.release and now - self.blocked_on >= self.blocked_for:
+                self.unblock(now)
+        else:
+            degraded = jitter > self.jitter or rtt > self.rtt
+            self.streak = self.streak + 1 if degraded else 0
+            if self.streak >= self.hold:
+                _logger.info('links degraded (jitter: %.1fms, rtt: %.1fms)', jitter * 1000, rtt * 1000)
+                self.block(now)
+
+    def block(self, now):
+        if self.restored_on is not None and now - self.restored_on < self.blocked_for:
+            self.blocked_for = min(self.blocked_for * 2, self.max_blocked) # flapping; back off
+        else:
+            self.blocked_for = self.min_blocked
+        _logger.info('Disabling WIFI (for at least %ss)', self.blocked_for)
+        self.blocked = True
+        self.blocked_on = now
+        self.streak = 0
+        self.rfkill.switch(self.idx, 1)
+        self.metrics.count('wifi_blocks')
+        self.metrics.gauge('wifi_blocked', 1)
+
+    def unblock(self, now=None):
+        _logger.info('Enabling WIFI')
+        self.blocked = False
+        self.restored_on = time.monotonic() if now is None else now
+        self.streak = 0
+        self.rfkill.switch(self.idx, 0)
+        self.metrics.gauge('wifi_blocked', 0)
+
+    def radio_changed(self, evt):
+        ''' respect anyone else (ui, rfkill cli) switching wifi '''
+        if evt.op == Op.change_all:
+            if evt.type not in (Type.all, Type.wlan):
+                return
+        elif evt.op != Op.change or evt.idx != self.idx:
+            return
+        if bool(evt.softblock) != self.blocked and not self.manual:
+            _logger.info('WIFI switched externally; no longer managing it')
+            self.manual = True
+            self.blocked = False
+
+    def reset(self):
+        ''' restore wifi (if we blocked it) and start over '''
+        if self.blocked:
+            self.unblock()
+        self.streak = 0
+        self.restored_on = None
+        self.blocked_for = self.min_blocked
+
+    def stop(self):
+        self.timer.cancel()
+        self.reset()
@@ -7,6 +7,11 @@
 from collections import namedtuple
 from argparse import Namespace
 import struct
+import time
+
+from asopimx.reactor import Reactor
+from asopimx.metrics import Metrics
+from asopimx import trace
 
 class Device(Namespace):
         pass
@@ -24,6 +29,17 @@ class Gamepad:
     # NOTE: devices and profiles may not support the level of sensitivity specified in this class
     #   or may not be able to support some features (limited selection of leds)
     #   however, they should map best they can (use full min/max range)
+
+    # host -> device feedback
+    # rumble: 0-255 (per side); leds: p1-p4 bitmask (None = unchanged)
+    CFeedback = namedtuple('Feedback', 'lrumble rrumble leds')
+    report_size = 64 # largest input report we expect from the phys device
+    drain_max = 64 # most reports read per wakeup (hidraw queues 64)
+    input_reports = None # ids of (state) input reports; None = all
+    memo = None # (SEE: memo.Memo, recall)
+    volatile = () # report bytes the transform ignores (counters, timers, low bytes, ...); masked off memo keys
+    jitter = None # (SEE: metrics.Jitter)
+
     def __init__(self, *args, **kwargs):
         super(Gamepad,self).__init__()
 
@@ -37,3 +53,117 @@ class Gamepad:
             0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, # buttons (analog)
         )
         self.cstate = self.cneutral
+        self.metrics = None # (SEE: attach)
+
+    def metrics_key(self):
+        ''' what our metrics are kept under (the phys device's path, when there is one) '''
+        path = getattr(getattr(self, 'device', None), 'path', None)
+        return path if path is not None else getattr(self, 'code', type(self).__name__)
+
+    def recv_host(self, feedback):
+        ''' receive capability class feedback (rumble, leds) from the host
+        should be overridden to forward it to the phys device
+        '''
+        pass
+
+    def apply_report(self, data):
+        ''' handle a phys device report that isn't an input report (replies, battery, etc.) '''
+        pass
+
+    def recv_device(self):
+        ''' drain the (readable) phys device
+        other reports are applied in order, but only the newest input report is forwarded
+        (stale ones are counted as coalesced)
+        '''
+        n = 0 # newest input report's size
+        inputs = 0
+        for _ in range(self.drain_max):
+            try:
+                size = self.device.readinto(self.rbuffer)
+            except OSError as e:
+                self.lost = e
+                Reactor().remove_reader(self.device)
+                return
+            if not size:
+                break
+            if self.input_reports is None or self.rbuffer[0] in self.input_reports:
+                # keep it; read the next one into the other buffer
+                n = size
+                inputs += 1
+                self.rbuffer, self.ibuffer = self.ibuffer, self.rbuffer
+                self.rview, self.iview = self.iview, self.rview
+            else:
+                self.apply_report(self.rview[:size])
+        if inputs > 1:
+            Metrics().count('coalesced_reports', inputs - 1)
+            self.metrics.coalesced += inputs - 1
+        if n:
+            if trace.enabled:
+                trace.record(trace.READ, self.metrics_key(), self.iview[:n])
+            start = time.monotonic()
+            if self.memo is None:
+                self.read(self.iview[:n])
+            else:
+                self.recall(self.iview[:n])
+            self.metrics.report(time.monotonic() - start)
+
+    def recall(self, data, miss=None):
+        ''' read a report, unless we've seen it before (then the host report it made is resent)
+        miss: called instead of read(data) when it's new (data's then only the key; ex. SWJCPPC.flush)
+        '''
+        memo = self.memo
+        key = memo.key(data)
+        entry = memo.get(key)
+        if entry is None:
+            profile = self.profile
+            profile.sent = None
+            if miss is None:
+                self.read(data)
+            else:
+                miss()
+            if profile.sent is not None:
+                memo.put(key, (self.state, self.cstate, profile.state, bytes(profile.sent)))
+            return
+        if self.jitter is not None:
+            self.jitter.tick(time.monotonic())
+        self.state, self.cstate = entry[0], entry[1]
+        self.profile.recv_memo(entry[1], entry[2], entry[3])
+
+    def attach(self):
+        ''' start forwarding phys device reports as they arrive (from the reactor) '''
+        self.rbuffer = bytearray(self.report_size) # read into
+        self.rview = memoryview(self.rbuffer)
+        self.ibuffer = bytearray(self.report_size) # newest input report
+        self.iview = memoryview(self.ibuffer)
+        self.lost = None
+        self.metrics = Metrics().device(self.metrics_key())
+        self.metrics.connects += 1
+        if self.memo is not None:
+            self.memo.attach(self.metrics_key())
+        Reactor().add_reader(self.device, self.recv_device)
+
+    def detach(self):
+        Reactor().remove_reader(self.device)
+
+    def listen(self):
+        ''' forward phys device reports as they arrive (running everything else in between)
+        until the device is lost
+        '''
+        listen([self])
+
+def listen(gamepads, started=None):
+    ''' forward reports from several gamepads at once, until one of them is lost
+    started: called once they're all attached (ex. realtime.Realtime.start)
+    '''
+    reactor = Reactor()
+    for gamepad in gamepads:
+        gamepad.attach()
+    try:
+        if started is not None:
+            started()
+        while all(gamepad.lost is None for gamepad in gamepads):
+            reactor.run_once(None)
+    finally:
+        for gamepad in gamepads:
+            gamepad.detach()
+    raise next(gamepad.lost for gamepad in gamepads if gamepad.lost is not None)
@@ -3,16 +3,17 @@
 # NOTE: Joycon communication is inherently asynchronous
 # NOTE: asyncio (and its ilk) unfortunately add some startup latency
 
-import hid
+from asopimx.tools import hidraw as hid
 import base64
 from collections import namedtuple
 import struct
 from argparse import Namespace
 import time
-import sched
 import logging
 
 from asopimx.tools import phexlify
+from asopimx.scheduler import Scheduler
+from asopimx.metrics import Metrics
 
 _logger = logging.getLogger(__name__ if __name__ != '__main__' else __file__)
 
@@ -70,9 +71,139 @@ class JCD:
         ''' convenience fn '''
         print(self.ps(res), end=end)
 
+    # rumble data (4 bytes per side):
+    #   hf freq (lsb), hf freq (msb) | hf amp, lf freq | lf amp (lsb), lf amp
+    # NOTE: frequencies are left at their defaults (320Hz/160Hz);
+    #   only the amplitude is mapped to/from a 0-255 strength
+    @staticmethod
+    def encode_rumble(strength):
+        hamp = (strength * 0xC8 // 0xFF) & 0xFE # even values only
+        lamp = strength * 0x64 // 0xFF
+        return [0x00, 0x01 | hamp, 0x40 | ((lamp & 0x1) << 7), 0x40 + (lamp >> 1)]
+
+    @staticmethod
+    def decode_rumble(data):
+        hamp = data[1] & 0xFE
+        lamp = max(0, ((data[3] - 0x40) << 1) | (data[2] >> 7))
+        return min(0xFF, max(hamp * 0xFF // 0xC8, lamp * 0xFF // 0x64))
+
+class Subcommand:
+    ''' an in-flight subcommand (resolved by its 0x21 reply) '''
+    def __init__(self, scmd, scdata=None, callback=None):
+        self.scmd = scmd
+        self.scdata = scdata if scdata is not None else []
+        self.callbacks = [callback] if callback else []
+        self.tries = 0
+        self.sent_on = None
+        self.done = False
+        self.failed = False
+        self.ack = None
+        self.data = None
+
+    def add_done_callback(self, fn):
+        if self.done:
+            fn(self)
+        else:
+            self.callbacks.append(fn)
+
+    def acked(self):
+        # MSB == 1; ack, MSB == 0; nack
+        return bool(self.ack is not None and self.ack >> 7)
+
+    def finish(self, report=None):
+        if report is None:
+            self.failed = True
+        else:
+            self.ack = report.ack
+            self.data = report.scrdata
+        self.done = True
+        for fn in self.callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                _logger.warning('subcommand %s callback failed: %s', hex(self.scmd), e)
+        self.callbacks = []
+
+class Subcommands:
+    ''' tracks in-flight subcommands by id
+
+    Replies (0x21) only carry the id of the subcommand they answer,
+    so only one request per id is in flight at a time; requests with other ids
+    are pipelined (up to window) and the rest wait their turn.
+    '''
+    def __init__(self, write, window=3, timeout=.1, retries=3):
+        self.write = write # fn(scmd, scdata)
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.inflight = {} # scmd: Subcommand
+        self.queue = []
+
+    def __len__(self):
+        return len(self.inflight) + len(self.queue)
+
+    def pending(self, scmd):
+        return scmd in self.inflight or any(s.scmd == scmd for s in self.queue)
+
+    def submit(self, scmd, scdata=None, callback=None):
+        sc = Subcommand(scmd, scdata, callback)
+        self.queue.append(sc)
+        self.pump()
+        return sc
+
+    def pump(self):
+        ''' send whatever fits into the window '''
+        i = 0
+        while i < len(self.queue) and len(self.inflight) < self.window:
+            sc = self.queue[i]
+            if sc.scmd in self.inflight: # wait for the current one to finish
+                i += 1
+                continue
+            del self.queue[i]
+            self.inflight[sc.scmd] = sc
+            self.transmit(sc)
+
+    def transmit(self, sc):
+        sc.tries += 1
+        sc.sent_on = time.monotonic()
+        self.write(sc.scmd, sc.scdata)
+
+    def resolve(self, report):
+        ''' match a 0x21 reply to its request; returns the resolved Subcommand (if any) '''
+        sc = self.inflight.pop(report.scrid, None)
+        if sc is None:
+            return None
+        sc.finish(report)
+        self.pump()
+        return sc
+
+    def expire(self, now=None):
+        ''' retry (or give up on) requests that haven't been answered in time '''
+        if not self.inflight:
+            return
+        if now is None:
+            now = time.monotonic()
+        for scmd, sc in list(self.inflight.items()):
+            if now - sc.sent_on < self.timeout:
+                continue
+            if sc.tries <= self.retries:
+                _logger.debug('subcommand %s timed out; retrying (%s)', hex(scmd), sc.tries)
+                self.transmit(sc)
+            else:
+                _logger.warning('subcommand %s unanswered after %s tries', hex(scmd), sc.tries)
+                del self.inflight[scmd]
+                sc.finish()
+        self.pump()
+
+    def cancel(self):
+        for sc in list(self.inflight.values()) + self.queue:
+            sc.finish()
+        self.inflight = {}
+        self.queue = []
+
 class JCDP(JCD):
     def __init__(self, dev):
-        self.scheduler = sched.scheduler()
+        self.scheduler = Scheduler()
         self.devinfo = dev
         self.dev = self.devinfo.dev
         self.devfd = open(self.devinfo.path, 'rb')
@@ -80,15 +211,24 @@ class JCDP(JCD):
         self.gpn = 0
         self.gpn_max = 0xF
         self.read_max = 0x400
+        self.drain_max = 64 # most reports read per observe (hidraw queues 64)
+        self.rbuffer = bytearray(self.read_max) # read into
+        self.rview = memoryview(self.rbuffer)
+        self.sbuffer = bytearray(self.read_max) # newest state report
+        self.sview = memoryview(self.sbuffer)
+        self.state_report = self.sview[:0] # (SEE: swjc.SWJCPPC.key)
         self.lstate = self.State(**self.neutral.__dict__)
         self.lplstate = 0
         self.lplstate_confirmed = False
+        self.subcommands = Subcommands(self.send_subcommand)
+        self.jitter = Metrics().jitter(self.devinfo.path)
         self.devfd.flush() # attempt to flush device buffer
 
         self.init()
         super(JCDP, self).__init__()
 
-    def init(self):
+    def init(self, timeout=1):
+        # independent subcommands; pipelined, then confirmed together
         _logger.info('enabling vibration')
         self.vibrate(True)
         #print('enable IMU data (6-axis sensor)')
@@ -96,24 +236,41 @@ class JCDP(JCD):
         _logger.info("disabling IMU data (6-axis sensor; we're not using it)")
         self.imu(False)
         _logger.info('switching to full reports')
-        self.send(0x1, 0x3, [0x30])
+        self.report_mode(0x30)
         #print('read device s/n (not necessary)')
         #self.read_spi(0x6002, 0xE)
+        if not self.settle(timeout):
+            _logger.warning('%s: initialization unconfirmed', self.devinfo.path)
+
+    def settle(self, timeout=1):
+        ''' process replies until all subcommands are resolved (or we run out of time) '''
+        deadline = time.monotonic() + timeout
+        while self.subcommands:
+            now = time.monotonic()
+            if now >= deadline:
+                return False
+            self.subcommands.expire(now)
+            # wait (at most) until the next retry is due
+            wait = min(self.subcommands.timeout, deadline - now)
+            r = self.read(timeout=max(1, int(wait * 1000)))
+            if r:
+                self.dispatch(r)
+        return True
 
     def claimed(self, devinfo):
         if devinfo.path == self.devinfo.path:
             return True
 
     def imu(self, on=True):
-        return self.send(0x1, 0x40, [0x01 if on else 0x00])
+        return self.subcommand(0x40, [0x01 if on else 0x00])
 
     def vibrate(self, on=True):
-        return self.send(0x1, 0x48, [0x01 if on else 0x00])
+        return self.subcommand(0x48, [0x01 if on else 0x00])
 
-    def read_spi(self, offset, size):
-        high, low = divmod(offset, 0x100)
-        subargs = [low, high, size]
-        return self.send(0x1, 0x10, subargs)
+    def read_spi(self, offset, size, callback=None):
+        ''' read size bytes of spi flash; reply data: offset (LE32), size, data '''
+        subargs = list(struct.pack('<IB', offset, size))
+        return self.subcommand(0x10, subargs, callback)
 
 
     def inc_gpn(self):
@@ -134,6 +291,16 @@ class JCDP(JCD):
         self.dev.write(request)
         self.inc_gpn()
 
+    def send_subcommand(self, scmd, scdata):
+        ''' (re)transmit a subcommand (SEE: subcommand) '''
+        self.send(0x01, scmd, scdata)
+
+    def subcommand(self, scmd, scdata=None, callback=None):
+        ''' queue a subcommand; returns a Subcommand resolved by its reply
+        callback: fn(Subcommand) called once it's been answered (or given up on)
+        '''
+        return self.subcommands.submit(scmd, scdata, callback)
+
     def handshake(self):
         ''' only necessary if connected via usb/serial (?)'''
         cmds = [
@@ -173,52 +340,64 @@ class JCDP(JCD):
 
     def request_state(self):
         ''' request a state report '''
-        report = self.send(0x01, 0x00)
+        report = self.subcommand(0x00)
 
     def observe(self):
         # self.devfd.flush() # attempt to flush device buffer
-        while True:
-            self.scheduler.run(blocking=False)
-            r = self.read() #64 
-            #r = self.read(64)
+        # drain everything pending; replies are handled in order,
+        # but only the newest state report is applied
+        self.subcommands.expire()
+        n = 0 # newest state report's size
+        states = 0
+        for _ in range(self.drain_max):
+            r = self.read()
             if not r:
-                #print('nothing to read %s (%s)' % (self.devinfo.product_string, self.devinfo.serial_number))
-                return None
-            rtype = r[0]
-            rformatting = self.reports.get(rtype)
-            if rtype == 0x3f:
-                self.init() # wrong report format; reinitialize
-            if rformatting and rtype in [0x30,0x31]:
-                self.update_state(r)
-                if self.lstate.bl < 6 and self.lplstate != 0x01:
-                    self.plights(0, 0x01)
-                elif not self.lplstate_confirmed:
-                    self.plights(self.lplstate)
-                return self.lstate
-            elif rtype == 0x21:
-                rformatting = self.reports.get(rtype)
-                #print(len(r))
-                report = rformatting['Report'](*rformatting['format'].unpack(bytes(r)))
-                if report.scrid == 0x31:
-                    #print(report.scrdata)
-                    plstate = report.scrdata[0]
-                    if self.lplstate == plstate:
-                        self.lplstate_confirmed = True
-                elif report.scrid == 0x30: # plights ack/nack
-                    # MSB == 1; ack, MSB == nack
-                    ack = report.ack >> 7
-                    if not ack:
-                        _logger.debug("plights %s'd" % 'ack' if ack else 'nack')
-                else:
-                    _logger.warning(
-                        'unsupported scmd report: %s (%s)' % (
-                            phexlify(bytes([report.scrid])), report.scrid
-                    ))
+                break
+            if r[0] in (0x30, 0x31):
+                n = len(r)
+                states += 1
+                # keep it; read the next one into the other buffer
+                self.rbuffer, self.sbuffer = self.sbuffer, self.rbuffer
+                self.rview, self.sview = self.sview, self.rview
             else:
-                _logger.warning('unsupported: %s' % rtype)
-                _logger.warning(phexlify(bytes(r)))
-            time.sleep(.01) # let the system breath
-        
+                self.dispatch(r)
+        if states > 1:
+            Metrics().count('coalesced_reports', states - 1)
+        if not n:
+            return None
+        self.state_report = self.sview[:n]
+        return self.dispatch(self.state_report)
+
+    def dispatch(self, r):
+        ''' handle a single report; returns our state if it was a state report '''
+        rtype = r[0]
+        rformatting = self.reports.get(rtype)
+        if rtype == 0x3f: # wrong report format; reinitialize
+            if not self.subcommands.pending(0x03):
+                self.report_mode(0x30)
+            return None
+        if rformatting and rtype in [0x30,0x31]:
+            self.jitter.tick(time.monotonic())
+            self.update_state(r)
+            if self.lstate.bl < 6 and self.lplstate != 0x01 << 4: # (flashing; SEE: plights)
+                if not self.subcommands.pending(0x30):
+                    self.plights(0, 0x01)
+            elif not self.lplstate_confirmed and not self.subcommands.pending(0x30):
+                self.plights(self.lplstate)
+            return self.lstate
+        elif rtype == 0x21:
+            #print(len(r))
+            report = rformatting['Report'](*rformatting['format'].unpack(bytes(r[:rformatting['format'].size])))
+            if self.subcommands.resolve(report) is None:
+                _logger.debug(
+                    'unexpected scmd report: %s (%s)' % (
+                        phexlify(bytes([report.scrid])), report.scrid
+                ))
+        else:
+            _logger.warning('unsupported: %s' % rtype)
+            _logger.warning(phexlify(bytes(r)))
+        return None
+
 
     def update_state(self, report):
         # TODO: handle state management and such in a separate thread;
@@ -249,8 +428,8 @@ class JCDP(JCD):
             self.request_state()
             self.loop.call_later(.01667, self.async_poll) # .02 = 50hz, .01667 ~ 60hz, .1 = 10hz
 
-    def info(self):
-        return self.send(0x01,0x02)
+    def info(self, callback=None):
+        return self.subcommand(0x02, callback=callback)
 
     def plights(self, on=None, flash=None):
         # this is designed such that one can pass a single, full plight state,
@@ -258,7 +437,7 @@ class JCDP(JCD):
         ## NOTE: trail effect can't be set; not supported
         if on is None and flash is None:
             # get lights
-            return self.send(0x01,0x30)
+            return self.subcommand(0x31)
         else:
             if on is None:
                 on = 0
@@ -270,14 +449,18 @@ class JCDP(JCD):
         #data = 0x20 | 0x10 | 0x8 | 0x4
         self.lplstate = data
         self.lplstate_confirmed = False
-        r = self.send(0x01, 0x30, [self.lplstate])
-        r = self.send(0x01, 0x31, [self.lplstate])
-        return r
+        def confirm(sc):
+            # only the latest request counts
+            if sc.acked() and sc.scdata == [self.lplstate]:
+                self.lplstate_confirmed = True
+            else:
+                _logger.debug('plights %s' % ('failed' if sc.failed else 'nack'))
+        return self.subcommand(0x30, [self.lplstate], confirm)
 
     def hlight(self, mcydur=0xF, intensity=0x7, cycles=1, mcycles=None):
         ''' home light, mcycles = list of up to 15 MiniCycles '''
         data = []
-        self.send(0x01, 0x38, data)
+        return self.subcommand(0x38, data)
 
     def rumble(self, timing=0xFF, freq=0.0):
         # NOTE: there's a limted set of valid variable ranges
@@ -314,12 +497,14 @@ class JCDP(JCD):
         return []
 
     def report_mode(self, mode=0x30):
-        self.send(0x01, mode)
+        return self.subcommand(0x03, [mode])
 
     def read(self, size=None, timeout=0):
+        ''' read a report (a view of our read buffer; only valid until the next read) '''
         if size is None:
             size = self.read_max
-        return self.dev.read(size, timeout)
+        n = self.dev.readinto(self.rview[:size], timeout)
+        return self.rview[:n]
 
     def show_battery(self):
         bl = self.lstate.bl
@@ -388,7 +573,7 @@ class JCP(JCD):
         import time
         jcd.observe()
         jcd.show_battery()
-        jcd.scheduler.enter(3, 1, jcd.plights, argument=(0x01, 0))
+        jcd.scheduler.call_later(3, jcd.plights, 0x01, 0)
 
     def claimed(self, dev):
         return self.jcr.claimed(dev) or self.jcl.claimed(dev)
@@ -431,6 +616,16 @@ class JCP(JCD):
         if self.jcl:
             self.jcl.plights(on,flash)
 
+    def recv_host(self, feedback):
+        ''' forward host feedback (rumble, leds) to the pair '''
+        rumble = self.encode_rumble(feedback.lrumble) + self.encode_rumble(feedback.rrumble)
+        for jcd in (self.jcl, self.jcr):
+            if jcd is None:
+                continue
+            jcd.send(0x10, rumble=rumble)
+            if feedback.leds is not None and feedback.leds != jcd.lplstate:
+                jcd.plights(feedback.leds)
+
     def observe(self):
         rs = ls = None
         if self.jcr is not None:
@@ -8,8 +8,10 @@ import struct
 import logging
 
 from asopimx.profiles import Profile
+from asopimx.metrics import Metrics
 from asopimx.devices import Gamepad
-from asopimx.tools import phexlify
+from asopimx import trace
+from asopimx.tools import hiddesc
 
 _logger = logging.getLogger(__name__ if __name__ != '__main__' else __file__)
 logging.basicConfig()
@@ -38,7 +40,6 @@ class MNSD():
     # hid data
     protocol = '0' # bInterfaceProtocol
     subclass = '0' # bInterfaceSubClass
-    report_length = '137' # wDescriptorLength (NOTE: this should mach lenth of resport_desc below)
 
     report_desc = [
         0x05, 0x01,         #  Usage Page (Desktop),            
@@ -107,6 +108,15 @@ class MNSD():
         0x81, 0x02,         #      Input (Variable),            
         0xC0                #  End Collection                   
     ]
+    report_length = str(hiddesc.report_length(report_desc)) # longest report (bytes)
+    packer = hiddesc.Packer(report_desc, [
+        ('B', 'bset1'), ('B', 'bset2'), ('B', 'hat'),
+        ('B', 'x'), ('B', 'y'), ('B', 'z'), ('B', 'r'), # l&r sticks (0-255)
+        ('B', 'hr'), ('B', 'hl'), ('B', 'hu'), ('B', 'hd'), # hat (analog)
+        ('B', 'bx'), ('B', 'ba'), ('B', 'bb'), ('B', 'by'),
+        ('B', 'lb'), ('B', 'rb'), ('B', 'lt'), ('B', 'rt'),
+        ('8s', 'u4'),
+    ])
     
     # report example:
     #   LB1A2    L34
@@ -152,32 +162,9 @@ class MNSD():
             state.u8, state.u9, state.u10, #state.u11,
         )
         '''
-        # TODO: simplify this
-        #package = base64.b16decode('27'.replace(' ', ''))
-        package = b''
-        #package += struct.pack('B', self.state.u1)
-        package += struct.pack('B', self.state.bset1)
-        package += struct.pack('B', self.state.bset2)
-        package += struct.pack('B', self.state.hat)
-        # l&r sticks (0-255)
-        package += struct.pack('B', self.state.x)
-        package += struct.pack('B', self.state.y)
-        package += struct.pack('B', self.state.z)
-        package += struct.pack('B', self.state.r)
-        package += struct.pack('B', self.state.hr)
-        package += struct.pack('B', self.state.hl)
-        package += struct.pack('B', self.state.hu)
-        package += struct.pack('B', self.state.hd)
-        package += struct.pack('B', self.state.bx)
-        package += struct.pack('B', self.state.ba)
-        package += struct.pack('B', self.state.bb)
-        package += struct.pack('B', self.state.by)
-        package += struct.pack('B', self.state.lb)
-        package += struct.pack('B', self.state.rb)
-        package += struct.pack('B', self.state.lt)
-        package += struct.pack('B', self.state.rt)
-        package += self.state.u4
-        print(phexlify(package), end='\r')
+        package = self.packer.pack(self.state)
+        if trace.enabled:
+            trace.record(trace.REPACK, self.code, package)
         return package
 
 
@@ -215,31 +202,30 @@ class MNSD():
         aid = self.saxi.get(id, None)
         amap = {0:'x', 1:'y', 2:'z', 3:'r', 4:'hu', 5:'hr', 6:'hd', 7:'hl'}
         if aid is None or id not in amap:
-            print('not mapped')
+            if trace.enabled:
+                trace.record(trace.UNMAPPED, self.code, bytes([id & 0xFF]))
             return
 
-        print(value)
         avalue = int((value / 32767.0) * 128) + 128
-        print(avalue)
         if avalue > 255:
             avalue = 255
-        print(amap[id])
-        self.state.__dict__[amap[id]] = avalue
         self.state = self.state._replace(**{amap[id]: avalue})
-        print(self.state)
+        if trace.enabled:
+            trace.record(trace.UPDATE, self.code, bytes([id & 0xFF, avalue]))
 
     def update_button(self, id, value):
         bid = self.sbuttons.get(id, None)
         if bid is None:
-            print('not mapped')
+            if trace.enabled:
+                trace.record(trace.UNMAPPED, self.code, bytes([id & 0xFF]))
             return
         # TODO: pick button block depending on bid
         bstates = self.state.bset1
         bbstates = self.decode_bools(bstates, 16)
         bbstates[bid] = True if value else False
-        print(bbstates)
         self.state = self.state._replace(bset1=self.encode_bools(bbstates))
-        print(self.state.bset1)
+        if trace.enabled:
+            trace.record(trace.UPDATE, self.code, bytes([id & 0xFF, self.state.bset1 & 0xFF]))
         return
 
 
@@ -249,17 +235,21 @@ class MNSDProfile(MNSD,Profile):
 class MNSDPC(MNSD,Gamepad):
     # transforms
     bmap = {1:1, 2:4,3:3,4:2}
+    volatile = tuple(range(19, 27)) # u4 (SEE: transform_cc)
     def assign_device(self, device):
         self.device = device
     def assign_profile(self, profile):
         ''' assign a profile to push/pull states to/from '''
         self.profile = profile
+        profile.assign_device(self)
     def unpack(self, data):
         ''' get data message, translate it to capability class state '''
         try:
             s = self.format.unpack(data)
-        except Exception as e:
-            _logger.warn(e)
+        except Exception:
+            Metrics().count('malformed_reports')
+            if trace.enabled:
+                trace.record(trace.MALFORMED, self.metrics_key(), data)
             return self.state
         return self.State(*s)
         # TODO: translate state tp capability class state
@@ -8,7 +8,10 @@ import time
 import logging
 
 from asopimx.profiles import Profile
+from asopimx.metrics import Metrics
 from asopimx.devices import Gamepad
+from asopimx import trace
+from asopimx.tools import hiddesc
 
 _logger = logging.getLogger(__name__ if __name__ != '__main__' else __file__)
 logging.basicConfig()
@@ -36,7 +39,6 @@ class PS3():
     # hid data
     protocol = '0' # bInterfaceProtocol
     subclass = '0' # bInterfaceSubClass
-    report_length = '148' # wDescriptorLength (NOTE: this should mach lenth of resport_desc below)
 
     report_desc = [
         0x05, 0x01,         #   Usage Page (Desktop),
@@ -117,6 +119,24 @@ class PS3():
         0xC0,               #       End Collection,
         0xC0                #   End Collection
     ]
+    report_length = str(hiddesc.report_length(report_desc)) # longest report (bytes)
+    packer = hiddesc.Packer(report_desc, [
+        ('B', 0x01), ('B', 0x00), # report id, padding
+        ('H', 'bset1'), ('2s', b'\0\0'), # buttons 1-16, 17-19
+        ('B', 'x'), ('B', 'y'), ('B', 'z'), ('B', 'r'), # l&r sticks (0-255)
+        ('4s', b'\0\0\0\0'),
+        ('B', 'hu'), ('B', 'hr'), ('B', 'hd'), ('B', 'hl'), # hat (0-255)
+        # TODO
+        ('15s', bytes.fromhex('00 00 00 00 00 00 00 00 00 00 00 00 02 EE 12')),
+        ('8s', bytes.fromhex('00 00 00 00 12 F8 77 00')),
+        # x, y, z; (+/-)  right/left, forward/back, up/down(right-hand rule)
+        # 02 = sixaxis rotation around the x axis
+        # 03,01 = sixaxis rotation around the y axis
+        # 04 = sixaxis rotation around the z axis
+        # (byte before each of them are acceleration? detection of motion? orientation?)
+        # (juding by hid report data, motion detection seems most likely)
+        ('8s', bytes.fromhex('00 02 05 03 EF 01 93 04')),
+    ], report_id=0x01)
     
     # report example:
     #[ # each entry = 1 byte (ex: "\0\0" = 2 bytes (2B))
@@ -134,7 +154,7 @@ class PS3():
     #    "\x7\x1\xee\x1\x94\x1\xd7"
     #]
 
-    def __init__(self):
+    def __init__(self, *args, **kwargs):
         self.State = namedtuple('State', 'u1 u2 bset1 bset2 u3 u4 x y z r u5 hu hr hd hl u6 u7 u8 u9 u10 u11')
         self.format = Struct('B' * 12) # TODO
         self.lstate = self.State(
@@ -159,6 +179,7 @@ class PS3():
         })
         # 0-5; x, y, z(rx), r(ry), hatx, haty
         self.saxi = dict((i, i) for i in range(0,6))
+        super(PS3,self).__init__(*args, **kwargs)
 
 
     def repack(self):
@@ -173,39 +194,25 @@ class PS3():
             state.u8, state.u9, state.u10, #state.u11,
         )
         '''
-        package = base64.b16decode('01 00'.replace(' ', ''))
-        package += struct.pack('H', self.lstate.bset1)
-        # 16-buttons (binary)
-        package += base64.b16decode('00 00'.replace(' ', ''))
-        # l&r sticks (0-255)
-        package += struct.pack('B', self.lstate.x)
-        package += struct.pack('B', self.lstate.y)
-        package += struct.pack('B', self.lstate.z)
-        package += struct.pack('B', self.lstate.r)
-        package += base64.b16decode('00 00 00 00'.replace(' ', ''))
-        #package += base64.b16decode('00 00 00 83 7D 81 80 00 00 00 00 00 00'.replace(' ', ''))
-        # hat (0-255)
-        package += struct.pack('B', self.lstate.hu)
-        package += struct.pack('B', self.lstate.hr)
-        package += struct.pack('B', self.lstate.hd)
-        package += struct.pack('B', self.lstate.hl)
-        # TODO
-        package += base64.b16decode('00 00 00 00 00 00 00 00 00 00 00 00 02 EE 12'.replace(' ', ''))
-        package += base64.b16decode('00 00 00 00 12 F8 77 00'.replace(' ', ''))
-        # x, y, z; (+/-)  right/left, forward/back, up/down(right-hand rule)
-        # 02 = sixaxis rotation around the x axis
-        # 03,01 = sixaxis rotation around the y axis
-        # 04 = sixaxis rotation around the z axis
-        # (byte before each of them are acceleration? detection of motion? orientation?)
-        # (juding by hid report data, motion detection seems most likely)
-        package += base64.b16decode('00 02 05 03 EF 01 93 04'.replace(' ', ''))
-        return package
+        return self.packer.pack(self.lstate)
+
+    # output report:
+    #   01 (id), 00, r duration, r (small) motor on, l duration, l (large) motor force,
+    #   00 00 00 00, leds (bitmap; 0x02 = p1), led settings (4 x 5 bytes), 00 x5
+    led_settings = [0xff, 0x27, 0x10, 0x00, 0x32]
+
+    def transform_host(self, data):
+        ''' build capabilities class feedback from a host output report '''
+        if len(data) < 11 or data[0] != 0x01:
+            return None
+        return Gamepad.CFeedback(data[5], 0xFF if data[3] else 0x00, (data[10] >> 1) & 0x0F)
 
     def update_axis(self, id, value):
         aid = self.saxi.get(id, None)
         amap = {0:'x', 1:'y', 2:'z', 3:'r', 4:'hu', 5:'hr', 6:'hd', 7:'hl'}
         if aid is None or id not in amap:
-            _logger.warning('not mapped')
+            if trace.enabled:
+                trace.record(trace.UNMAPPED, self.code, bytes([id & 0xFF]))
             return
 
         avalue = int((value / 32767.0) * 128) + 128
@@ -217,7 +224,8 @@ class PS3():
     def update_button(self, id, value):
         bid = self.sbuttons.get(id, None)
         if bid is None:
-            _logger.warning('not mapped')
+            if trace.enabled:
+                trace.record(trace.UNMAPPED, self.code, bytes([id & 0xFF]))
             return
         # TODO: pick button block depending on bid
         bstates = self.lstate.bset1
@@ -237,27 +245,38 @@ class PS3Pad(PS3,Gamepad): # TODO
     def assign_device(self, device):
         self.dev = device # new-style device
         self.device = device.dev # phys device
+        self.jitter = Metrics().jitter(device.path)
     def assign_profile(self, profile):
         ''' assign a profile to push/pull states to/from '''
         self.profile = profile
-    def listen(self):
-        while True:
-            # TODO: handle timeouts
-            data = bytes(self.device.read(64))
-            self.read(data)
-            time.sleep(.1) # let the system breath
+        profile.assign_device(self)
+        self.leds = 0x01
+    def recv_host(self, feedback):
+        ''' forward host feedback (rumble, leds) to the phys device '''
+        if feedback.leds is not None:
+            self.leds = feedback.leds
+        report = [
+            0x01,
+            0x00, 0xFF, 0x01 if feedback.rrumble else 0x00, 0xFF, feedback.lrumble,
+            0x00, 0x00, 0x00, 0x00, (self.leds & 0x0F) << 1,
+        ]
+        report += self.led_settings * 4 + [0x00] * 5
+        self.device.write(report)
     def read(self, data):
         ''' "Read" data from phys device (recorded data can be passed in for testing)'''
         if not data:
             return
+        self.jitter.tick(time.monotonic())
         self.state = self.unpack(data)
         self.send_profile()
     def unpack(self, data):
         ''' get data message, translate it to capability class state '''
         try:
             s = self.format.unpack(data)
-        except Exception as e:
-            _logger.warn(e)
+        except Exception:
+            Metrics().count('malformed_reports')
+            if trace.enabled:
+                trace.record(trace.MALFORMED, self.metrics_key(), data)
             return self.state
         return self.State(*s)
         # TODO: translate state tp capability class state
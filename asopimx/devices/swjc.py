@@ -6,17 +6,20 @@
 from traceback import format_exc
 from struct import *
 from collections import namedtuple
-from datetime import datetime, timedelta
 import base64
 import struct
+import time
 import logging
 
 from asopimx.profiles import Profile
+from asopimx.reactor import Reactor
+from asopimx.metrics import Metrics
+from asopimx.governor import Governor
 from asopimx.devices import Gamepad
-from asopimx.tools import hz, phexlify, decode_bools, encode_bools
+from asopimx import trace
+from asopimx.tools import phexlify, decode_bools, encode_bools
 from asopimx.devices.jctalk import JCR, JCL, JCP, Device, Main
 from asopimx.devices.swpro import SWPROProfile
-from asopimx.scheduler import Scheduler
 
 _logger = logging.getLogger(__name__ if __name__ != '__main__' else __file__)
 logging.basicConfig()
@@ -47,10 +50,9 @@ class SWJCP(JCP):
     subclass = '0' # bInterfaceSubClass
 
     # NOTE: currently mapped as a pro controller
-    report_desc = [
-    ] # TODO
-
-    report_length = str(len(report_desc)) # wDescriptorLength
+    report_desc = SWPROProfile.report_desc
+    report_length = SWPROProfile.report_length
+    packer = SWPROProfile.packer
 
     def __init__(self, *args, **kwargs):
         super(SWJCP,self).__init__(*args, **kwargs)
@@ -68,23 +70,7 @@ class SWJCP(JCP):
         )
         '''
         # TODO: update this (JCP has different state vars)
-        #package = base64.b16decode('27'.replace(' ', ''))
-        package = b''
-        package += struct.pack('B', self.state.u1)
-        package += struct.pack('B', self.state.bset1)
-        package += struct.pack('B', self.state.bset2)
-        package += struct.pack('B', self.state.h)
-        package += struct.pack('B', self.state.u2)
-        # l&r sticks (0-255)
-        package += struct.pack('B', self.state.x)
-        package += struct.pack('B', self.state.u3)
-        package += struct.pack('B', self.state.y)
-        package += struct.pack('B', self.state.u4)
-        package += struct.pack('B', self.state.z)
-        package += struct.pack('B', self.state.u5)
-        package += struct.pack('B', self.state.r)
-        #print(phexlify(package), end='\r')
-        return package
+        return self.packer.pack(self.state)
 
     def transform_cc(self, lstate):
         ''' build capabilities class state from local state '''
@@ -167,18 +153,26 @@ class SWJCPProfile(SWJCP,Profile):
     pass
 
 class SWJCPPC(SWJCP,Gamepad):
+    # memo keys: the first keyed bytes of each joycon's newest state report (id, timer, battery/connection,
+    # buttons & sticks; rumble & 6-axis follow, and never reach the host), less the timer & battery/connection
+    keyed = 12
+    volatile = (1, 2, keyed + 1, keyed + 2)
+
     def __init__(self, loop=None):
         super(SWJCPPC, self).__init__(loop=loop)
 
     def assign_profile(self, profile):
         ''' assign a profile to push/pull states to/from '''
         self.profile = profile
+        profile.assign_device(self)
     def unpack(self, data):
         ''' get data message, translate it to capability class state '''
         try:
             s = self.format.unpack(data)
-        except Exception as e:
-            _logger.warn(e)
+        except Exception:
+            Metrics().count('malformed_reports')
+            if trace.enabled:
+                trace.record(trace.MALFORMED, self.metrics_key(), data)
             return self.state
         return self.State(*s)
         # TODO: translate state tp capability class state
@@ -195,37 +189,64 @@ class SWJCPPC(SWJCP,Gamepad):
         # TODO: support raw send if device and profile match (no translation wanted/needed)
         self.cstate = self.transform_cc(self.lstate)
         self.profile.recv_dev(self.cstate)
-    def listen(self):
-        #from threading import Timer
-        #self.t = Timer(0.5, self.poll_state)
-        #self.t.start()
-        #self.s = Timer(0.5, self.send_profile)
-        #self.s.start()
-        # TODO: handle timeouts
-        import time
-        target_speed = timedelta(seconds=hz(120))
-        race = False
-        scheduler = Scheduler()
-        last = datetime.now()
-        while True:
-            scheduler.run()
-            self.observe()
-            self.send_profile()
-            if race:
-                continue
-            now = datetime.now()
-            delta = now - last
-            if delta > target_speed:
-                _logger.warn(
-                    'Falling behind: %s (%shz) / Target: %s (%shz)',
-                    delta.total_seconds(), hz(delta.total_seconds()),
-                    target_speed.total_seconds(), hz(target_speed.total_seconds()),
-                )
-                race = True
-                # target_speed = timedelta(seconds=hz(60))
-            else:
-                time.sleep((target_speed - delta).total_seconds())
-            last = datetime.now() # sleeping means we'll be a little slower
+    def recv_device(self, jcd):
+        ''' drain a (readable) joycon; fused state goes out once per wakeup '''
+        try:
+            state = jcd.observe()
+        except OSError as e:
+            self.lost = e
+            self.reactor.remove_reader(jcd.dev)
+            return
+        if state is not None and not self.pending:
+            # the other joycon may be readable, too
+            self.pending = True
+            self.reactor.call_soon(self.flush)
+    def flush(self):
+        self.pending = False
+        start = time.monotonic()
+        if self.memo is None:
+            self.fuse()
+        else:
+            self.recall(self.key(), self.fuse)
+        self.metrics.report(time.monotonic() - start)
+    def fuse(self):
+        self.fuse_state()
+        self.send_profile()
+    def key(self):
+        ''' both joycons' newest state reports (their keyed bytes; SEE: memo) '''
+        for i, jcd in enumerate((self.jcl, self.jcr)):
+            offset = i * self.keyed
+            r = jcd.state_report[:self.keyed] if jcd is not None else b''
+            self.kview[offset:offset + len(r)] = r
+            if len(r) < self.keyed: # (nothing yet)
+                self.kview[offset + len(r):offset + self.keyed] = bytes(self.keyed - len(r))
+        return self.kview
+    def expire(self):
+        ''' retry/give up on unanswered subcommands, even if a joycon goes quiet '''
+        for jcd in (self.jcl, self.jcr):
+            if jcd is not None:
+                jcd.subcommands.expire()
+    def attach(self):
+        ''' forward fused joycon state as reports arrive (until one of them is lost) '''
+        self.reactor = Reactor() # runs timers, too
+        self.pending = False
+        self.lost = None
+        self.metrics = Metrics().device(self.metrics_key())
+        self.metrics.connects += 1
+        if self.memo is not None:
+            self.kbuffer = bytearray(2 * self.keyed)
+            self.kview = memoryview(self.kbuffer)
+            self.memo.attach(self.metrics_key())
+        self.jcds = [jcd for jcd in (self.jcl, self.jcr) if jcd is not None]
+        for jcd in self.jcds:
+            self.reactor.add_reader(jcd.dev, self.recv_device, jcd)
+        self.timer = Governor().manage(self.reactor.call_every(.05, self.expire))
+
+    def detach(self):
+        self.timer.cancel()
+        for jcd in self.jcds:
+            self.reactor.remove_reader(jcd.dev)
+
 
 if __name__ == '__main__':
     import argparse
@@ -12,7 +12,11 @@ import time
 import logging
 
 from asopimx.profiles import Profile
+from asopimx.metrics import Metrics
 from asopimx.devices import Gamepad
+from asopimx import trace
+from asopimx.tools import hiddesc
+from asopimx.devices.jctalk import JCD
 from asopimx.tools import phexlify, decode_bools, encode_bools
 from asopimx.devices import Device
 
@@ -136,7 +140,12 @@ class SWPRO():
         # 0x00,            #  Unknown (bTag: 0x00, bType: 0x00)
     ] # 171 bytes (-1 (trailing unknown))
 
-    report_length = str(len(report_desc)) # wDescriptorLength (NOTE: this should mach lenth of resport_desc below)
+    report_length = str(hiddesc.report_length(report_desc)) # longest report (bytes)
+    packer = hiddesc.Packer(report_desc, [
+        ('B', 'u1'), ('B', 'bset1'), ('B', 'bset2'), ('B', 'h'),
+        ('B', 'u2'), ('B', 'x'), ('B', 'u3'), ('B', 'y'), # x, y: 16-bit (lo, hi)
+        ('B', 'u4'), ('B', 'z'), ('B', 'u5'), ('B', 'r'),
+    ], report_id=0x3F)
     # example:
     #   LB1A1    L34
     #   RB2B2    R38
@@ -175,15 +184,21 @@ class SWPRO():
             state.u8, state.u9, state.u10, #state.u11,
         )
         '''
-        # TODO: simplify this
-        s = self.state
-        package = self.format.pack(
-            s.u1, s.bset1,
-            s.bset2, s.h,
-            s.u2, s.x, s.u3, s.y, s.u4, s.z, s.u5, s.r
+        return self.packer.pack(self.state)
+
+    def transform_host(self, data):
+        ''' build capabilities class feedback from a host output report
+        0x01: gpn, rumble (8), subcommand, subcommand data
+        0x10: gpn, rumble (8)
+        '''
+        if len(data) < 10 or data[0] not in (0x01, 0x10):
+            return None
+        leds = None
+        if data[0] == 0x01 and len(data) > 11 and data[10] == 0x30: # player lights
+            leds = data[11] & 0x0F
+        return Gamepad.CFeedback(
+            JCD.decode_rumble(data[2:6]), JCD.decode_rumble(data[6:10]), leds,
         )
-        #print(phexlify(package), end='\r')
-        return package
 
     def transform_cc(self, lstate):
         ''' build capabilities class state from local state '''
@@ -250,7 +265,8 @@ class SWPRO():
         aid = self.saxi.get(id, None)
         amap = {0:'x', 1:'y', 2:'z', 3:'r'}
         if aid is None or id not in amap:
-            _logger.warn('not mapped')
+            if trace.enabled:
+                trace.record(trace.UNMAPPED, self.code, bytes([id & 0xFF]))
             return
 
         avalue = int((value / 32767.0) * 128) + 128
@@ -262,7 +278,8 @@ class SWPRO():
     def update_button(self, id, value):
         bid = self.sbuttons.get(id, None)
         if bid is None:
-            _logger.warn('not mapped')
+            if trace.enabled:
+                trace.record(trace.UNMAPPED, self.code, bytes([id & 0xFF]))
             return
         # TODO: pick button block depending on bid
         bstates = self.state.bset1
@@ -278,21 +295,48 @@ class SWPROProfile(SWPRO,Profile):
 class SWPROPC(SWPRO,Gamepad):
     def __init__(self, device=None):
         super(SWPROPC, self).__init__()
+        self.gpn = 0
+        self.vibrating = False
         if device:
             self.assign_device(device)
     def assign_device(self, device):
         self.dev = device # new-style device
         self.device = device.dev # phys device
+        self.jitter = Metrics().jitter(device.path)
 
     def assign_profile(self, profile):
         ''' assign a profile to push/pull states to/from '''
         self.profile = profile
+        profile.assign_device(self)
+    def send(self, cmd, rumble, scmd=None, scdata=None):
+        request = [cmd, self.gpn] + rumble
+        if scmd is not None:
+            request += [scmd] + (scdata or [])
+        self.device.write(request)
+        self.gpn = (self.gpn + 1) & 0xF
+    def recv_host(self, feedback):
+        ''' forward host feedback (rumble, leds) to the phys device '''
+        rumble = JCD.encode_rumble(feedback.lrumble) + JCD.encode_rumble(feedback.rrumble)
+        if not self.vibrating: # enable vibration (once)
+            self.send(0x01, JCD.rumblen, 0x48, [0x01])
+            self.vibrating = True
+        if feedback.leds is not None:
+            self.send(0x01, rumble, 0x30, [feedback.leds])
+        else:
+            self.send(0x10, rumble)
+    input_reports = {0x3F}
+    volatile = (4, 6, 8, 10) # stick low bytes (SEE: transform_cc)
+    def apply_report(self, data):
+        ''' subcommand replies, etc. (nothing to do with them yet) '''
+        _logger.debug('report: %s', phexlify(bytes(data)))
     def unpack(self, data):
         ''' get data message, translate it to capability class state '''
         try:
             s = self.format.unpack(data)
-        except Exception as e:
-            _logger.warn(e)
+        except Exception:
+            Metrics().count('malformed_reports')
+            if trace.enabled:
+                trace.record(trace.MALFORMED, self.metrics_key(), data)
             return self.state
         return self.State(*s)
         # TODO: translate state tp capability class state
@@ -300,6 +344,7 @@ class SWPROPC(SWPRO,Gamepad):
         ''' "Read" data from phys device (recorded data can be passed in for testing)'''
         if not data:
             return
+        self.jitter.tick(time.monotonic())
         self.state = self.unpack(data)
         #print('\rState: %s' % str(self.state), end='')
         self.send_profile()
@@ -310,12 +355,6 @@ class SWPROPC(SWPRO,Gamepad):
         # TODO: support raw send if device and profile match (no translation wanted/needed)
         self.cstate = self.transform_cc(self.state)
         self.profile.recv_dev(self.cstate)
-    def listen(self):
-        while True:
-            # TODO: handle timeouts
-            data = bytes(self.device.read(64))
-            self.read(data)
-            time.sleep(.001) # let the system breath
 
 
 if __name__ == '__main__':
@@ -332,10 +371,10 @@ if __name__ == '__main__':
         sys.exit()
     try:
         if args.test:
-            import hid
-            d = Device()
-            d.dev = hid.device()
-            d.dev.open_path(b'/dev/hidraw0')
+            from asopimx.tools import hidraw
+            d = Device(path=b'/dev/hidraw0')
+            d.dev = hidraw.device()
+            d.dev.open_path(d.path)
             con = SWPROPC()
             con.assign_profile(profile)
             con.assign_device(d)
@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+
+# XInput (wired Xbox 360 controller), served through FunctionFS
+# SEE: x/x3/gfs.py (Xbox360Msg), data/magic-ns/xinput
+
+from collections import namedtuple
+import struct
+import logging
+
+from asopimx.profiles import FFSProfile
+from asopimx.devices import Gamepad
+from asopimx.tools import fnfs
+from asopimx.tools.fnfs import Descriptor, USB
+
+_logger = logging.getLogger(__name__ if __name__ != '__main__' else __file__)
+logging.basicConfig()
+_logger.setLevel(logging.INFO) # logging.getLevelName('INFO')
+
+def button_table(bmap):
+    ''' buttons for each value of a (capability class) button byte '''
+    return [sum(b for i, b in bmap.items() if v & (1 << i)) for v in range(256)]
+
+class X360():
+    name = 'X360'
+    code = 'x360'
+
+    usb_bcd = '0x0200' # 02.00 # (USB2)
+    vendor_id = '0x045e' # Microsoft Corp. # idVendor
+    product_id = '0x028e' # Xbox360 Controller # idProduct
+    device_bcd = '0x0114' # 1.14 # bcdDevice
+    manufacturer = '1' # 1 # iManufacturer
+    product = 'Controller' # 2 iProduct
+    serial = '3' # iSerial
+    configuration = 'Xbox 360 Controller'
+    max_power = '500' # 500mA # MaxPower
+
+    # vendor specific (xinput); windows binds xusb22 through the XUSB10 compat id
+    device_class = ('0xff', '0xff', '0xff')
+    os_vendor_code = '0x90'
+    interface_class = (0xff, 0x5d, 0x01) # class, subclass, protocol
+    # NOTE: the vendor (0x21) descriptor real controllers have after the interface
+    #   can't be served; functionfs takes 0x21 for a HID descriptor (9 bytes)
+
+    max_packet = 32
+    in_ep = 1
+    out_ep = 2
+    report_length = '20'
+    output_length = 32
+
+    # Xbox360Msg: type, length, buttons, lt, rt, x1, y1, x2, y2 (6 bytes padding)
+    report = struct.Struct('<BBHBBhhhh6x')
+    XState = namedtuple('XState', 'type length buttons lt rt x y z r')
+    # buttons
+    class Buttons:
+        up = 1 << 0
+        down = 1 << 1
+        left = 1 << 2
+        right = 1 << 3
+        start = 1 << 4
+        back = 1 << 5
+        thumb_l = 1 << 6
+        thumb_r = 1 << 7
+        lb = 1 << 8
+        rb = 1 << 9
+        guide = 1 << 10
+        a = 1 << 12
+        b = 1 << 13
+        x = 1 << 14
+        y = 1 << 15
+    # capability class bits -> buttons (bset1: west, south, east, north, l, r, zl, zr)
+    bmap1 = {0: Buttons.x, 1: Buttons.a, 2: Buttons.b, 3: Buttons.y, 4: Buttons.lb, 5: Buttons.rb}
+    # (bset2: minus, plus, ls, rs, home)
+    bmap2 = {0: Buttons.back, 1: Buttons.start, 2: Buttons.thumb_l, 3: Buttons.thumb_r, 4: Buttons.guide}
+    btable1 = button_table(bmap1)
+    btable2 = button_table(bmap2)
+    # sticks: 0-255 -> signed 16-bit (y is up on xinput, down on ours)
+    # (128 is centre: 0; each half's scaled to its own end)
+    axis = [(v - 128) * 32767 // 127 if v > 128 else (v - 128) * 256 for v in range(256)]
+    axis_inverted = [min(32767, -a) for a in axis]
+    # capabilities (vendor request 0x01; 1s = supported, as a wired controller reports them)
+    capabilities = bytes([0x00, 0x14, 0xff, 0xf7, 0xff, 0xff, 0xc0, 0xff, 0xc0, 0xff, 0xc0, 0xff, 0xc0, 0xff, 0, 0, 0, 0, 0, 0])
+
+    def __init__(self, *args, **kwargs):
+        self.State = self.XState
+        self.neutral = self.State(
+            0x00, 0x14, # type, length
+            0x0000, # buttons
+            0x00, 0x00, # lt, rt
+            0, 0, # LS
+            0, 0, # RS
+        )
+        self.state = self.neutral
+        self.buffer = bytearray(self.report.size)
+        super(X360,self).__init__(*args, **kwargs)
+
+    def repack(self):
+        ''' repack state for transfer (to host) '''
+        self.report.pack_into(self.buffer, 0, *self.state)
+        return self.buffer
+
+    def transform_local(self, cstate):
+        ''' build local state from capabilities class state '''
+        buttons = self.btable1[cstate.bset1] | self.btable2[cstate.bset2] \
+            | cstate.hu | cstate.hd << 1 | cstate.hl << 2 | cstate.hr << 3
+        # digital triggers (zl, zr) when there's no analog value
+        lt = cstate.lt or (0xFF if cstate.bset1 & 0x40 else 0)
+        rt = cstate.rt or (0xFF if cstate.bset1 & 0x80 else 0)
+        self.state = self.State(
+            0x00, 0x14,
+            buttons,
+            lt, rt,
+            self.axis[cstate.x], self.axis_inverted[cstate.y],
+            self.axis[cstate.z], self.axis_inverted[cstate.r],
+        )
+        return self.state
+
+    def transform_host(self, data):
+        ''' build capabilities class feedback from a host output report
+        0x00: (length 8) 0x00, left (large) motor, right (small) motor, ...
+        0x01: (length 3) led pattern (2-5: player 1-4, flashing first; 6-9: player 1-4)
+        '''
+        if len(data) < 3:
+            return None
+        if data[0] == 0x00 and len(data) >= 5:
+            return Gamepad.CFeedback(data[3], data[4], None)
+        if data[0] == 0x01 and 0x02 <= data[2] <= 0x09:
+            return Gamepad.CFeedback(0, 0, 1 << ((data[2] - 0x02) % 4))
+        return None
+
+    def interfaces(self, speed):
+        ''' xinput interface: interrupt in (reports) & out (rumble, leds) '''
+        cls, subclass, protocol = self.interface_class
+        iface = Descriptor.Interface(
+            bLength=Descriptor.interface_size,
+            bDescriptorType=Descriptor.Type.interface,
+            bInterfaceNumber=0,
+            bNumEndpoints=2,
+            bInterfaceClass=cls,
+            bInterfaceSubClass=subclass,
+            bInterfaceProtocol=protocol,
+        )
+        eps = [
+            Descriptor.Endpoint(
+                bLength=Descriptor.endpoint_size,
+                bDescriptorType=Descriptor.Type.endpoint,
+                bEndpointAddress=n | direction,
+                bmAttributes=USB.Endpoint.Xfer.int,
+                wMaxPacketSize=self.max_packet,
+                bInterval=fnfs.interval(self.poll_ms, speed),
+            ) for n, direction in ((self.in_ep, USB.Dir.IN), (self.out_ep, USB.Dir.OUT))
+        ]
+        return [fnfs.Interface(iface, eps)]
+
+    def os_descs(self):
+        return [fnfs.os_compat(0, b'XUSB10')]
+
+    def control(self, function, request):
+        ''' vendor requests (capabilities) '''
+        if request.bRequestType & USB.Dir.IN and (request.bRequestType & USB.Type.mask) == USB.Type.vendor:
+            function.reply(request, self.capabilities)
+        else:
+            function.stall(request)
+
+
+class X360Profile(X360,FFSProfile):
+    pass
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    from traceback import format_exc
+    from asopimx.reactor import Reactor
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--clean', default=False, action='store_true')
+    args = parser.parse_args()
+    profile = X360Profile()
+    if args.clean:
+        profile.clean()
+        sys.exit()
+    try:
+        profile.register()
+        Reactor().run()
+    except KeyboardInterrupt:
+        pass
+    except:
+        _logger.warning(format_exc())
+    finally:
+        profile.clean()
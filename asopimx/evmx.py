@@ -1,3 +1,4 @@
+#!/usr/bin/python3
 
 # mx using evdev instead of js
 # Although evdev supports force-feedback, it's decidedly lacking. (All-around poor support.)
@@ -8,4 +9,323 @@ FF Support:
     Unsupported:
         PS4
         SWPro
+
+Any controller with a kernel driver works as a source:
+every pending input_event is read in one go (into a numpy buffer),
+events up to the last SYN_REPORT are applied to key/axis tables at once,
+and only the resulting state is sent on.
 '''
+
+import os
+import io
+import time
+import errno
+import ctypes
+import fcntl
+import logging
+from traceback import format_exc
+
+import numpy
+
+from asopimx.devices import Gamepad
+from asopimx.reactor import Reactor
+from asopimx.metrics import Metrics
+from asopimx.tools.ioctl import IOCTL
+
+_logger = logging.getLogger(__name__ if __name__ != '__main__' else 'evmx')
+
+# input-event-codes.h
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_ABS = 0x03
+SYN_REPORT = 0
+SYN_DROPPED = 3
+KEY_MAX = 0x2ff
+ABS_MAX = 0x3f
+
+class BTN:
+    SOUTH = 0x130
+    EAST = 0x131
+    NORTH = 0x133
+    WEST = 0x134
+    TL = 0x136
+    TR = 0x137
+    TL2 = 0x138
+    TR2 = 0x139
+    SELECT = 0x13a
+    START = 0x13b
+    MODE = 0x13c
+    THUMBL = 0x13d
+    THUMBR = 0x13e
+    DPAD_UP = 0x220
+    DPAD_DOWN = 0x221
+    DPAD_LEFT = 0x222
+    DPAD_RIGHT = 0x223
+
+class ABS:
+    X = 0x00
+    Y = 0x01
+    Z = 0x02
+    RX = 0x03
+    RY = 0x04
+    RZ = 0x05
+    GAS = 0x09
+    BRAKE = 0x0a
+    HAT0X = 0x10
+    HAT0Y = 0x11
+
+# input.h
+# struct input_event (native; the timeval is two longs)
+event = numpy.dtype([('sec', 'l'), ('usec', 'l'), ('type', 'u2'), ('code', 'u2'), ('value', 'i4')])
+
+class AbsInfo(ctypes.Structure):
+    _fields_ = [
+        ('value', ctypes.c_int32),
+        ('minimum', ctypes.c_int32),
+        ('maximum', ctypes.c_int32),
+        ('fuzz', ctypes.c_int32),
+        ('flat', ctypes.c_int32),
+        ('resolution', ctypes.c_int32),
+    ]
+
+class EVIOC:
+    type = ord('E')
+
+    def name(size):
+        return IOCTL.read(EVIOC.type, 0x06, size)
+
+    def key(size):
+        return IOCTL.read(EVIOC.type, 0x18, size)
+
+    def bit(ev, size):
+        return IOCTL.read(EVIOC.type, 0x20 + ev, size)
+
+    def abs(code):
+        return IOCTL.read(EVIOC.type, 0x40 + code, AbsInfo)
+
+class EVMX(Gamepad):
+    ''' evdev gamepad source (/dev/input/eventN) '''
+    name = 'evdev Gamepad'
+    code = 'evdev'
+
+    # capability class buttons (bset1: 0-7, bset2: 8-15)
+    # face buttons go west, south, east, north (SEE: devices.swpro bmap)
+    buttons = {
+        BTN.WEST: 0, BTN.SOUTH: 1, BTN.EAST: 2, BTN.NORTH: 3,
+        BTN.TL: 4, BTN.TR: 5, BTN.TL2: 6, BTN.TR2: 7,
+        BTN.SELECT: 8, BTN.START: 9, BTN.THUMBL: 10, BTN.THUMBR: 11, BTN.MODE: 12,
+    }
+    sticks = {ABS.X: 'x', ABS.Y: 'y', ABS.RX: 'z', ABS.RY: 'r'}
+    triggers = {ABS.Z: 'lt', ABS.RZ: 'rt', ABS.BRAKE: 'lt', ABS.GAS: 'rt'}
+    batch = 256 # most events per read
+
+    def __init__(self, path=None):
+        super(EVMX, self).__init__()
+        self.profile = None
+        self.keys = numpy.zeros(KEY_MAX + 1, numpy.int32)
+        self.abs = numpy.zeros(ABS_MAX + 1, numpy.int32)
+        self.ranges = {} # abs code: (minimum, span)
+        self.events = numpy.zeros(self.batch, event)
+        self.view = memoryview(self.events).cast('B')
+        self.pending = 0 # events read past the last SYN_REPORT
+        self.device = None
+        if path:
+            self.open(path)
+
+    @staticmethod
+    def list_devices():
+        ''' event devices with gamepad buttons '''
+        found = []
+        for fn in sorted(os.listdir('/dev/input')):
+            if not fn.startswith('event'):
+                continue
+            path = os.path.join('/dev/input', fn)
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                continue
+            try:
+                bits = bytearray((KEY_MAX + 8) // 8)
+                fcntl.ioctl(fd, EVIOC.bit(EV_KEY, len(bits)), bits, True)
+                if bits[BTN.SOUTH >> 3] & (1 << (BTN.SOUTH & 7)):
+                    found.append(path)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+        return found
+
+    def open(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+        self.device = io.FileIO(self.fd, 'rb', closefd=False)
+        for code in list(self.sticks) + list(self.triggers) + [ABS.HAT0X, ABS.HAT0Y]:
+            info = self.absinfo(code)
+            if info is not None:
+                self.ranges[code] = (info.minimum, max(1, info.maximum - info.minimum))
+        self.sync()
+        _logger.info('%s: %s', path, self.get_name())
+
+    def fileno(self):
+        return self.fd
+
+    def ioctl(self, request, arg):
+        fcntl.ioctl(self.fd, request, arg, True)
+
+    def get_name(self, size=256):
+        name = ctypes.create_string_buffer(size)
+        self.ioctl(EVIOC.name(size), name)
+        return name.value.decode('utf8', 'replace')
+
+    def absinfo(self, code):
+        info = AbsInfo()
+        try:
+            self.ioctl(EVIOC.abs(code), info)
+        except OSError: # not supported
+            return None
+        return info
+
+    def sync(self):
+        ''' (re)read key & axis state (on open, and whenever the kernel drops events) '''
+        bits = bytearray((KEY_MAX + 8) // 8)
+        self.ioctl(EVIOC.key(len(bits)), bits)
+        self.keys[:] = numpy.unpackbits(numpy.frombuffer(bytes(bits), numpy.uint8), bitorder='little')[:KEY_MAX + 1]
+        for code in self.ranges:
+            info = self.absinfo(code)
+            if info is not None:
+                self.abs[code] = info.value
+
+    def assign_profile(self, profile):
+        ''' assign a profile to push/pull states to/from '''
+        self.profile = profile
+        profile.assign_device(self)
+
+    def recv_device(self):
+        ''' read pending events; complete (SYN_REPORT terminated) batches are applied together '''
+        size = event.itemsize
+        try:
+            n = self.device.readinto(self.view[self.pending * size:])
+            if n == 0:
+                raise OSError(errno.ENODEV, 'device removed', self.path)
+        except OSError as e:
+            self.lost = e
+            Reactor().remove_reader(self.device)
+            return
+        if n is None: # nothing pending
+            return
+        total = self.pending + n // size
+        ev = self.events[:total]
+        syn = numpy.flatnonzero(ev['type'] == EV_SYN)
+        reports = syn[ev['code'][syn] == SYN_REPORT]
+        if not len(reports):
+            # partial batch; wait for the rest
+            if total < self.batch:
+                self.pending = total
+                return
+            # it's filled the buffer; treat it like SYN_DROPPED (a lost key release would stick)
+            Metrics().count('dropped_events')
+            self.metrics.dropped += 1
+            self.pending = 0
+            self.sync()
+            self.send_profile()
+            return
+        end = reports[-1] + 1
+        if (ev['code'][syn] == SYN_DROPPED).any():
+            # the kernel's queue overflowed; what we have is incomplete
+            Metrics().count('dropped_events')
+            self.metrics.dropped += 1
+            self.sync()
+        else:
+            self.apply(ev[:end])
+        left = total - end
+        if left:
+            self.events[:left] = self.events[end:total]
+        self.pending = left
+        if len(reports) > 1:
+            Metrics().count('coalesced_reports', len(reports) - 1)
+            self.metrics.coalesced += len(reports) - 1
+        start = time.monotonic()
+        self.send_profile()
+        self.metrics.report(time.monotonic() - start)
+
+    def apply(self, ev):
+        ''' apply events (in order; the last value of each key/axis wins) '''
+        for type, table in ((EV_KEY, self.keys), (EV_ABS, self.abs)):
+            sel = ev[ev['type'] == type][::-1]
+            if len(sel):
+                codes, idx = numpy.unique(sel['code'], return_index=True)
+                table[codes] = sel['value'][idx]
+
+    def scale(self, code, default):
+        ''' axis value (0-255) '''
+        r = self.ranges.get(code)
+        if r is None:
+            return default
+        return min(255, max(0, (int(self.abs[code]) - r[0]) * 255 // r[1]))
+
+    def trigger(self, axes, button):
+        for code in axes:
+            if code in self.ranges:
+                return self.scale(code, 0)
+        return 255 if self.keys[button] else 0
+
+    def state(self):
+        ''' build capability class state from the key/axis tables '''
+        k = self.keys
+        bset = 0
+        for code, bit in self.buttons.items():
+            if k[code]:
+                bset |= 1 << bit
+        hx = self.abs[ABS.HAT0X]
+        hy = self.abs[ABS.HAT0Y]
+        pressed = lambda code: 255 if k[code] else 0
+        return self.CState(
+            bset & 0xFF, bset >> 8,
+            self.scale(ABS.X, 128), self.scale(ABS.Y, 128),
+            self.scale(ABS.RX, 128), self.scale(ABS.RY, 128),
+            int(hx > 0 or bool(k[BTN.DPAD_RIGHT])), int(hx < 0 or bool(k[BTN.DPAD_LEFT])),
+            int(hy < 0 or bool(k[BTN.DPAD_UP])), int(hy > 0 or bool(k[BTN.DPAD_DOWN])),
+            pressed(BTN.NORTH), pressed(BTN.EAST), pressed(BTN.SOUTH), pressed(BTN.WEST),
+            pressed(BTN.TL), pressed(BTN.TR),
+            self.trigger((ABS.Z, ABS.BRAKE), BTN.TL2), self.trigger((ABS.RZ, ABS.GAS), BTN.TR2),
+        )
+
+    def send_profile(self):
+        ''' send current state to profile '''
+        self.cstate = self.state()
+        if self.profile is not None:
+            self.profile.recv_dev(self.cstate)
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    from asopimx.devices.mnsd import MNSDProfile
+    from asopimx.devices.swpro import SWPROProfile
+    from asopimx.devices.ps3 import PS3Profile
+    profiles = dict((p.code, p) for p in (MNSDProfile, SWPROProfile, PS3Profile))
+
+    parser = argparse.ArgumentParser(description='Multiplex an evdev gamepad')
+    parser.add_argument('device', nargs='?', help='Event device (ex. /dev/input/event0; defaults to the first gamepad)')
+    parser.add_argument('-p', '--profile', default='swpro', help='Capability profile to register')
+    parser.add_argument('-l', '--list', default=False, action='store_true', help='List gamepads')
+    args = parser.parse_args()
+
+    if args.list:
+        print('\n'.join(EVMX.list_devices()))
+        sys.exit()
+    path = args.device or (EVMX.list_devices() or [None])[0]
+    if path is None:
+        print('No gamepads found.')
+        sys.exit(1)
+    profile = profiles[args.profile](path='/dev/hidg0')
+    try:
+        profile.register()
+        con = EVMX(path)
+        con.assign_profile(profile)
+        con.listen()
+    except KeyboardInterrupt:
+        pass
+    except:
+        _logger.warning(format_exc())
+    finally:
+        profile.clean()
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+''' live capability class state, exported through a memory-mapped file (for overlays, loggers, tests, ...)
+Profiles publish every state they receive (SEE: Profile.recv_dev); readers map the file
+and sample it whenever they like; no syscalls (and nothing for us to wait on) either way.
+
+layout (little-endian):
+    header (16 bytes)
+        0   4s  magic (b'AMXS')
+        4   u16 version (1)
+        6   u16 slots
+        8   u16 slot size (48)
+        10  u16 state size (18)
+        12  (padding)
+    slot (one per profile; SEE: Profile.index), at 16 + index * slot size
+        0   u32 seq (odd while the slot's being written; readers retry until it's even & unchanged)
+        4   u32 reports published
+        8   u64 timestamp (CLOCK_MONOTONIC, ns)
+        16  8s  profile code (NUL padded; empty = unused)
+        24  u8[18] capability class state: bset1 bset2 x y z r hr hl hu hd bx ba bb by lb rb lt rt
+            (SEE: devices.Gamepad)
+        42  (padding)
+'''
+
+import os
+import mmap
+import time
+import struct
+from collections import namedtuple
+import logging
+
+_logger = logging.getLogger(__name__)
+
+path = '/dev/shm/asopimx'
+magic = b'AMXS'
+version = 1
+header = struct.Struct('<4sHHHH4x')
+slot = struct.Struct('<IIQ8s18B6x')
+seqs = struct.Struct('<II') # seq, reports
+stamp = struct.Struct('<Q')
+state = struct.Struct('<18B')
+state_offset = 24
+retries = 16
+
+State = namedtuple('State', 'bset1 bset2 x y z r hr hl hu hd bx ba bb by lb rb lt rt')
+Sample = namedtuple('Sample', 'seq reports timestamp code state')
+
+class Export:
+    ''' (writer) the exported state file '''
+    def __init__(self, path=path, slots=4):
+        self.path = path
+        self.slots = slots
+        size = header.size + slot.size * slots
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        header.pack_into(self.map, 0, magic, version, slots, slot.size, state.size)
+        self.seqs = [0] * slots
+        self.reports = [0] * slots
+
+    def offset(self, index):
+        return header.size + index * slot.size
+
+    def attach(self, index, code):
+        ''' claim a slot for a profile '''
+        if index >= self.slots:
+            raise ValueError('no slot for profile %s (%s slots)' % (index, self.slots))
+        slot.pack_into(self.map, self.offset(index), 0, 0, 0, code.encode()[:8], *bytes(state.size))
+        self.seqs[index] = self.reports[index] = 0
+
+    def publish(self, index, cstate):
+        offset = self.offset(index)
+        seq = self.seqs[index] + 1
+        reports = self.reports[index] + 1
+        seqs.pack_into(self.map, offset, seq, reports - 1)
+        stamp.pack_into(self.map, offset + seqs.size, time.monotonic_ns())
+        state.pack_into(self.map, offset + state_offset, *cstate)
+        seqs.pack_into(self.map, offset, seq + 1, reports)
+        self.seqs[index] = seq + 1
+        self.reports[index] = reports
+
+    def close(self):
+        self.map.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+class Reader:
+    ''' (consumer) sample exported state
+    reader = Reader()
+    sample = reader.read(0) # Sample(seq, reports, timestamp, code, state)
+    '''
+    def __init__(self, path=path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        m, v, self.slots, slot_size, state_size = header.unpack_from(self.map, 0)
+        if m != magic or v != version or slot_size != slot.size or state_size != state.size:
+            raise ValueError('%s: not a (version %s) state export' % (path, version))
+
+    def seq(self, index):
+        ''' the slot's seq (cheap; compare against a sample's to see if anything's changed) '''
+        return seqs.unpack_from(self.map, header.size + index * slot.size)[0]
+
+    def read(self, index):
+        ''' a consistent sample of a slot (None if it's unused, or kept changing under us) '''
+        offset = header.size + index * slot.size
+        for _ in range(retries):
+            seq = seqs.unpack_from(self.map, offset)[0]
+            if seq & 1:
+                continue
+            values = slot.unpack_from(self.map, offset)
+            if seqs.unpack_from(self.map, offset)[0] != seq:
+                continue
+            code = values[3].rstrip(b'\0').decode()
+            if not code:
+                return None
+            return Sample(seq, values[1], values[2], code, State(*values[4:]))
+        return None
+
+    def samples(self):
+        return [self.read(i) for i in range(self.slots)]
+
+    def close(self):
+        self.map.close()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Watch exported controller state')
+    parser.add_argument('path', nargs='?', default=path)
+    parser.add_argument('-r', '--rate', default=30, type=float, help='Samples per second (default: %(default)s)')
+    args = parser.parse_args()
+    reader = Reader(args.path)
+    try:
+        while True:
+            print(' | '.join(
+                '%s %s' % (s.code, ' '.join('%3d' % v for v in s.state)) for s in reader.samples() if s
+            ), end='\r', flush=True)
+            time.sleep(1 / args.rate)
+    except KeyboardInterrupt:
+        print()
+    finally:
+        reader.close()
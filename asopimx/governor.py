@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+''' adaptive pacing (for battery powered / single core boards)
+Reports are handled as they arrive, whatever the governor thinks; it only paces the periodic work
+around them (coexistence checks, link pings, metrics, subcommand expiry, device discovery):
+    idle: no input state changed for a while; managed timers back off (by backoff)
+    budget: process cpu use (of one core) over the budget; managed timers slow down further,
+        doubling each check it stays over (halving again once it's well under)
+The first changed state snaps everything back (SEE: Profile.recv_dev).
+'''
+
+import os
+import time
+import logging
+
+from asopimx.tools import Singleton
+from asopimx.scheduler import Scheduler
+from asopimx.metrics import Metrics
+
+_logger = logging.getLogger(__name__)
+
+class Governor(metaclass=Singleton):
+    max_pressure = 4 # (budget slowdown: up to 2 ** max_pressure)
+
+    def __init__(self):
+        self.timers = {} # timer: interval (at full speed)
+        self.running = False
+        self.idle = False
+        self.pressure = 0
+        self.last = time.monotonic() # last input
+        self.timer = None
+
+    def manage(self, timer):
+        ''' pace a periodic timer (non-essential work) '''
+        self.timers[timer] = timer.interval
+        if self.running and self.factor() != 1:
+            Scheduler().reschedule(timer, timer.interval * self.factor())
+        return timer
+
+    def start(self, reactor, idle=.5, backoff=4, budget=None, interval=None):
+        ''' idle: seconds without a state change; budget: cpu (of one core; ex. .25), None = unlimited '''
+        self.idle_after = idle
+        self.backoff = backoff
+        self.budget = budget
+        self.last = time.monotonic()
+        self.sampled = (self.last, self.cpu())
+        self.running = True
+        self.timer = reactor.call_every(interval or max(idle / 2, .05), self.check)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.running = False
+        self.idle = False
+        self.pressure = 0
+        self.apply()
+
+    def cpu(self):
+        t = os.times()
+        return t.user + t.system
+
+    def factor(self):
+        ''' how much slower managed work runs right now '''
+        return (self.backoff if self.idle else 1) * (1 << self.pressure)
+
+    def stretch(self, interval):
+        ''' pace (something like) a timer that isn't managed (ex. discovery) '''
+        return interval * self.factor() if self.running else interval
+
+    def input(self):
+        ''' a (changed) input state came in '''
+        self.last = time.monotonic()
+        if self.idle:
+            self.idle = False
+            Metrics().count('governor_wakes')
+            self.apply()
+
+    def check(self):
+        now = time.monotonic()
+        factor = self.factor()
+        if not self.idle and now - self.last >= self.idle_after:
+            self.idle = True
+        if self.budget is not None and now - self.sampled[0] >= 1:
+            cpu = self.cpu()
+            used = (cpu - self.sampled[1]) / (now - self.sampled[0])
+            self.sampled = (now, cpu)
+            Metrics().gauge('cpu', used)
+            if used > self.budget and self.pressure < self.max_pressure:
+                self.pressure += 1
+                Metrics().count('governor_throttles')
+            elif used < self.budget * .75 and self.pressure:
+                self.pressure -= 1
+        if self.factor() != factor:
+            self.apply()
+
+    def apply(self):
+        factor = self.factor() if self.running else 1
+        Metrics().gauge('governor_factor', factor)
+        scheduler = Scheduler()
+        for timer, interval in list(self.timers.items()):
+            if timer.cancelled:
+                del self.timers[timer]
+                continue
+            scheduler.reschedule(timer, interval * factor)
@@ -1,17 +1,19 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 # Multiplexing via legacy js interface (kept for posterity)
 # Thanks to rdb for his quick example implementation!
 
 # SEE: https://www.kernel.org/doc/Documentation/input/joystick-api.txt 
 
-import os, struct, array
+import os, io, errno, struct
 from fcntl import ioctl
-from struct import *
 from collections import namedtuple
 import base64
 import logging
 
+from asopimx.reactor import Reactor
+from asopimx.metrics import Metrics
+
 _logger = logging.getLogger(__name__ if __name__ != '__main__' else 'jsmx')
 
 class JSMX():
@@ -87,6 +89,13 @@ class JSMX():
         0x2c3 : 'dpad_down',
     }
 
+    # struct js_event: time (ms), value, type, number
+    event = struct.Struct('IhBB')
+    JS_EVENT_BUTTON = 0x01
+    JS_EVENT_AXIS = 0x02
+    JS_EVENT_INIT = 0x80
+    batch = 64 # most events per read
+
     @staticmethod
     def list_devices():
         print('Available devices:')
@@ -105,13 +114,13 @@ class JSMX():
     @staticmethod
     def decode_bools(intval, bits):
         res = []
-        for bit in xrange(bits):
+        for bit in range(bits):
             mask = 1 << bit
             res.append((intval & mask) == mask)
         return res
     
     
-    def __init__(self):
+    def __init__(self, path='/dev/input/js0', hidg='/dev/hidg0'):
         self.axis_states = {}
         self.button_states = {}
         self.axis_map = []
@@ -128,31 +137,33 @@ class JSMX():
         })
         # 0-5; x, y, z(rx), r(ry), hatx, haty
         self.saxi = dict((i, i) for i in range(0,6))
+        self.amap = {0:'x', 1:'y', 2:'z', 3:'r', 4:'hu', 5:'hr', 6:'hd', 7:'hl'}
         
-        # Open the joystick device.
-        fn = '/dev/input/js0'
-        print('Opening %s...' % fn)
-        self.jsdev = open(fn, 'rb')
+        # Open the joystick device (non-blocking; events are read in bulk, SEE: recv_device)
+        self.path = path
+        self.jsfd = os.open(path, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+        self.jsdev = io.FileIO(self.jsfd, 'rb', closefd=False)
+        self.evbuffer = bytearray(self.event.size * self.batch)
+        self.evview = memoryview(self.evbuffer)
         
         # Get the device name.
-        #buf = bytearray(63)
-        buf = array.array('c', ['\0'] * 64)
-        ioctl(self.jsdev, 0x80006a13 + (0x10000 * len(buf)), buf) # JSIOCGNAME(len)
-        js_name = buf.tostring()
-        print('Device name: %s' % js_name)
+        buf = bytearray(64)
+        ioctl(self.jsfd, 0x80006a13 + (0x10000 * len(buf)), buf) # JSIOCGNAME(len)
+        js_name = buf.split(b'\0', 1)[0].decode('utf8', 'replace')
+        _logger.info('%s: %s', path, js_name)
         
         # Get number of axes and buttons.
-        buf = array.array('B', [0])
-        ioctl(self.jsdev, 0x80016a11, buf) # JSIOCGAXES
+        buf = bytearray(1)
+        ioctl(self.jsfd, 0x80016a11, buf) # JSIOCGAXES
         num_axes = buf[0]
         
-        buf = array.array('B', [0])
-        ioctl(self.jsdev, 0x80016a12, buf) # JSIOCGBUTTONS
+        buf = bytearray(1)
+        ioctl(self.jsfd, 0x80016a12, buf) # JSIOCGBUTTONS
         num_buttons = buf[0]
         
         # Get the axis map.
-        buf = array.array('B', [0] * 0x40)
-        ioctl(self.jsdev, 0x80406a32, buf) # JSIOCGAXMAP
+        buf = bytearray(0x40)
+        ioctl(self.jsfd, 0x80406a32, buf) # JSIOCGAXMAP
         
         for axis in buf[:num_axes]:
             axis_name = self.axis_names.get(axis, 'unknown(0x%02x)' % axis)
@@ -160,20 +171,17 @@ class JSMX():
             self.axis_states[axis_name] = 0.0
         
         # Get the button map.
-        buf = array.array('H', [0] * 200)
-        ioctl(self.jsdev, 0x80406a34, buf) # JSIOCGBTNMAP
+        buf = bytearray(2 * 200)
+        ioctl(self.jsfd, 0x80406a34, buf) # JSIOCGBTNMAP
         
-        for btn in buf[:num_buttons]:
+        for (btn,) in struct.iter_unpack('H', buf[:2 * num_buttons]):
             btn_name = self.button_names.get(btn, 'unknown(0x%03x)' % btn)
             self.button_map.append(btn_name)
             self.button_states[btn_name] = 0
         
-        print('%d axes found: %s' % (num_axes, ', '.join(self.axis_map)))
-        print('%d buttons found: %s' % (num_buttons, ', '.join(self.button_map)))
+        _logger.info('%d axes found: %s', num_axes, ', '.join(self.axis_map))
+        _logger.info('%d buttons found: %s', num_buttons, ', '.join(self.button_map))
 
-        # tried to use structs, but reverted back to hex-manipulation
-        # due to sizing issues (and endian-ness was mixing everything up)
-        self.dformat = 'bbBBbbBBBBihiqqQ'
         self.State = namedtuple('State', 'u1 u2 bset1 bset2 u3 u4 x y z r u5 hu hr hd hl u6 u7 u8 u9 u10 u11')
         self.state = self.State(
             1, 0,
@@ -185,7 +193,6 @@ class JSMX():
             0, 0, 0, 0,
             0, 0,
         )
-        print(str(self.state.u6))
         # \x1\0\xff\x2\0\0\x83\x7d\x81\x80
         # \0\0\0\0\0\0\0
         # \0\0\0\0\0\0\0\0
@@ -193,122 +200,121 @@ class JSMX():
         # \0\0\0\x12\xf8\x77\0\0
         # \x2\x7\x1\xee\x1\x94\x1\xd7
 
-    def repack(self):
-        '''
-        package = struct.pack(
-            self.dformat,
-            state.u1, state.u2,
-            state.bset1, state.bset2,
-            state.u3, state.u4,
-            state.x, state.y, state.z, state.r,
-            state.u5, state.u6, state.u7,
-            state.u8, state.u9, state.u10, #state.u11,
-        )
-        '''
-        package = base64.b16decode('01 00'.replace(' ', ''))
-        package += struct.pack('H', self.state.bset1)
-        print(self.state.x)
-        # 16-buttons (binary)
-        package += base64.b16decode('00 00'.replace(' ', ''))
-        # l&r sticks (0-255)
-        package += struct.pack('B', self.state.x)
-        package += struct.pack('B', self.state.y)
-        package += struct.pack('B', self.state.z)
-        package += struct.pack('B', self.state.r)
-        package += base64.b16decode('00 00 00 00'.replace(' ', ''))
-        #package += base64.b16decode('00 00 00 83 7D 81 80 00 00 00 00 00 00'.replace(' ', ''))
-        # hat (0-255)
-        package += struct.pack('B', self.state.hu)
-        package += struct.pack('B', self.state.hr)
-        package += struct.pack('B', self.state.hd)
-        package += struct.pack('B', self.state.hl)
+        # report: the state fields are packed over a (constant) template (SEE: repack)
+        # u1, (u2), 16-buttons (binary), (00 00), l&r sticks (0-255), (00 00 00 00), hat (0-255)
+        self.dformat = struct.Struct('<BxH2x4B4x4B')
+        self.report = bytearray(self.dformat.size)
         # TODO
-        package += base64.b16decode('00 00 00 00 00 00 00 00 00 00 00 00 02 EE 12'.replace(' ', ''))
-        package += base64.b16decode('00 00 00 00 12 F8 77 00'.replace(' ', ''))
+        self.report += base64.b16decode('00 00 00 00 00 00 00 00 00 00 00 00 02 EE 12'.replace(' ', ''))
+        self.report += base64.b16decode('00 00 00 00 12 F8 77 00'.replace(' ', ''))
         # x, y, z; (+/-)  right/left, forward/back, up/down(right-hand rule)
         # 02 = sixaxis rotation around the x axis
         # 03,01 = sixaxis rotation around the y axis
         # 04 = sixaxis rotation around the z axis
         # (byte before each of them are acceleration? detection of motion? orientation?)
         # (juding by hid report data, motion detection seems most likely)
-        package += base64.b16decode('00 02 05 03 EF 01 93 04'.replace(' ', ''))
-        print(len(package))
-        return package
+        self.report += base64.b16decode('00 02 05 03 EF 01 93 04'.replace(' ', ''))
+
+        # persistent gadget fd (SEE: send_event)
+        self.hidg = hidg
+        self.hidfd = None
+
+    def repack(self):
+        ''' pack the state into the (reused) report buffer '''
+        s = self.state
+        self.dformat.pack_into(self.report, 0,
+            s.u1,
+            s.bset1,
+            s.x, s.y, s.z, s.r,
+            s.hu, s.hr, s.hd, s.hl,
+        )
+        return self.report
 
     def update_axis(self, id, value):
         aid = self.saxi.get(id, None)
-        amap = {0:'x', 1:'y', 2:'z', 3:'r', 4:'hu', 5:'hr', 6:'hd', 7:'hl'}
-        if aid is None or id not in amap:
-            print('not mapped')
+        if aid is None or id not in self.amap:
             return
  
-        print(value)
         avalue = int((value / 32767.0) * 128) + 128
-        print(avalue)
         if avalue > 255:
             avalue = 255
-        print(amap[id])
-        self.state.__dict__[amap[id]] = avalue
-        self.state = self.state._replace(**{amap[id]: avalue})
-        print(self.state)
+        self.state = self.state._replace(**{self.amap[id]: avalue})
 
     def update_button(self, id, value):
         bid = self.sbuttons.get(id, None)
         if bid is None:
-            print('not mapped')
             return
         # TODO: pick button block depending on bid
-        bstates = self.state.bset1
-        bbstates = self.decode_bools(bstates, 16)
-        bbstates[bid] = True if value else False
-        print(bbstates)
-        self.state = self.state._replace(bset1=self.encode_bools(bbstates))
-        print(self.state.bset1)
-        return
+        if value:
+            bset1 = self.state.bset1 | (1 << bid)
+        else:
+            bset1 = self.state.bset1 & ~(1 << bid)
+        self.state = self.state._replace(bset1=bset1)
 
     def send_event(self):
-        s = self.repack()
-        print(repr(s))
-        with open('/dev/hidg0', 'wb') as f:
-            f.write(s)
+        if self.hidfd is None:
+            self.hidfd = os.open(self.hidg, os.O_WRONLY | os.O_CLOEXEC)
+        os.write(self.hidfd, self.repack())
+
+    def recv_device(self):
+        ''' read all pending events; they're applied together and sent as one report '''
+        state = self.state
+        events = 0
+        while True:
+            try:
+                n = self.jsdev.readinto(self.evbuffer)
+                if n == 0:
+                    raise OSError(errno.ENODEV, 'device removed', self.path)
+            except OSError as e:
+                self.lost = e
+                Reactor().remove_reader(self.jsfd)
+                return
+            if n is None: # drained
+                break
+            for time, value, type, number in self.event.iter_unpack(self.evview[:n]):
+                events += 1
+                if type & self.JS_EVENT_BUTTON:
+                    if number < len(self.button_map):
+                        self.button_states[self.button_map[number]] = value
+                    self.update_button(number, value)
+                elif type & self.JS_EVENT_AXIS:
+                    if number < len(self.axis_map):
+                        self.axis_states[self.axis_map[number]] = value / 32767.0
+                    self.update_axis(number, value)
+            if n < len(self.evbuffer):
+                break
+        if events > 1:
+            Metrics().count('coalesced_events', events - 1)
+        if self.state != state:
+            self.send_event()
 
     def mix(self):
+        ''' forward joystick events until the device is lost '''
+        reactor = Reactor()
         # send initial state
         self.send_event()
-        
-        # event loop
-        while True:
-            self.send_event()
-            evbuf = self.jsdev.read(8)
-            if evbuf:
-                time, value, type, number = struct.unpack('IhBB', evbuf)
-        
-                if type & 0x80:
-                     print("(initial)")
-        
-                if type & 0x01:
-                    button = self.button_map[number]
-                    state = self.update_button(number, value)
-                    self.send_event()
-                    if button:
-                        self.button_states[button] = value
-                        if value:
-                            print("%s pressed" % (button))
-                        else:
-                            print("%s released" % (button))
-        
-                if type & 0x02:
-                    axis = self.axis_map[number]
-                    print(number)
-                    if axis:
-                        self.update_axis(number, value)
-                        self.send_event()
-                        fvalue = value / 32767.0
-                        self.axis_states[axis] = fvalue
-                        print("%s: %.3f" % (axis, fvalue))
+        self.lost = None
+        reactor.add_reader(self.jsfd, self.recv_device)
+        try:
+            while self.lost is None:
+                reactor.run_once(None)
+        finally:
+            reactor.remove_reader(self.jsfd)
+            self.close()
+        raise self.lost
+
+    def close(self):
+        if self.hidfd is not None:
+            os.close(self.hidfd)
+            self.hidfd = None
+        if self.jsfd is not None:
+            self.jsdev.close()
+            os.close(self.jsfd)
+            self.jsfd = None
 
 if __name__ == '__main__':
     # TODO: do something more useful
+    logging.basicConfig(level=logging.INFO)
     JSMX.list_devices()
     jsmx = JSMX()
     jsmx.mix()
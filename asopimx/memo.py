@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+''' device -> profile transform memoization
+A controller at rest sends the same report over and over; each one goes through
+unpack, transform_cc, transform_local & repack to produce the same host report.
+Memo maps a phys device report (less its volatile bytes: counters, timers, anything the
+transform ignores) to what came out of it, so repeats are sent as they are (SEE: Gamepad.recv_device).
+It's a bounded LRU; entries are small (a key, three states we already had, and a copy of the host report),
+so a few hundred of them keep a resting controller's reports well within a Pi Zero's means.
+'''
+
+import sys
+from collections import OrderedDict
+import logging
+
+from asopimx.metrics import Metrics
+
+_logger = logging.getLogger(__name__)
+
+class Memo:
+    ''' report key: (state, cstate, profile state, packed host report) '''
+    def __init__(self, size=256, volatile=()):
+        self.size = size
+        self.entries = OrderedDict()
+        # volatile bytes are masked off the key (a report is keyed as an int, a bit over its length marks the length)
+        self.mask = ~sum(0xFF << (8 * i) for i in volatile)
+        self.bytes = 0 # (approximate) memory held by entries
+        self.metrics = None # the device's (SEE: attach)
+        self.device = None
+
+    def attach(self, device):
+        self.device = device
+        self.metrics = Metrics().device(device)
+        self.gauges()
+
+    def key(self, view):
+        return (int.from_bytes(view, 'little') | (1 << (len(view) * 8))) & self.mask
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.metrics.memo_misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.metrics.memo_hits += 1
+        return entry
+
+    def put(self, key, entry):
+        if key in self.entries:
+            return
+        self.entries[key] = entry
+        self.bytes += self.footprint(key, entry)
+        while len(self.entries) > self.size:
+            k, e = self.entries.popitem(last=False)
+            self.bytes -= self.footprint(k, e)
+        self.gauges()
+
+    def footprint(self, key, entry):
+        # (the states are shared with whatever else produced them; only the key, entry & report are ours)
+        return sys.getsizeof(key) + sys.getsizeof(entry) + sys.getsizeof(entry[3])
+
+    def gauges(self):
+        metrics = Metrics()
+        metrics.gauge('memo_entries', len(self.entries), self.device)
+        metrics.gauge('memo_bytes', self.bytes, self.device)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+        self.gauges()
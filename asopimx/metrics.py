@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+
+''' runtime metrics (latencies and counters)
+Kept to plain attribute updates so recording from the hot path stays cheap.
+Everything's exported in the Prometheus text format (SEE: render, Endpoint):
+over a UNIX socket (connect & read) and/or a textfile (for node_exporter's textfile collector).
+'''
+
+import os
+import time
+import socket
+from bisect import bisect_left
+import logging
+
+from asopimx.tools import Singleton
+
+_logger = logging.getLogger(__name__)
+
+class Latency:
+    ''' running latency stats (in seconds) '''
+    __slots__ = ('count', 'total', 'min', 'max', 'last')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        self.last = value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def __repr__(self):
+        return '<Latency n=%s last=%.6f mean=%.6f min=%.6f max=%.6f>' % (
+            self.count, self.last, self.mean(), self.min or 0.0, self.max
+        )
+
+class Jitter:
+    ''' inter-arrival jitter (seconds; smoothed mean deviation from the mean interval)
+    gaps longer than idle are treated as the device idling, not jitter
+    '''
+    __slots__ = ('last', 'interval', 'jitter', 'idle')
+
+    def __init__(self, idle=.1):
+        self.last = None
+        self.interval = None
+        self.jitter = 0.0
+        self.idle = idle
+
+    def tick(self, now):
+        last, self.last = self.last, now
+        if last is None:
+            return
+        d = now - last
+        if d > self.idle:
+            return
+        if self.interval is None:
+            self.interval = d
+            return
+        self.jitter += (abs(d - self.interval) - self.jitter) / 16
+        self.interval += (d - self.interval) / 16
+
+class Histogram:
+    ''' fixed bucket (seconds) histogram; counts are preallocated '''
+    __slots__ = ('counts', 'count', 'total')
+    bounds = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1) # (last: +Inf)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+class DeviceMetrics:
+    ''' per device counters (kept across reconnects)
+    transform: reading a report through to the host report being written (less the write)
+    write: sending it to the host
+    '''
+    __slots__ = ('reports', 'coalesced', 'dropped', 'connects', 'transform', 'write', 'written',
+        'rate', 'sampled', 'sampled_on', 'memo_hits', 'memo_misses')
+
+    def __init__(self):
+        self.reports = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.connects = 0
+        self.transform = Histogram()
+        self.write = Histogram()
+        self.written = 0.0 # last write's time (taken out of the report's transform time)
+        self.rate = 0.0 # reports/s (SEE: Metrics.sample)
+        self.sampled = 0
+        self.sampled_on = None
+        self.memo_hits = 0 # (SEE: memo)
+        self.memo_misses = 0
+
+    def report(self, elapsed):
+        ''' a report's been handled (elapsed: seconds, write included) '''
+        self.reports += 1
+        self.transform.record(elapsed - self.written)
+        self.written = 0.0
+
+    def wrote(self, elapsed):
+        self.write.record(elapsed)
+        self.written = elapsed
+
+class Metrics(metaclass=Singleton):
+    def __init__(self):
+        self.latencies = {}
+        self.counters = {}
+        self.gauges = {} # (name, device): value
+        self.jitters = {} # device: Jitter
+        self.devices = {} # device: DeviceMetrics
+
+    def latency(self, name):
+        ''' get (or create) a named Latency '''
+        l = self.latencies.get(name)
+        if l is None:
+            l = self.latencies[name] = Latency()
+        return l
+
+    def jitter(self, device):
+        ''' get (or create) a device's report Jitter '''
+        j = self.jitters.get(device)
+        if j is None:
+            j = self.jitters[device] = Jitter()
+        return j
+
+    def device(self, device):
+        ''' get (or create) a device's DeviceMetrics '''
+        m = self.devices.get(device)
+        if m is None:
+            m = self.devices[device] = DeviceMetrics()
+        return m
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value, device=None):
+        ''' set a point-in-time value (optionally per device) '''
+        self.gauges[(name, device)] = value
+
+    def drop(self, device):
+        ''' forget a device's gauges '''
+        for key in [k for k in self.gauges if k[1] == device]:
+            del self.gauges[key]
+
+    def snapshot(self):
+        return {
+            'latencies': dict(self.latencies),
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'devices': dict(self.devices),
+        }
+
+    def sample(self, now=None):
+        ''' update device report rates (since the last sample) '''
+        now = time.monotonic() if now is None else now
+        for m in self.devices.values():
+            if m.sampled_on is not None and now > m.sampled_on:
+                m.rate = (m.reports - m.sampled) / (now - m.sampled_on)
+            m.sampled, m.sampled_on = m.reports, now
+
+    def render(self):
+        ''' everything, in the Prometheus text format '''
+        lines = []
+        def metric(name, kind, samples):
+            lines.append('# TYPE asopimx_%s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('asopimx_%s%s %s' % (name, labels, value))
+        def labels(**kw):
+            return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in kw.items() if v is not None) if kw else ''
+        def name(device):
+            return device.decode('utf8', 'replace') if isinstance(device, bytes) else device
+        devices = sorted(self.devices.items(), key=lambda i: str(i[0]))
+        for attr, kind, suffix in (('reports', 'counter', '_total'), ('rate', 'gauge', '_per_second'),
+            ('coalesced', 'counter', '_total'), ('dropped', 'counter', '_total'), ('connects', 'counter', '_total'),
+            ('memo_hits', 'counter', '_total'), ('memo_misses', 'counter', '_total')):
+            metric('device_%s%s' % (attr, suffix), kind,
+                [(labels(device=name(d)), getattr(m, attr)) for d, m in devices])
+        metric('device_reconnects_total', 'counter',
+            [(labels(device=name(d)), max(0, m.connects - 1)) for d, m in devices])
+        metric('device_memo_hit_ratio', 'gauge',
+            [(labels(device=name(d)), m.memo_hits / (m.memo_hits + m.memo_misses))
+                for d, m in devices if m.memo_hits + m.memo_misses])
+        for attr in ('transform', 'write'):
+            lines.append('# TYPE asopimx_%s_seconds histogram' % attr)
+            for d, m in devices:
+                h = getattr(m, attr)
+                total = 0
+                for bound, count in zip(h.bounds + ('+Inf',), h.counts):
+                    total += count
+                    lines.append('asopimx_%s_seconds_bucket%s %s' % (attr, labels(device=name(d), le=bound), total))
+                lines.append('asopimx_%s_seconds_sum%s %s' % (attr, labels(device=name(d)), h.total))
+                lines.append('asopimx_%s_seconds_count%s %s' % (attr, labels(device=name(d)), h.count))
+        metric('report_jitter_seconds', 'gauge',
+            [(labels(device=name(d)), j.jitter) for d, j in sorted(self.jitters.items(), key=lambda i: str(i[0]))])
+        for counter, value in sorted(self.counters.items()):
+            metric('%s_total' % counter, 'counter', [('', value)])
+        for lname, l in sorted(self.latencies.items()):
+            lines.append('# TYPE asopimx_%s_seconds summary' % lname)
+            lines.append('asopimx_%s_seconds_sum %s' % (lname, l.total))
+            lines.append('asopimx_%s_seconds_count %s' % (lname, l.count))
+            metric('%s_seconds_max' % lname, 'gauge', [('', l.max)])
+        gauges = {}
+        for (gname, device), value in self.gauges.items():
+            gauges.setdefault(gname, []).append((labels(device=name(device)) if device is not None else '', value))
+        for gname, samples in sorted(gauges.items()):
+            metric(gname, 'gauge', samples)
+        return '\n'.join(lines) + '\n'
+
+class Endpoint:
+    ''' serve metrics (from the reactor)
+    socket: UNIX socket path; each connection gets the current metrics (then it's closed)
+    textfile: rewritten every interval seconds (atomically)
+    '''
+    def __init__(self, reactor, socket=None, textfile=None, interval=10):
+        self.reactor = reactor
+        self.socket_path = socket
+        self.textfile = textfile
+        self.server = None
+        if socket is not None:
+            self.listen(socket)
+        from asopimx.governor import Governor # (it records metrics, too)
+        self.timer = Governor().manage(reactor.call_every(interval, self.tick))
+
+    def listen(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(4)
+        self.server.setblocking(False)
+        self.reactor.add_reader(self.server, self.accept)
+
+    def accept(self):
+        try:
+            conn, _ = self.server.accept()
+        except BlockingIOError:
+            return
+        with conn:
+            Metrics().sample()
+            conn.settimeout(.1) # (not worth stalling the loop for)
+            try:
+                conn.sendall(Metrics().render().encode())
+            except OSError as e:
+                _logger.debug('metrics client: %s', e)
+
+    def tick(self):
+        metrics = Metrics()
+        metrics.sample()
+        if self.textfile is None:
+            return
+        tmp = '%s.%s' % (self.textfile, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                f.write(metrics.render())
+            os.rename(tmp, self.textfile)
+        except OSError as e:
+            _logger.warning('unable to write %s: %s', self.textfile, e)
+
+    def close(self):
+        self.timer.cancel()
+        if self.server is not None:
+            self.reactor.remove_reader(self.server)
+            self.server.close()
+            self.server = None
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
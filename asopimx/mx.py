@@ -1,20 +1,33 @@
 #!/usr/bin/python3
 
-import hid # we assume this is just uses libusb; hidraw, even when installed, can't be specified
 from traceback import format_exc
 import time
+import re
 import logging
 
 _logger = logging.getLogger(__file__ if __name__ == '__main__' else __name__)
 
+from asopimx.tools import hidraw as hid # (cython-hidapi compatible)
 from asopimx.tools.btctl import Btctl
+from asopimx.tools.l2ping import LinkMonitor
+from asopimx.coex import Coexistence
+from asopimx.metrics import Endpoint
+from asopimx.profiles import FFSProfile, Composite
 # enumerate supported devices & profiles
 # TODO: automate this
-from asopimx.devices import Device
+from asopimx.devices import Device, listen
+from asopimx import export
+from asopimx import trace
+from asopimx import timeline
+from asopimx.scheduler import Scheduler
+from asopimx.realtime import Realtime
+from asopimx.governor import Governor
+from asopimx.memo import Memo
 from asopimx.devices.mnsd import MNSDProfile, MNSDPC
 from asopimx.devices.ps3 import PS3Profile, PS3Pad
 from asopimx.devices.swpro import SWPROProfile, SWPROPC
 from asopimx.devices.swjc import SWJCPProfile, SWJCPPC, JCL, JCR
+from asopimx.devices.x360 import X360Profile
 devices = [
     MNSDPC, SWPROPC, PS3Pad,
 ]
@@ -22,7 +35,7 @@ composite_devices = [
     (SWJCPPC, [JCL, JCR])
 ]
 profiles = [
-    MNSDProfile, SWPROProfile, PS3Profile, # SWJCPProfile,
+    MNSDProfile, SWPROProfile, PS3Profile, X360Profile, # SWJCPProfile,
 ]
 prof_code_map = dict([(p.code, p) for p in profiles])
 
@@ -43,6 +56,29 @@ class AsopiMX():
                 for p in cls.products:
                     self.cpmap[p] = cls
         self.dnames = {d.product for d in devices}
+        self.links = None # bt link monitor
+        self.skip_wifi = False
+        self.coex_opts = {} # None: always disable wifi when a device is found
+        self.coex = None # wifi/bt coexistence policy
+        self.profiles = [] # one per (virtual) controller
+        self.shard = False # a process per device (SEE: shards)
+        self.export = None # live state export
+        self.metrics_opts = {} # (SEE: metrics.Endpoint)
+        self.endpoint = None
+        self.trace = None # where to dump the trace (SEE: trace)
+        self.realtime = None # (SEE: realtime.Realtime)
+        self.governor_opts = None # (SEE: governor.Governor.start)
+        self.memo = 0 # memoized reports per device (SEE: memo)
+
+    bt_address = re.compile('^([0-9a-f]{2}:){5}[0-9a-f]{2}$', re.IGNORECASE)
+
+    def watch_link(self, d):
+        ''' monitor a device's bluetooth link latency (if it's connected via bluetooth) '''
+        if self.links is None:
+            return
+        addr = getattr(getattr(d, 'dev', None), 'address', None) or getattr(d, 'serial_number', None)
+        if isinstance(addr, str) and self.bt_address.match(addr):
+            self.links.add(addr)
 
     def find_bt_devices(self, pair=True):
         # TODO: mesh these with hid devices somehow
@@ -117,6 +153,7 @@ class AsopiMX():
                 Dcls = self.cpmap.get(key, self.pmap.get(key))
                 newd = Dcls(d) # , self.loop)
                 new.append(newd)
+                self.watch_link(d)
                 return
 
 
@@ -163,7 +200,8 @@ class AsopiMX():
                 if claimed:
                     continue
                 _logger.info('%s Found! (%s / %s)' % (d.product_string, d.serial_number, d.path))
-                self.disable_wifi() # no wifi, please
+                if self.coex is None and self.coex_opts is None:
+                    self.disable_wifi() # no wifi, please
                 dev = hid.device()
                 dev.open_path(d.path)
                 d.dev = dev
@@ -171,6 +209,7 @@ class AsopiMX():
                 Dcls = self.cpmap.get(key, self.pmap.get(key))
                 newd = Dcls(d) # , self.loop)
                 new.append(newd)
+                self.watch_link(d)
 
 
         if pair and new and (len(self.found) > 1 or len(new) > 1):
@@ -199,6 +238,17 @@ class AsopiMX():
 
         self.found.extend(new)
 
+    def instrument(self):
+        ''' pipeline stages, the scheduler & discovery, as timeline slices '''
+        gamepads = devices + [c for c, cs in composite_devices] + [c for _, cs in composite_devices for c in cs]
+        for cls in gamepads:
+            timeline.instrument(cls, 'recv_device', 'read', 'unpack', 'transform_cc')
+        for profile in self.profiles:
+            timeline.instrument(type(profile), 'transform_local', 'repack', 'send_event')
+        timeline.instrument(Scheduler, 'run')
+        timeline.instrument(AsopiMX, 'find_hid_devices', 'find_bt_devices')
+        timeline.instrument(Btctl, 'get_devices', 'connect', 'start_scan', 'stop_scan')
+
     def disable_wifi(self):
         if not self.skip_wifi and not self.wl_blocked: # wifi was initially on
             _logger.info('Disabling WIFI')
@@ -211,23 +261,39 @@ class AsopiMX():
 
 
     def run(self):
-        from asopimx.tools.rfkill import wlan
+        from asopimx.tools.rfkill import wlan, Monitor
         from asopimx.ui.af12x64oled import AsopiUI as UI
-        from asopimx.scheduler import Scheduler
+        from asopimx.reactor import Reactor
+        self.reactor = Reactor()
+        Monitor().attach(self.reactor) # radio state is kept up to date from rfkill events
+        self.links = LinkMonitor(self.reactor)
+        if self.metrics_opts:
+            self.endpoint = Endpoint(self.reactor, **self.metrics_opts)
+        if self.governor_opts is not None:
+            Governor().start(self.reactor, **self.governor_opts)
+            for profile in self.profiles:
+                profile.governor = Governor()
         self.wl0 = wlan.first()
         self.wl_blocked = self.wl0.softblock # initial state
-        self.scheduler = Scheduler()
+        if not self.skip_wifi and not self.wl_blocked and self.coex_opts is not None:
+            self.coex = Coexistence(self.reactor, self.wl0, **self.coex_opts)
         self.btctl = Btctl()
         try:
             self.ui = UI()
+            timeline.instrument(UI, 'display_status', 'update_wifi')
             self.ui.start()
         except Exception as e:
             _logger.warning('Unable to start ui; ignoring. (%s)', e)
             self.ui = None
+        started = None
+        if self.realtime is not None:
+            # (measured & applied once devices are being served)
+            self.realtime = Realtime(self.reactor, **self.realtime)
+            started = self.realtime.start
         scanning = False
         while True:
             try:
-                self.scheduler.run()
+                self.reactor.run_once()
                 if not scanning:
                     self.btctl.start_scan()
                     scanning = True
@@ -235,17 +301,24 @@ class AsopiMX():
                     self.find_hid_devices()
                     if not self.found:
                         self.find_bt_devices()
-                    time.sleep(1)
+                    self.reactor.run_once(Governor().stretch(1)) # timers (ui) keep running while we wait
                 if self.found:
                     self.btctl.stop_scan()
                     scanning = False
                 if not self.wl_blocked and not self.found:
                     self.enable_wifi() # re-enable wifi
-                if len(self.found) > 1:
-                    _logger.warning('Multiple devices found; only one device at at time is supported.')
-                con = self.found[0]
-                con.assign_profile(self.profile)
-                con.listen()
+                if len(self.found) > len(self.profiles):
+                    _logger.warning('%s devices found; only %s profile(s) registered.', len(self.found), len(self.profiles))
+                cons = self.found[:len(self.profiles)]
+                if self.shard:
+                    from asopimx import shards
+                    shards.serve(cons, self.profiles, started)
+                else:
+                    for con, profile in zip(cons, self.profiles):
+                        con.assign_profile(profile)
+                        if self.memo:
+                            con.memo = Memo(self.memo, con.volatile)
+                    listen(cons, started)
             except AttributeError as e:
                 _logger.warning(format_exc())
             except OSError as e:
@@ -253,13 +326,23 @@ class AsopiMX():
                 _logger.warning(e)
             except SystemExit as e:
                 if not self.ui is None:
+                    self.ui.stop()
                     self.ui.clear()
+                if self.coex is not None:
+                    self.coex.stop()
+                if self.realtime is not None:
+                    self.realtime.stop()
                 raise
             finally:
-                if not self.wl_blocked:
+                if self.realtime is not None:
+                    self.realtime.interrupt()
+                if self.coex is not None:
+                    self.coex.reset() # restore wifi between sessions
+                elif not self.wl_blocked:
                     self.enable_wifi()
 
             self.found = [] # go back to finding devices
+            self.links.clear()
             time.sleep(1)
             # TODO: add support for stream tests
             #import hids
@@ -294,10 +377,89 @@ class AsopiMX():
         )
         parser.add_argument('-t', '--test', default=False, action='store_true')
         parser.add_argument('-c', '--clean', default=False, action='store_true')
-        parser.add_argument('-w', '--wifi', default=False, action='store_true')
+        parser.add_argument(
+            '-w', '--wifi', default=False, action='store_true',
+            help='Keep wifi up, regardless of controller link quality'
+        )
+        parser.add_argument(
+            '-W', '--no-wifi', default=False, action='store_true',
+            help='Disable wifi whenever a device is connected'
+        )
+        parser.add_argument(
+            '--coex-jitter', default=4, type=float, metavar='MS',
+            help='Disable wifi while controller report jitter exceeds this (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--coex-rtt', default=40, type=float, metavar='MS',
+            help='Disable wifi while bluetooth round-trip time (p95) exceeds this (default: %(default)s)'
+        )
         parser.add_argument(
             '-p', '--profile', default='swpro',
-            help='Capability profile to register'
+            help='Capability profile to register (comma-separated for several controllers in one gadget; ex. swpro,swpro)'
+        )
+        parser.add_argument(
+            '--poll-ms', default=None, type=float, metavar='MS',
+            help='Serve the (HID) profile through FunctionFS, polled every MS (ex. 1 for 1000Hz; default: f_hid)'
+        )
+        parser.add_argument(
+            '--shard', default=False, action='store_true',
+            help='Read each device in its own process (for multi-core boards)'
+        )
+        parser.add_argument(
+            '--export', nargs='?', default=None, const=export.path, metavar='PATH',
+            help='Export live controller state to a memory-mapped file (default: %s; SEE: export.Reader)' % export.path
+        )
+        parser.add_argument(
+            '--metrics-socket', default=None, metavar='PATH',
+            help='Serve metrics (Prometheus text format) on a UNIX socket (ex. /run/asopimx.sock)'
+        )
+        parser.add_argument(
+            '--metrics-textfile', default=None, metavar='PATH',
+            help='Periodically write metrics to a (node_exporter textfile collector) file (ex. /var/lib/node_exporter/asopimx.prom)'
+        )
+        parser.add_argument(
+            '--metrics-interval', default=10, type=float, metavar='S',
+            help='How often to update metrics rates & the textfile (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--trace', default=None, metavar='PATH',
+            help='Trace reports (into a ring buffer) and dump them to PATH on exit (render with: python -m asopimx.trace PATH)'
+        )
+        parser.add_argument(
+            '--trace-size', default=4096, type=int, metavar='N',
+            help='Trace records kept (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--timeline', default=None, metavar='PATH',
+            help='Record pipeline stage timings; dumped to PATH (Chrome Trace Event JSON, for Perfetto) on SIGUSR2 & exit'
+        )
+        parser.add_argument(
+            '--timeline-size', default=65536, type=int, metavar='N',
+            help='Timeline slices kept (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--realtime', default=False, action='store_true',
+            help='SCHED_FIFO & a core of its own for the I/O loop, locked memory & GC only while idle (reports jitter before & after)'
+        )
+        parser.add_argument(
+            '--realtime-priority', default=50, type=int, metavar='N',
+            help='SCHED_FIFO priority (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--realtime-cpu', default=None, type=int, metavar='CPU',
+            help='Core for the I/O loop (default: the last)'
+        )
+        parser.add_argument(
+            '--idle-ms', default=None, type=float, metavar='MS',
+            help='Back off periodic work (link pings, coexistence checks, ...) once input state has been still this long'
+        )
+        parser.add_argument(
+            '--cpu-budget', default=None, type=float, metavar='FRACTION',
+            help='Slow periodic work down while we use more than this much of a core (ex. .25)'
+        )
+        parser.add_argument(
+            '--memo', default=0, type=int, metavar='N',
+            help='Remember the host reports made from up to N distinct device reports, and resend them on repeats (ex. 256)'
         )
         parser.add_argument(
             '-s', '--supported', default=False, action='store_true',
@@ -313,16 +475,56 @@ class AsopiMX():
            args.test = args.register = args.clean = True
 
         try:
-            self.profile = prof_code_map.get(args.profile)(path='/dev/hidg0')
+            for code in args.profile.split(','):
+                profile = prof_code_map[code]
+                if args.poll_ms is not None:
+                    if issubclass(profile, FFSProfile):
+                        profile = type(profile.__name__, (profile,), {'poll_ms': args.poll_ms})
+                    else:
+                        profile = profile.over_ffs(args.poll_ms)
+                self.profiles.append(profile(path='/dev/hidg%s' % len(self.profiles)))
+            self.gadget = self.profiles[0] if len(self.profiles) == 1 else Composite(self.profiles)
         except Exception as e:
             print(
                 'Unable to load requested profile (%s): %s' % (args.profile, e)
             )
 
         self.skip_wifi = args.wifi
+        if args.shard:
+            try:
+                from asopimx import shards
+                self.shard = True
+            except ImportError as e: # (shared_memory: python 3.8+)
+                _logger.warning('unable to shard (%s); serving every device from one process', e)
+        self.memo = args.memo
+        if args.idle_ms is not None or args.cpu_budget is not None:
+            self.governor_opts = dict(
+                idle=(args.idle_ms if args.idle_ms is not None else 500) / 1000, budget=args.cpu_budget
+            )
+        if args.realtime:
+            self.realtime = dict(priority=args.realtime_priority, cpu=args.realtime_cpu)
+        if args.timeline:
+            timeline.enable(args.timeline, args.timeline_size)
+            self.instrument()
+        if args.trace:
+            self.trace = args.trace
+            trace.enable(args.trace_size)
+        if args.metrics_socket or args.metrics_textfile:
+            self.metrics_opts = dict(
+                socket=args.metrics_socket, textfile=args.metrics_textfile, interval=args.metrics_interval
+            )
+        if args.export:
+            self.export = export.Export(args.export, max(1, len(self.profiles)))
+            for profile in self.profiles:
+                self.export.attach(profile.index, profile.code)
+                profile.export = self.export
+        if args.no_wifi:
+            self.coex_opts = None
+        else:
+            self.coex_opts = dict(jitter=args.coex_jitter / 1000, rtt=args.coex_rtt / 1000)
         try:
             if args.register:
-                self.profile.register()
+                self.gadget.register()
             if args.test:
                 self.run()
         except SystemExit as e:
@@ -335,9 +537,15 @@ class AsopiMX():
         finally:
             if args.clean:
                 try:
-                    self.profile.clean()
+                    self.gadget.clean()
                 except (FileNotFoundError, PermissionError) as e:
                     _logger.error(e)
+            if self.export is not None:
+                self.export.close()
+            if self.endpoint is not None:
+                self.endpoint.close()
+            if self.trace is not None:
+                trace.dump(self.trace)
 
 
 if __name__ == '__main__':
@@ -14,8 +14,13 @@ import shutil
 from struct import *
 from collections import namedtuple
 import base64
+import time
 import logging
 from asopimx.tools import *
+from asopimx.tools import fnfs
+from asopimx.reactor import Reactor
+from asopimx.metrics import Metrics
+from asopimx import trace
 
 _logger = logging.getLogger(__file__ if __file__ != '__main__' else 'ps3.py')
 logging.basicConfig()
@@ -37,7 +42,8 @@ class Profile:
     # hid data
     protocol = '0' # bInterfaceProtocol
     subclass = '0' # bInterfaceSubClass
-    report_length = '148' # wDescriptorLength (NOTE: this should mach lenth of resport_desc below)
+    report_length = '64' # longest report, in bytes (SEE: tools.hiddesc.report_length)
+    output_length = 64 # largest output report (host -> device) we expect
     
     base_dir = '/sys/kernel/config/usb_gadget'
     mx_dir = path.join(base_dir, 'piconmx')
@@ -45,9 +51,17 @@ class Profile:
     config_str_dir = path.join(config_dir, 'strings/0x409')
 
     report_desc = []
+    index = 0 # function instance (SEE: Composite)
+    export = None # live state export (SEE: export.Export)
+    governor = None # told about input state changes (SEE: governor.Governor)
+    last_input = None
+    sent = None # last report sent (or that would've been; SEE: Gamepad.recall)
 
     def __init__(self, path=None):
         self.fd = None
+        self.hostfd = None # output reports (host -> device)
+        self.device = None
+        self.feedback = None # pending (feedback, received on)
         if path is None:
             # attempt to register
             pass
@@ -56,10 +70,26 @@ class Profile:
             self.path = path
         self.warned = 0
 
+    @property
+    def instance(self):
+        return 'hid.usb%d' % self.index
+
+    def release(self):
+        ''' let go of our function's files (before it's removed) '''
+        if self.hostfd is not None:
+            Reactor().remove_reader(self.hostfd)
+            os.close(self.hostfd)
+            self.hostfd = None
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
     def clean(self):
         # TODO: make this more pythonic
         # disable gadget
         write('', path.join(self.mx_dir, 'UDC'))
+        self.release()
+        os.system('rm -f %s/os_desc/c.1' % self.mx_dir)
         os.system('rm %s/configs/*.*/*' % self.mx_dir)
         # remove configuration string directories
         os.system('rmdir %s/configs/*/strings/*' % self.mx_dir)
@@ -73,6 +103,12 @@ class Profile:
         os.system('rmdir ' + self.mx_dir)
     
     def register(self):
+        self.register_gadget()
+        self.register_function()
+        self.bind()
+
+    def register_gadget(self):
+        ''' (re)create the gadget & its configuration '''
         if os.path.isdir(self.mx_dir):
             self.clean()
         _logger.info(self.mx_dir)
@@ -89,25 +125,103 @@ class Profile:
         makedirs(self.config_str_dir)
         write(self.configuration, path.join(self.config_str_dir, 'configuration'))
         write(self.max_power, path.join(self.config_dir, 'MaxPower'))
+
+    def register_function(self):
+        ''' create (& link) our function '''
         # hid stuff
-        hid_dir = path.join(self.mx_dir, 'functions/hid.usb0')
+        hid_dir = path.join(self.mx_dir, 'functions', self.instance)
         makedirs(hid_dir)
         write(self.protocol, path.join(hid_dir, 'protocol'))
         write(self.subclass, path.join(hid_dir, 'subclass'))
         write(self.report_length, path.join(hid_dir, 'report_length'))
         write(bytearray(self.report_desc), path.join(hid_dir, 'report_desc'))
-        os.symlink(hid_dir, path.join(self.config_dir, 'functions'))
+        os.symlink(hid_dir, path.join(self.config_dir, self.instance))
+
+    def bind(self):
+        ''' attach the gadget to the (first) udc '''
         write(check_output(['ls','/sys/class/udc']), path.join(self.mx_dir, 'UDC'))
-        # TODO: figure out which device we are (path to send/receive data)
-        # for now, assume we're the only one (/dev/hidg0)
-        self.path = '/dev/hidg0'
+        self.path = self.node()
+
+    def node(self):
+        ''' our function's device (/dev/hidgN), by its major:minor '''
+        with open(path.join(self.mx_dir, 'functions', self.instance, 'dev')) as f:
+            dev = f.read().strip()
+        try:
+            with open(path.join('/sys/dev/char', dev, 'uevent')) as f:
+                for line in f:
+                    if line.startswith('DEVNAME='):
+                        return path.join('/dev', line.strip().split('=', 1)[1])
+        except FileNotFoundError: # not bound (yet)
+            pass
+        return '/dev/hidg%s' % dev.split(':')[1]
 
     def repack(self): # should be overidden to return profile's HID report ready to send
         return ''
 
+    @classmethod
+    def over_ffs(cls, poll_ms=1):
+        ''' this profile, served through FunctionFS (polled every poll_ms; SEE: HIDFunctionProfile) '''
+        return type(cls.__name__ + 'FFS', (HIDFunctionProfile, cls), {'poll_ms': poll_ms})
+
+    def transform_host(self, data):
+        ''' build capabilities class feedback from a host output report
+        should be overridden; None = nothing to forward
+        '''
+        return None
+
+    def assign_device(self, device):
+        ''' assign a device to forward host feedback to '''
+        self.device = device
+
+    def open(self):
+        ''' open our gadget device (if it's there yet) '''
+        if not path.exists(self.path):
+            return False
+        self.fd = open(self.path, 'wb')
+        # separate non-blocking fd for output reports,
+        # so reading them never changes how we write
+        self.hostfd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        Reactor().add_reader(self.hostfd, self.recv_host)
+        return True
+
+    def recv_host(self):
+        ''' read pending output reports from the host '''
+        while True:
+            try:
+                data = os.read(self.hostfd, self.output_length)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            self.host_report(data)
+
+    def host_report(self, data):
+        ''' handle an output report from the host '''
+        if trace.enabled:
+            trace.record(trace.FEEDBACK, self.instance, data)
+        feedback = self.transform_host(data)
+        if feedback is None:
+            return
+        if self.feedback is None: # not yet scheduled
+            Reactor().call_soon(self.send_device)
+        # only the latest feedback matters
+        self.feedback = (feedback, time.monotonic())
+
+    def send_device(self):
+        ''' forward pending host feedback to the phys device '''
+        if self.feedback is None:
+            return
+        feedback, received_on = self.feedback
+        self.feedback = None
+        if self.device is None:
+            return
+        self.device.recv_host(feedback)
+        Metrics().latency('host_device').record(time.monotonic() - received_on)
+
     def recv_dev(self, state):
         ''' receive state from device '''
         #TODO: translate supported capability class state to profile
+        self.received(state)
         if self.raw: # raw state; same device pass-through
             self.state = state
         else:
@@ -115,15 +229,32 @@ class Profile:
             self.state = self.transform_local(self.cstate)
         self.send_event()
 
-    def send_event(self):
-        ''' repack state and send to host '''
-        s = self.repack()
+    def recv_memo(self, cstate, state, packed):
+        ''' receive state from device, already transformed & packed (SEE: memo) '''
+        self.received(cstate)
+        self.cstate = cstate
+        self.state = state
+        self.send_event(packed)
+
+    def received(self, state):
+        ''' let whoever's watching know about a device state '''
+        if self.governor is not None and state != self.last_input:
+            self.last_input = state
+            self.governor.input()
+        if self.export is not None and not self.raw:
+            self.export.publish(self.index, state)
+
+    def send_event(self, packed=None):
+        ''' repack state (unless it's been packed already) and send to host '''
+        s = self.repack() if packed is None else packed
+        self.sent = s
         #with open(self.path, 'wb') as f:
         #    f.write(s)
         if self.fd is None:
             # wait until device's created
             # (won't work if we create the file ourselves)
             if not path.exists(self.path):
+                self.dropped()
                 return # this was slowing things down?
                 if self.warned % 10000 == 0:
                     _logger.warning('%s not ready; discarding event', self.path)
@@ -132,11 +263,259 @@ class Profile:
                 self.warned += 1
                 return
             else:
-                self.fd = open(self.path, 'wb')
+                self.open()
 
+        if trace.enabled:
+            trace.record(trace.SEND, self.instance, s)
+        start = time.monotonic()
         self.fd.write(s)
         self.fd.flush()
         #os.fsync(self.fd)
+        self.wrote(time.monotonic() - start)
+
+    def wrote(self, elapsed):
+        ''' record a write to the host (against our device's metrics) '''
+        metrics = getattr(self.device, 'metrics', None)
+        if metrics is not None:
+            metrics.wrote(elapsed)
+
+    def dropped(self):
+        ''' record a report we couldn't send '''
+        metrics = getattr(self.device, 'metrics', None)
+        if metrics is not None:
+            metrics.dropped += 1
+
+
+class ProfileFunction(fnfs.FnFS):
+    ''' a profile's FunctionFS function; control requests go to the profile '''
+    def __init__(self, profile, *args, **kwargs):
+        self.profile = profile
+        super(ProfileFunction, self).__init__(*args, **kwargs)
+
+    def setup(self, request):
+        self.profile.control(self, request)
+
+    def enable(self):
+        super(ProfileFunction, self).enable()
+        _logger.info('%s: enabled', self.profile.code)
+
+class FFSProfile(Profile):
+    ''' a profile served through FunctionFS (instead of f_hid)
+    for vendor class devices (ex. xinput), and to pick our own endpoints (and polling interval)
+    inheritors supply interfaces() (and handle control requests)
+    '''
+    ffs_dir = '/dev/ffs' # functionfs mounts (one per function)
+    device_class = None # (bDeviceClass, bDeviceSubClass, bDeviceProtocol); None = per interface
+    os_vendor_code = None # MS OS descriptors' vendor request (ex. '0x90'); None = none
+    poll_ms = 1 # interrupt endpoints' polling interval (bInterval; SEE: tools.fnfs.interval)
+    in_ep = 1 # endpoint (ep<n>) reports are written to
+    out_ep = None # endpoint output reports (host -> device) arrive on
+
+    def __init__(self, path=None):
+        super(FFSProfile, self).__init__(path)
+        self.function = None
+        self.writer = None
+
+    @property
+    def ffs_name(self):
+        ''' functionfs instance name (& mount) '''
+        return self.code if not self.index else '%s%d' % (self.code, self.index)
+
+    @property
+    def instance(self):
+        return 'ffs.%s' % self.ffs_name
+
+    @property
+    def mount_dir(self):
+        return path.join(self.ffs_dir, self.ffs_name)
+
+    def interfaces(self, speed):
+        ''' fnfs.Interfaces for speed ('fs' or 'hs'); should be overridden '''
+        return []
+
+    def os_descs(self):
+        ''' MS OS descriptors (SEE: tools.fnfs.os_compat) '''
+        return []
+
+    def control(self, function, request):
+        ''' handle a control request (the function's ep0); should be overridden '''
+        function.stall(request)
+
+    def register_gadget(self):
+        super(FFSProfile, self).register_gadget()
+        if self.device_class is not None:
+            for name, value in zip(('bDeviceClass', 'bDeviceSubClass', 'bDeviceProtocol'), self.device_class):
+                write(value, path.join(self.mx_dir, name))
+        if self.os_vendor_code is not None:
+            os_dir = path.join(self.mx_dir, 'os_desc')
+            write('1', path.join(os_dir, 'use'))
+            write(self.os_vendor_code, path.join(os_dir, 'b_vendor_code'))
+            write('MSFT100', path.join(os_dir, 'qw_sign'))
+            os.symlink(self.config_dir.rstrip('/'), path.join(os_dir, 'c.1'))
+
+    def register_function(self):
+        fn_dir = path.join(self.mx_dir, 'functions', self.instance)
+        makedirs(fn_dir)
+        os.symlink(fn_dir, path.join(self.config_dir, self.instance))
+        makedirs(self.mount_dir, exist_ok=True)
+        check_output(['mount', '-t', 'functionfs', self.ffs_name, self.mount_dir])
+        # descriptors have to be written before binding
+        self.function = ProfileFunction(self, self.mount_dir,
+            self.interfaces('fs'), self.interfaces('hs'),
+            os_descs=self.os_descs(), key=self.code)
+        self.path = self.mount_dir
+        self.open()
+
+    def bind(self):
+        write(check_output(['ls','/sys/class/udc']), path.join(self.mx_dir, 'UDC'))
+
+    def node(self):
+        return self.mount_dir
+
+    def open(self):
+        if self.function is None:
+            return False
+        self.writer = self.function.writer(self.in_ep, int(self.report_length))
+        if self.out_ep is not None:
+            if self.function.aio is None:
+                # (endpoint files can't be polled; HID output still comes in as SET_REPORT on ep0)
+                _logger.warning('%s: no AIO; ignoring output reports on ep%s', self.instance, self.out_ep)
+            else:
+                self.function.reader(self.out_ep, self.output_length, self.recv_output)
+        return True
+
+    def recv_output(self, data):
+        self.host_report(bytes(data))
+
+    def send_event(self, packed=None):
+        ''' repack state (unless it's been packed already) and send to host '''
+        if self.writer is None or not self.function.enabled:
+            self.dropped()
+            return
+        s = self.repack() if packed is None else packed
+        self.sent = s
+        if trace.enabled:
+            trace.record(trace.SEND, self.instance, s)
+        start = time.monotonic()
+        self.writer.write(s)
+        self.wrote(time.monotonic() - start)
+
+    def release(self):
+        if self.function is not None:
+            self.function.close()
+            self.function = None
+            self.writer = None
+        if path.ismount(self.mount_dir):
+            os.system('umount %s' % self.mount_dir)
+        super(FFSProfile, self).release()
+
+    def clean(self):
+        if path.exists(path.join(self.mx_dir, 'UDC')):
+            write('', path.join(self.mx_dir, 'UDC'))
+        self.release() # (functionfs has to be unmounted before its function's removed)
+        super(FFSProfile, self).clean()
+
+
+class HIDFunctionProfile(FFSProfile):
+    ''' a HID profile served through FunctionFS rather than f_hid
+    same report descriptor & repack, but we pick the endpoints' polling interval
+    (SEE: Profile.over_ffs)
+    '''
+    in_ep = 1
+    out_ep = 2
+    hid_bcd = 0x0111 # 1.11
+
+    def hid_descriptor(self):
+        return fnfs.HID.Descriptor(
+            bLength=fnfs.HID.descriptor_size,
+            bDescriptorType=fnfs.HID.Type.hid,
+            bcdHID=self.hid_bcd,
+            bNumDescriptors=1,
+            bClassDescriptorType=fnfs.HID.Type.report,
+            wDescriptorLength=len(self.report_desc),
+        )
+
+    def interfaces(self, speed):
+        iface = fnfs.Descriptor.Interface(
+            bLength=fnfs.Descriptor.interface_size,
+            bDescriptorType=fnfs.Descriptor.Type.interface,
+            bInterfaceNumber=0,
+            bNumEndpoints=2,
+            bInterfaceClass=fnfs.Descriptor.Class.hid,
+            bInterfaceSubClass=int(self.subclass),
+            bInterfaceProtocol=int(self.protocol),
+        )
+        eps = [
+            fnfs.Descriptor.Endpoint(
+                bLength=fnfs.Descriptor.endpoint_size,
+                bDescriptorType=fnfs.Descriptor.Type.endpoint,
+                bEndpointAddress=n | direction,
+                bmAttributes=fnfs.USB.Endpoint.Xfer.int,
+                wMaxPacketSize=size,
+                bInterval=fnfs.interval(self.poll_ms, speed),
+            ) for n, direction, size in (
+                (self.in_ep, fnfs.USB.Dir.IN, int(self.report_length)),
+                (self.out_ep, fnfs.USB.Dir.OUT, min(self.output_length, 64)),
+            )
+        ]
+        return [fnfs.Interface(iface, eps, [self.hid_descriptor()])]
+
+    def control(self, function, request):
+        ''' descriptor & hid class requests (f_hid would otherwise answer these) '''
+        rtype = request.bRequestType
+        req = request.bRequest
+        if rtype == 0x81 and req == fnfs.USB.Request.get_descriptor: # standard, interface
+            dtype = request.wValue >> 8
+            if dtype == fnfs.HID.Type.report:
+                return function.reply(request, bytes(self.report_desc))
+            if dtype == fnfs.HID.Type.hid:
+                return function.reply(request, bytes(self.hid_descriptor()))
+        elif rtype == 0xA1: # class, interface, in
+            if req == fnfs.HID.Request.get_report:
+                return function.reply(request, self.repack())
+            if req == fnfs.HID.Request.get_idle:
+                return function.reply(request, b'\x00')
+            if req == fnfs.HID.Request.get_protocol:
+                return function.reply(request, b'\x01') # report
+        elif rtype == 0x21: # class, interface, out
+            if req == fnfs.HID.Request.set_report:
+                data = function.receive(request)
+                if data:
+                    self.host_report(data)
+                return
+            if req in (fnfs.HID.Request.set_idle, fnfs.HID.Request.set_protocol):
+                function.receive(request) # ack
+                return
+        function.stall(request)
+
+
+class Composite:
+    ''' several profiles in one gadget, each its own function (& device, & writer)
+    (ex. four controllers for local multiplayer)
+    the gadget itself (ids, strings) is the first profile's
+    '''
+    def __init__(self, profiles):
+        self.profiles = profiles
+        for i, profile in enumerate(profiles):
+            profile.index = i
+
+    def register(self):
+        first = self.profiles[0]
+        first.register_gadget()
+        for profile in self.profiles:
+            profile.register_function()
+        first.bind()
+        for profile in self.profiles[1:]:
+            profile.path = profile.node()
+        _logger.info('functions: %s', ', '.join(p.path for p in self.profiles))
+
+    def clean(self):
+        udc = path.join(Profile.mx_dir, 'UDC')
+        if path.exists(udc):
+            write('', udc)
+        for profile in self.profiles:
+            profile.release()
+        self.profiles[0].clean()
 
 
 if __name__ == '__main__':
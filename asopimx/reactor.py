@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+''' minimal poll-based event loop
+NOTE: asyncio (and its ilk) add startup latency and per-callback overhead
+    we can't afford on a Pi Zero; this only does what we need:
+    fd readiness callbacks, deferred calls and timers (SEE: scheduler)
+'''
+
+import os
+import select
+import math
+import time
+from collections import deque
+import logging
+from traceback import format_exc
+
+from asopimx.tools import Singleton
+from asopimx.scheduler import Scheduler
+
+_logger = logging.getLogger(__name__)
+
+def fileno(fd):
+    return fd if isinstance(fd, int) else fd.fileno()
+
+class Reactor(metaclass=Singleton):
+    def __init__(self):
+        self.poller = select.poll()
+        self.readers = {} # fd: (callback, args)
+        self.ready = deque() # deferred calls (appended from any thread; SEE: call_soon_threadsafe)
+        self.scheduler = Scheduler()
+        self.wakeup = None # self-pipe (SEE: call_soon_threadsafe)
+        self.idle = [] # called after a poll that waited, and nothing came (SEE: realtime.Collector)
+
+    def add_reader(self, fd, callback, *args):
+        ''' call callback(*args) whenever fd is readable '''
+        fd = fileno(fd)
+        if fd in self.readers:
+            self.poller.modify(fd, select.POLLIN)
+        else:
+            self.poller.register(fd, select.POLLIN)
+        self.readers[fd] = (callback, args)
+
+    def remove_reader(self, fd):
+        fd = fileno(fd)
+        if self.readers.pop(fd, None) is not None:
+            self.poller.unregister(fd)
+
+    def call_soon(self, callback, *args):
+        ''' call callback(*args) once the current batch of readers has been handled '''
+        self.ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        ''' call_soon from another thread (wakes up a blocking poll) '''
+        if self.wakeup is None:
+            raise RuntimeError('call_soon_threadsafe requires enable_wakeup() first')
+        self.ready.append((callback, args)) # (deque appends & pops are atomic)
+        try:
+            os.write(self.wakeup[1], b'\0')
+        except BlockingIOError:
+            pass # already pending
+
+    def enable_wakeup(self):
+        ''' create the self-pipe used by call_soon_threadsafe (from the loop's thread) '''
+        if self.wakeup is None:
+            self.wakeup = os.pipe()
+            for fd in self.wakeup:
+                os.set_blocking(fd, False)
+            self.add_reader(self.wakeup[0], self.drain_wakeup)
+
+    def drain_wakeup(self):
+        try:
+            while os.read(self.wakeup[0], 64):
+                pass
+        except BlockingIOError:
+            pass
+
+    def call_later(self, delay, callback, *args):
+        return self.scheduler.call_later(delay, callback, *args)
+
+    def call_every(self, interval, callback, *args, **kwargs):
+        return self.scheduler.call_every(interval, callback, *args, **kwargs)
+
+    def run_once(self, timeout=0):
+        ''' poll once (timeout in seconds; None blocks) and dispatch whatever's ready
+        the poll never outlasts the next timer deadline
+        '''
+        if self.ready:
+            timeout = 0
+        else:
+            deadline = self.scheduler.timeout()
+            if deadline is not None and (timeout is None or deadline < timeout):
+                timeout = deadline
+        if self.readers:
+            # round up; a 0ms poll just before a deadline would spin
+            events = self.poller.poll(None if timeout is None else math.ceil(timeout * 1000))
+        else:
+            events = []
+            if timeout: # nothing to poll; just wait for the next timer
+                time.sleep(timeout)
+        for fd, event in events:
+            reader = self.readers.get(fd)
+            if reader is None:
+                continue
+            callback, args = reader
+            if event & (select.POLLERR | select.POLLNVAL):
+                _logger.warning('fd %s: poll error (%s); dropping reader', fd, event)
+                self.remove_reader(fd)
+            try:
+                callback(*args)
+            except Exception:
+                _logger.warning(format_exc())
+        # only what's queued so far; calls queued from here on wait for the next batch
+        for _ in range(len(self.ready)):
+            callback, args = self.ready.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                _logger.warning(format_exc())
+        self.scheduler.run()
+        if not events and timeout and self.idle:
+            for callback in self.idle:
+                callback()
+        return len(events)
+
+    def run(self):
+        while self.readers or self.ready or self.scheduler.timers:
+            self.run_once(None)
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+''' real-time runtime mode
+The reactor (I/O) thread goes SCHED_FIFO on a core of its own (everything else is moved off it),
+memory's locked (no page faults mid-report), and the cyclic GC only runs while input's idle.
+Worst-case loop jitter (timer lateness) is measured before & after, so you can see what it bought
+(only while devices are being served; SEE: start, interrupt).
+Needs root (or CAP_SYS_NICE & CAP_IPC_LOCK); whatever isn't permitted is skipped (with a warning).
+'''
+
+import os
+import gc
+import time
+import ctypes
+import ctypes.util
+import threading
+import multiprocessing
+import logging
+
+from asopimx.metrics import Metrics
+
+_logger = logging.getLogger(__name__)
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+spare = None # the cores left to everything but the I/O thread, once it's pinned (SEE: Realtime.apply, shards)
+
+def mlockall():
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+def tasks():
+    ''' our threads' (native) ids '''
+    return [int(t) for t in os.listdir('/proc/self/task')]
+
+def gettid():
+    ''' the calling thread's native id (threading.get_native_id is python 3.8+) '''
+    if hasattr(threading, 'get_native_id'):
+        return threading.get_native_id()
+    return int(os.readlink('/proc/thread-self').rsplit('/', 1)[-1]) # (<pid>/task/<tid>)
+
+class Probe:
+    ''' worst-case loop jitter: how late a periodic timer runs '''
+    def __init__(self, reactor, interval=.001):
+        self.reactor = reactor
+        self.interval = interval
+        self.timer = None
+
+    def start(self):
+        self.worst = 0.0
+        self.expected = time.monotonic() + self.interval
+        self.timer = self.reactor.call_every(self.interval, self.tick)
+
+    def tick(self):
+        now = time.monotonic()
+        late = now - self.expected
+        if late > self.worst:
+            self.worst = late
+        self.expected += self.interval
+        if self.expected <= now: # the scheduler skipped ahead (SEE: Scheduler.run_expired)
+            self.expected = now + self.interval
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return self.worst
+
+class Collector:
+    ''' cyclic GC, only when the loop's idle (SEE: Reactor.idle)
+    generations are collected as gc would (by its thresholds), just not mid-report;
+    if input never lets up, it's forced once gen0 gets to force * threshold
+    '''
+    def __init__(self, reactor, force=10, interval=1):
+        self.reactor = reactor
+        self.thresholds = gc.get_threshold()
+        self.force = force
+        gc.disable()
+        reactor.idle.append(self.collect)
+        self.timer = reactor.call_every(interval, self.check)
+
+    def collect(self):
+        counts = gc.get_count()
+        if counts[0] < self.thresholds[0]:
+            return
+        generation = 0
+        if counts[1] >= self.thresholds[1]:
+            generation = 1
+            if counts[2] >= self.thresholds[2]:
+                generation = 2
+        start = time.monotonic()
+        gc.collect(generation)
+        Metrics().latency('gc').record(time.monotonic() - start)
+
+    def check(self):
+        if gc.get_count()[0] >= self.thresholds[0] * self.force:
+            Metrics().count('gc_forced')
+            self.collect()
+
+    def stop(self):
+        self.timer.cancel()
+        self.reactor.idle.remove(self.collect)
+        gc.enable()
+
+class Realtime:
+    ''' measure, apply (SEE: apply), measure again '''
+    def __init__(self, reactor, priority=50, cpu=None, probe=2.0):
+        self.reactor = reactor
+        self.priority = priority
+        self.cpus = os.sched_getaffinity(0)
+        self.cpu = max(self.cpus) if cpu is None else cpu # (cpu0 takes most interrupts)
+        self.probe_time = probe
+        self.probe = Probe(reactor)
+        self.timer = None # (the measurement under way)
+        self.collector = None
+        self.before = None
+        self.after = None
+
+    def start(self):
+        ''' (once devices are being served) measure, or pick up where an interrupted measurement left off '''
+        if self.timer is not None or self.after is not None:
+            return
+        self.probe.start()
+        self.timer = self.reactor.call_later(
+            self.probe_time, self.report if self.before is not None else self.measured
+        )
+
+    def interrupt(self):
+        ''' devices aren't being served (anymore); drop what's measured so far (it'd be discovery's stalls) '''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+            self.probe.stop()
+
+    def measured(self):
+        self.timer = None
+        self.before = self.probe.stop()
+        self.apply()
+        self.start()
+
+    def report(self):
+        self.timer = None
+        self.after = self.probe.stop()
+        Metrics().gauge('loop_jitter_worst', self.after)
+        _logger.info('worst loop jitter: %.3fms before, %.3fms realtime', self.before * 1000, self.after * 1000)
+
+    def apply(self):
+        ''' (from the reactor thread) '''
+        global spare
+        try:
+            # (threads & workers started from here on get the default policy)
+            os.sched_setscheduler(0, os.SCHED_FIFO | os.SCHED_RESET_ON_FORK, os.sched_param(self.priority))
+        except OSError as e:
+            _logger.warning('unable to set SCHED_FIFO: %s', e)
+        if len(self.cpus) > 1:
+            # ui, discovery, gpio, ... threads go elsewhere
+            me = gettid()
+            others = self.cpus - {self.cpu}
+            for tid in tasks():
+                try:
+                    os.sched_setaffinity(tid, {self.cpu} if tid == me else others)
+                except OSError as e: # (gone already)
+                    _logger.debug('affinity %s: %s', tid, e)
+            # workers (SEE: shards) too; those forked later would inherit our core, they move themselves
+            spare = others
+            for child in multiprocessing.active_children():
+                try:
+                    os.sched_setaffinity(child.pid, others)
+                except OSError as e:
+                    _logger.debug('affinity %s: %s', child.pid, e)
+        try:
+            mlockall()
+        except OSError as e:
+            _logger.warning('unable to lock memory: %s', e)
+        # startup's objects are here to stay; keep them out of every collection
+        gc.collect()
+        gc.freeze()
+        self.collector = Collector(self.reactor)
+
+    def stop(self):
+        self.interrupt()
+        if self.collector is not None:
+            self.collector.stop()
+            self.collector = None
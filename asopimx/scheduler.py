@@ -1,7 +1,103 @@
+''' heap-based timers
+Driven by the Reactor: the next deadline bounds its poll timeout,
+so nothing runs (or gets checked) between expirations.
+'''
+
+import heapq
+import time
+import logging
 
 from asopimx.tools import Singleton
-import sched
+from asopimx.metrics import Metrics
+
+_logger = logging.getLogger(__name__)
+
+class Timer:
+    __slots__ = ('deadline', 'interval', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, interval, callback, args):
+        self.deadline = deadline
+        self.interval = interval # None = one-shot
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+class Scheduler(metaclass=Singleton):
+    def __init__(self):
+        self.timers = [] # heap
+        self.clock = time.monotonic
+
+    def call_at(self, deadline, callback, *args):
+        t = Timer(deadline, None, callback, args)
+        heapq.heappush(self.timers, t)
+        return t
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def call_every(self, interval, callback, *args, delay=None):
+        ''' periodic timer (first call after delay; defaults to interval) '''
+        t = Timer(self.clock() + (interval if delay is None else delay), interval, callback, args)
+        heapq.heappush(self.timers, t)
+        return t
+
+    def enter(self, delay, priority, action, argument=(), kwargs=None):
+        ''' sched.scheduler-compatible (priority is ignored) '''
+        if kwargs:
+            return self.call_later(delay, lambda: action(*argument, **kwargs))
+        return self.call_later(delay, action, *argument)
+
+    def cancel(self, timer):
+        timer.cancel()
+
+    def reschedule(self, timer, interval):
+        ''' change a periodic timer's interval (if that brings its next call in, it's moved up) '''
+        timer.interval = interval
+        deadline = self.clock() + interval
+        if deadline < timer.deadline:
+            timer.deadline = deadline
+            heapq.heapify(self.timers)
+
+    def timeout(self):
+        ''' seconds until the next deadline (None if there's nothing to wait for) '''
+        timers = self.timers
+        while timers and timers[0].cancelled:
+            heapq.heappop(timers)
+        if not timers:
+            return None
+        return max(0, timers[0].deadline - self.clock())
 
-class Scheduler(sched.scheduler, metaclass=Singleton):
     def run(self, blocking=False):
-        return super(Scheduler, self).run(blocking)
+        ''' run expired timers; returns seconds until the next deadline (or None)
+        blocking: keep running until there's nothing left
+        '''
+        wait = self.run_expired()
+        while blocking and wait is not None:
+            time.sleep(wait)
+            wait = self.run_expired()
+        return wait
+
+    def run_expired(self):
+        timers = self.timers
+        now = self.clock()
+        while timers and timers[0].deadline <= now:
+            t = heapq.heappop(timers)
+            if t.cancelled:
+                continue
+            if t.interval is not None:
+                t.deadline += t.interval
+                if t.deadline <= now: # missed (at least) one; don't try to catch up
+                    Metrics().count('timer_overruns')
+                    t.deadline = now + t.interval
+                heapq.heappush(timers, t)
+            try:
+                t.callback(*t.args)
+            except Exception as e:
+                _logger.warning('timer %s failed: %s', t.callback, e)
+        return self.timeout()
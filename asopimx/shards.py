@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+
+''' process-per-device sharding
+Each phys device is read (and transformed to capability class state) in its own (forked) process;
+a slow or misbehaving device only stalls its own worker.
+Workers publish state into a shared memory slot (seqlocked) and ring a doorbell (eventfd; a pipe before 3.10);
+the main process is the only writer to the host: it picks up whatever slots changed,
+and does the profile side (transform_local, repack, send_event) at its own pace.
+Host feedback goes back to each worker through a pipe.
+
+slot layout (32 bytes, native order):
+    0   u32 seq (odd while the slot's being written)
+    4   u32 reports published
+    8   u8[18] capability class state (Gamepad.CState order)
+    26  (padding)
+
+(needs python 3.8+, for shared_memory)
+'''
+
+import os
+import errno
+import struct
+import multiprocessing
+from multiprocessing import shared_memory
+import logging
+from traceback import format_exc
+
+from asopimx.devices import listen
+from asopimx.reactor import Reactor
+from asopimx.scheduler import Scheduler
+from asopimx.metrics import Metrics
+from asopimx import realtime
+
+_logger = logging.getLogger(__name__)
+
+slot = struct.Struct('=II18B6x')
+header = struct.Struct('=II')
+state_offset = header.size
+state = struct.Struct('=18B')
+feedback = struct.Struct('=BBB') # lrumble, rrumble, leds (0xFF = unchanged)
+retries = 16 # torn reads before giving up on a slot (until the next doorbell)
+
+class Doorbell:
+    ''' wakes the writer; an eventfd, or a pipe where there's no os.eventfd (python < 3.10) '''
+    def __init__(self):
+        if hasattr(os, 'eventfd'):
+            self.fd = self.wfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self.fd, self.wfd = os.pipe()
+            os.set_blocking(self.fd, False)
+            os.set_blocking(self.wfd, False)
+
+    def ring(self):
+        try:
+            if self.fd == self.wfd:
+                os.eventfd_write(self.wfd, 1)
+            else:
+                os.write(self.wfd, b'\x01')
+        except BlockingIOError: # (full; it's been rung plenty)
+            pass
+
+    def answer(self):
+        ''' returns whether it had been rung '''
+        rung = False
+        try:
+            if self.fd == self.wfd:
+                rung = os.eventfd_read(self.fd) > 0
+            else:
+                while os.read(self.fd, 64):
+                    rung = True
+        except BlockingIOError:
+            pass
+        return rung
+
+    def close(self):
+        os.close(self.fd)
+        if self.wfd != self.fd:
+            os.close(self.wfd)
+
+class Publisher:
+    ''' (worker side) stands in for the profile; publishes state into the device's slot '''
+    def __init__(self, buf, offset, doorbell):
+        self.buf = buf
+        self.offset = offset
+        self.doorbell = doorbell
+        self.seq = 0
+        self.reports = 0
+        self.device = None
+
+    def assign_device(self, device):
+        self.device = device
+
+    def recv_dev(self, cstate):
+        # seqlock: readers retry while seq is odd or changes under them
+        # (each store is a separate call into the interpreter; nothing reorders them across that in practice)
+        self.seq += 1
+        header.pack_into(self.buf, self.offset, self.seq, self.reports)
+        state.pack_into(self.buf, self.offset + state_offset, *cstate)
+        self.seq += 1
+        self.reports += 1
+        header.pack_into(self.buf, self.offset, self.seq, self.reports)
+        self.doorbell.ring()
+
+class Feedback:
+    ''' (writer side) stands in for the device; forwards host feedback to its worker '''
+    def __init__(self, fd, metrics):
+        self.fd = fd
+        self.buffer = bytearray(feedback.size)
+        self.metrics = metrics # the device's (SEE: Profile.wrote)
+
+    def recv_host(self, fb):
+        feedback.pack_into(self.buffer, 0, fb.lrumble, fb.rrumble, 0xFF if fb.leds is None else fb.leds)
+        try:
+            os.write(self.fd, self.buffer)
+        except BlockingIOError: # worker's behind; drop it
+            Metrics().count('dropped_feedback')
+
+class Shard:
+    ''' a device, its worker process and its slot '''
+    def __init__(self, index, gamepad, profile):
+        self.index = index
+        self.offset = index * slot.size
+        self.gamepad = gamepad
+        self.profile = profile
+        self.seq = 0 # last seen
+        self.reports = 0
+        self.process = None
+        self.feedback = None # (read, write)
+
+class Shards:
+    ''' serve several (gamepad, profile) pairs, a worker process per gamepad '''
+    def __init__(self, gamepads, profiles):
+        self.shards = [Shard(i, g, p) for i, (g, p) in enumerate(zip(gamepads, profiles))]
+        self.memory = None
+        self.doorbell = None
+        self.lost = None
+
+    def start(self):
+        self.memory = shared_memory.SharedMemory(create=True, size=slot.size * len(self.shards))
+        self.doorbell = Doorbell()
+        context = multiprocessing.get_context('fork') # workers inherit the devices' open fds
+        for shard in self.shards:
+            shard.feedback = os.pipe()
+            os.set_blocking(shard.feedback[1], False)
+            shard.process = context.Process(
+                target=self.work, args=(shard,), name='asopimx-%s' % shard.index, daemon=True
+            )
+            shard.process.start()
+            os.close(shard.feedback[0])
+            metrics = Metrics().device(shard.gamepad.metrics_key())
+            metrics.connects += 1
+            shard.profile.assign_device(Feedback(shard.feedback[1], metrics))
+        reactor = Reactor()
+        reactor.add_reader(self.doorbell.fd, self.recv_slots)
+        for shard in self.shards:
+            reactor.add_reader(shard.process.sentinel, self.exited, shard)
+
+    def work(self, shard):
+        ''' (worker) read & transform the device, until it's lost '''
+        # a fresh loop; the parent's readers and timers aren't ours to run
+        Reactor.forget()
+        Scheduler.forget()
+        os.close(shard.feedback[1])
+        for other in self.shards:
+            if other.feedback is not None and other is not shard:
+                os.close(other.feedback[1])
+        shard.feedback = shard.feedback[0]
+        os.set_blocking(shard.feedback, False)
+        if realtime.spare: # (forked from the pinned I/O thread; that core's not ours)
+            os.sched_setaffinity(0, realtime.spare)
+        shard.gamepad.assign_profile(Publisher(self.memory.buf, shard.offset, self.doorbell))
+        Reactor().add_reader(shard.feedback, self.recv_feedback, shard)
+        try:
+            listen([shard.gamepad])
+        except KeyboardInterrupt:
+            pass
+        except OSError as e:
+            _logger.warning('%s: %s', shard.process.name if shard.process else shard.index, e)
+            os._exit(1)
+        except Exception:
+            _logger.warning(format_exc())
+            os._exit(1)
+
+    def recv_feedback(self, shard):
+        ''' (worker) forward the latest pending host feedback to the device '''
+        data = None
+        try:
+            while True:
+                chunk = os.read(shard.feedback, feedback.size * 16)
+                if not chunk:
+                    break
+                data = chunk
+        except BlockingIOError:
+            pass
+        if data is None:
+            return
+        lrumble, rrumble, leds = feedback.unpack_from(data, len(data) - feedback.size)
+        shard.gamepad.recv_host(shard.gamepad.CFeedback(lrumble, rrumble, None if leds == 0xFF else leds))
+
+    def recv_slots(self):
+        ''' (writer) forward state from every slot that's changed '''
+        if self.doorbell.answer():
+            self.scan()
+
+    def scan(self):
+        if self.memory is None: # stopped
+            return
+        buf = self.memory.buf
+        for shard in self.shards:
+            values = self.read_slot(buf, shard)
+            if values is None:
+                continue
+            seq, reports = values[:2]
+            metrics = shard.profile.device.metrics
+            metrics.reports += reports - shard.reports
+            if reports - shard.reports > 1:
+                Metrics().count('coalesced_reports', reports - shard.reports - 1)
+                metrics.coalesced += reports - shard.reports - 1
+            shard.seq, shard.reports = seq, reports
+            shard.profile.recv_dev(shard.gamepad.CState(*values[2:]))
+
+    def read_slot(self, buf, shard):
+        ''' a consistent copy of shard's slot (None if it hasn't changed) '''
+        for _ in range(retries):
+            seq = header.unpack_from(buf, shard.offset)[0]
+            if seq == shard.seq:
+                return None
+            if seq & 1: # being written
+                continue
+            values = slot.unpack_from(buf, shard.offset)
+            if header.unpack_from(buf, shard.offset)[0] == seq:
+                return values
+        Metrics().count('torn_reads')
+        Reactor().call_soon(self.scan) # (its doorbell's been rung already)
+        return None
+
+    def exited(self, shard):
+        Reactor().remove_reader(shard.process.sentinel)
+        shard.process.join()
+        if self.lost is None:
+            self.lost = OSError(errno.ENODEV, 'worker exited (%s)' % shard.process.exitcode, shard.process.name)
+
+    def stop(self):
+        reactor = Reactor()
+        if self.doorbell is not None:
+            reactor.remove_reader(self.doorbell.fd)
+            self.doorbell.close()
+            self.doorbell = None
+        for shard in self.shards:
+            if shard.process is None:
+                continue
+            reactor.remove_reader(shard.process.sentinel)
+            if shard.process.is_alive():
+                shard.process.terminate()
+            shard.process.join(1)
+            shard.profile.assign_device(shard.gamepad)
+            os.close(shard.feedback[1])
+            shard.process = None
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+    def serve(self, started=None):
+        ''' forward every device's state until one of them is lost (started: SEE: devices.listen) '''
+        reactor = Reactor()
+        self.start()
+        try:
+            if started is not None:
+                started()
+            while self.lost is None:
+                reactor.run_once(None)
+        finally:
+            self.stop()
+        raise self.lost
+
+def serve(gamepads, profiles, started=None):
+    ''' listen (SEE: devices.listen), with a worker process per gamepad '''
+    Shards(gamepads, profiles).serve(started)
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+''' pipeline timeline, for Perfetto / chrome://tracing
+Methods are instrumented (wrapped) only once it's enabled, so there's nothing in the way otherwise.
+Each call becomes a slice (name, start, duration, thread) in a bounded buffer (the oldest are dropped);
+the buffer's dumped as Chrome Trace Event JSON on SIGUSR2 and at exit.
+(SEE: trace, for the reports themselves)
+'''
+
+import os
+import json
+import time
+import atexit
+import signal
+import threading
+import functools
+from collections import deque
+import logging
+
+_logger = logging.getLogger(__name__)
+
+slices = None # (name, start ns, duration ns, thread id)
+path = None
+clock = time.monotonic_ns
+
+def enable(dump_path, size=65536, signum=signal.SIGUSR2):
+    ''' start keeping slices; dumped to dump_path on signum & exit '''
+    global slices, path
+    slices = deque(maxlen=size)
+    path = dump_path
+    atexit.register(dump)
+    if signum is not None:
+        signal.signal(signum, lambda signum, frame: dump())
+
+def wrap(func, name):
+    @functools.wraps(func)
+    def traced(*args, **kwargs):
+        start = clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            slices.append((name, start, clock() - start, threading.get_ident()))
+    traced.traced = True
+    return traced
+
+def instrument(cls, *names):
+    ''' turn cls's methods (names) into slices (named Class.method); skips what it doesn't have '''
+    if slices is None:
+        return
+    for name in names:
+        func = getattr(cls, name, None)
+        if func is None or getattr(func, 'traced', False):
+            continue
+        setattr(cls, name, wrap(func, '%s.%s' % (cls.__name__, name)))
+
+def events():
+    ''' slices as trace events (times in microseconds) '''
+    pid = os.getpid()
+    names = dict((t.ident, t.name) for t in threading.enumerate())
+    out = []
+    tids = set()
+    for name, start, duration, tid in list(slices):
+        tids.add(tid)
+        out.append({
+            'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+            'ts': start / 1000, 'dur': duration / 1000,
+        })
+    for tid in tids:
+        out.append({
+            'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+            'args': {'name': names.get(tid, str(tid))},
+        })
+    return out
+
+def dump(dump_path=None):
+    ''' write what we've got (Chrome Trace Event JSON) '''
+    dump_path = dump_path or path
+    if slices is None or dump_path is None:
+        return
+    tmp = '%s.%s' % (dump_path, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            json.dump({'traceEvents': events(), 'displayTimeUnit': 'ms'}, f)
+        os.rename(tmp, dump_path)
+        _logger.info('timeline: %s slices dumped to %s', len(slices), dump_path)
+    except OSError as e:
+        _logger.warning('unable to dump timeline to %s: %s', dump_path, e)
@@ -79,6 +79,10 @@ class Singleton(type):
             cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
 
+    def forget(cls):
+        ''' drop the instance (ex. a forked child's copy of its parent's) '''
+        cls._instances.pop(cls, None)
+
 
 # TODO: test!
 from path import Path
@@ -4,11 +4,22 @@
 # TODO: some of the often-used fields into their own classes
 # TODO: ch9.h 470 - 660; supply expected utility functions
 # TODO: Test! Test! Test!
+#   (modprobe dummy_hcd; mount -t functionfs <instance> <path>; FnFS(path, ...); bind the gadget to dummy_udc.0)
 
+import os
+import io
+import errno
+import fcntl
 import ctypes
+import struct
+import platform
+import logging
 from enum import IntEnum
 
-from ioctl import IOCTL
+from asopimx.tools.ioctl import IOCTL
+from asopimx.reactor import Reactor
+
+_logger = logging.getLogger(__name__)
 
 # to save some sanity
 u8 = ctypes.c_uint8
@@ -119,7 +130,7 @@ class USB:
         class Sync:
             type = 0x0c
             none = 0 << 2
-            async = 1 << 2
+            asynchronous = 1 << 2
             adaptive = 2 << 2
             sync = 3 << 2
         class Usage:
@@ -248,13 +259,13 @@ class USB:
             ('ck', u8 * 16),
         ]
     class Speed(IntEnum):
-        unknown = 0,
-        low = 1,
-        full = 2,
-        high = 3,
-        wireless = 4,
-        s = 5, # super
-        splus = 6,
+        unknown = 0
+        low = 1
+        full = 2
+        high = 3
+        wireless = 4
+        s = 5 # super
+        splus = 6
     class State(IntEnum):
         notattached = 0
         attached = 1
@@ -320,7 +331,7 @@ class Flags(IntEnum):
     SETUP = 128
 
 class CountReserved(ctypes.LittleEndianStructure):
-    _fields = [
+    _fields_ = [
         ('bCount', u8),
         ('Reserved', u8),
     ]
@@ -443,6 +454,7 @@ class Descriptor:
         ]
     interface_size = 9
     class Endpoint(ctypes.LittleEndianStructure): # no audio
+        _pack_ = 1
         _fields_ = [
             ('bLength', u8),
             ('bDescriptorType', u8),
@@ -470,13 +482,14 @@ class Descriptor:
             ]
             _fields_ = [
                 ('interface', u8),
-                ('dwLength', u8),
-                ('bcdVersion', u8),
-                ('wIndex', u8),
+                ('dwLength', le32),
+                ('bcdVersion', le16),
+                ('wIndex', le16),
                 ('count', Count),
             ]
     class Ext: # ended
         class Compat(ctypes.LittleEndianStructure): # ability
+            _pack_ = 1
             _fields_ = [
                 ('bFirstInterfaceNumber', u8),
                 ('Reserved1', u8),
@@ -700,6 +713,32 @@ class Descriptor(Descriptor):
             pass
         cap_size = 3
 
+# hid.h
+class HID:
+    class Type(IntEnum):
+        hid = 0x21
+        report = 0x22
+        physical = 0x23
+    class Request(IntEnum):
+        get_report = 0x01
+        get_idle = 0x02
+        get_protocol = 0x03
+        set_report = 0x09
+        set_idle = 0x0a
+        set_protocol = 0x0b
+    class Descriptor(ctypes.LittleEndianStructure):
+        _pack_ = 1
+        _fields_ = [
+            ('bLength', u8),
+            ('bDescriptorType', u8),
+            ('bcdHID', le16),
+            ('bCountryCode', u8),
+            ('bNumDescriptors', u8),
+            ('bClassDescriptorType', u8), # (first) class descriptor
+            ('wDescriptorLength', le16),
+        ]
+    descriptor_size = 9
+
 class Lang(ctypes.LittleEndianStructure):
     _pack_ = 1
     _fields_ = [
@@ -745,22 +784,147 @@ class Event(ctypes.LittleEndianStructure):
         _fields_ = [
             ('setup', Setup),
             ('type', u8),
-            ('_pad', u8),
+            ('_pad', u8 * 3),
         ]
 
-type = ord('g')
 class FIFO:
+    type = ord('g')
     status = IOCTL.noop(type, 1)
     flush = IOCTL.noop(type, 2)
     clear = IOCTL.noop(type, 3) # halt
     revmap_interface = IOCTL.noop(type, 128)
     revmap_endpoint = IOCTL.noop(type, 129)
-    describe_endpoint = IOCTL.noop(type, 130, Descriptor.Endpoint)
+    describe_endpoint = IOCTL.read(type, 130, 9) # usb_endpoint_descriptor (incl. audio fields)
+
+
+# kernel AIO (aio_abi.h)
+# endpoint files can't be polled, and plain reads/writes wait for the transfer to complete;
+#   AIO submits them and signals completion on an eventfd instead (which the reactor can poll)
+class IOCB(ctypes.LittleEndianStructure):
+    class Cmd(IntEnum):
+        PREAD = 0
+        PWRITE = 1
+    flag_resfd = 1 << 0
+    _pack_ = 1
+    _fields_ = [
+        ('aio_data', ctypes.c_uint64),
+        ('aio_key', ctypes.c_uint32),
+        ('aio_rw_flags', ctypes.c_uint32),
+        ('aio_lio_opcode', ctypes.c_uint16),
+        ('aio_reqprio', ctypes.c_int16),
+        ('aio_fildes', ctypes.c_uint32),
+        ('aio_buf', ctypes.c_uint64),
+        ('aio_nbytes', ctypes.c_uint64),
+        ('aio_offset', ctypes.c_int64),
+        ('aio_reserved2', ctypes.c_uint64),
+        ('aio_flags', ctypes.c_uint32),
+        ('aio_resfd', ctypes.c_uint32),
+    ]
+
+class IOEvent(ctypes.LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ('data', ctypes.c_uint64),
+        ('obj', ctypes.c_uint64),
+        ('res', ctypes.c_int64),
+        ('res2', ctypes.c_int64),
+    ]
+
+# io_setup, io_destroy, io_getevents, io_submit
+syscalls = {
+    'armv6l': (243, 244, 245, 246),
+    'armv7l': (243, 244, 245, 246),
+    'aarch64': (0, 1, 4, 2),
+    'x86_64': (206, 207, 208, 209),
+}
+
+def eventfd(libc):
+    ''' a nonblocking (close on exec) eventfd; os.eventfd is python 3.10+, so straight from libc otherwise '''
+    if hasattr(os, 'eventfd'):
+        return os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+    fd = libc.eventfd(0, os.O_NONBLOCK | os.O_CLOEXEC) # (EFD_NONBLOCK, EFD_CLOEXEC)
+    if fd < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return fd
+
+class AIO:
+    ''' a kernel AIO context with preallocated control blocks (one per slot)
+    completions are signalled on an eventfd (SEE: fileno, reap)
+    '''
+    def __init__(self, depth=8):
+        try:
+            self.sys_setup, self.sys_destroy, self.sys_getevents, self.sys_submit = syscalls[platform.machine()]
+        except KeyError:
+            raise OSError(errno.ENOSYS, 'no AIO syscalls for %s' % platform.machine())
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.efd = eventfd(self.libc)
+        self.ctx = ctypes.c_ulong(0)
+        try:
+            self.syscall(self.sys_setup, ctypes.c_uint(depth), ctypes.byref(self.ctx))
+        except OSError:
+            os.close(self.efd)
+            raise
+        self.iocbs = (IOCB * depth)()
+        self.iocbpp = (ctypes.c_void_p * 1)()
+        self.events = (IOEvent * depth)()
+        self.callbacks = [None] * depth
+        self.free = list(range(depth))
+
+    def syscall(self, nr, *args):
+        r = self.libc.syscall(nr, *args)
+        if r < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return r
+
+    def fileno(self):
+        return self.efd
+
+    def submit(self, fd, buf, size, write, callback):
+        ''' queue a read/write of buf (a ctypes buffer; size bytes); callback(res) on completion
+        res is the transferred size (or -errno)
+        '''
+        slot = self.free.pop()
+        cb = self.iocbs[slot]
+        cb.aio_data = slot
+        cb.aio_lio_opcode = IOCB.Cmd.PWRITE if write else IOCB.Cmd.PREAD
+        cb.aio_fildes = fd
+        cb.aio_buf = ctypes.addressof(buf)
+        cb.aio_nbytes = size
+        cb.aio_flags = IOCB.flag_resfd
+        cb.aio_resfd = self.efd
+        self.iocbpp[0] = ctypes.addressof(cb)
+        try:
+            self.syscall(self.sys_submit, self.ctx, ctypes.c_long(1), self.iocbpp)
+        except OSError:
+            self.free.append(slot)
+            raise
+        self.callbacks[slot] = callback
+
+    def reap(self):
+        ''' run completed transfers' callbacks (the reactor calls this when the eventfd is readable) '''
+        try:
+            os.read(self.efd, 8) # (the counter; same as os.eventfd_read)
+        except BlockingIOError:
+            return
+        n = self.syscall(self.sys_getevents, self.ctx, ctypes.c_long(0), ctypes.c_long(len(self.events)), self.events, None)
+        for i in range(n):
+            evt = self.events[i]
+            slot = evt.data
+            callback = self.callbacks[slot]
+            self.callbacks[slot] = None
+            self.free.append(slot)
+            callback(evt.res)
+
+    def close(self):
+        if self.efd is not None:
+            self.syscall(self.sys_destroy, self.ctx)
+            os.close(self.efd)
+            self.efd = None
 
 
 # NOW!  The good stuff!
-import io
-import errno
 class Endpoint(io.FileIO):
     # TODO: add in/out directional restrictions (defensive coding)
     def __init__(self, *args, **kwargs):
@@ -768,35 +932,29 @@ class Endpoint(io.FileIO):
         super(Endpoint, self).__init__(*args, **kwargs)
 
     def _ioctl(self, f, *args, **kwargs):
-        r = fnctl.ioctl(f, *args, **kwargs)
-        if r < 0:
+        r = fcntl.ioctl(self, f, *args, **kwargs)
+        if isinstance(r, int) and r < 0:
             raise IOError(r)
         return r
 
     def halted(self):
         return self._halted
 
-    def halt(self, rtype=None):
-        if rtype is None:
-            # we're not (supposed to be) 0
-            try:
-                raise NotImplementedError
-            except IOError as e:
-                if e.errno != errno.EBADMSG:
-                    raise
+    def halt(self, rtype):
+        ''' halt (stall); done by doing I/O in the wrong direction
+        rtype: the (setup) request's type for ep0, the endpoint's direction otherwise
+        '''
+        try:
+            if rtype & USB.Dir.IN:
+                os.read(self.fileno(), 0)
             else:
-                raise ValueError('Halt failed.')
+                os.write(self.fileno(), b'')
+        except OSError as e:
+            # ep0: EL2HLT; others: EBADMSG
+            if e.errno not in (errno.EL2HLT, errno.EBADMSG):
+                raise
         else:
-            try:
-                if rtype & USB.Dir.IN:
-                    self.read(0)
-                else:
-                    self.write(b'')
-            except IOError as e:
-                if e.errno != errno.EL2HLT:
-                    raise
-            else:
-                raise ValueError('Failed to halt endpoint.')
+            raise ValueError('Failed to halt endpoint.')
         self._halted = True
 
     def clear(self):
@@ -806,12 +964,13 @@ class Endpoint(io.FileIO):
     def status(self):
         return self._ioctl(FIFO.status)
 
-    def flush(self):
+    def flush_fifo(self): # (FileIO.flush is called on close)
         return self._ioctl(FIFO.flush)
 
     def descriptor(self):
-        r = Descriptor.Endpoint()
-        return self._ioctl(FIFO.describe_endpoint, r, True)
+        r = Descriptor.EndpointAudio()
+        self._ioctl(FIFO.describe_endpoint, r, True)
+        return r
 
     def get_iface_no(self, iface=None):
         try:
@@ -824,122 +983,338 @@ class Endpoint(io.FileIO):
                 return
             raise
 
+class Writer:
+    ''' IN endpoint writer; one transfer in flight, and only the newest data waits for it
+    (stale data is replaced rather than queued; the host only ever polls for the latest)
+    without AIO, writes block until the host polls
+    '''
+    def __init__(self, ep, size, aio=None):
+        self.ep = ep
+        self.fd = ep.fileno()
+        self.aio = aio
+        self.size = size
+        self.buffers = [(ctypes.c_char * size)(), (ctypes.c_char * size)()]
+        self.views = [memoryview(b).cast('B') for b in self.buffers]
+        self.lengths = [0, 0]
+        self.busy = False
+        self.pending = False
+        self.replaced = 0 # writes superseded before they were sent
+
+    def write(self, data):
+        n = len(data)
+        if self.aio is None:
+            return os.write(self.fd, data)
+        i = 1 if self.busy else 0 # 0: in flight, 1: next
+        self.views[i][:n] = data
+        self.lengths[i] = n
+        if self.busy:
+            self.replaced += self.pending
+            self.pending = True
+        else:
+            self.submit()
+        return n
+
+    def submit(self):
+        try:
+            self.aio.submit(self.fd, self.buffers[0], self.lengths[0], True, self.done)
+        except BlockingIOError: # not enabled (yet)
+            return
+        self.busy = True
+
+    def done(self, res):
+        self.busy = False
+        if res < 0 and res != -errno.ESHUTDOWN:
+            _logger.debug('%s: write failed (%s)', self.ep.name, os.strerror(-res))
+        if self.pending:
+            self.pending = False
+            self.buffers.reverse()
+            self.views.reverse()
+            self.lengths.reverse()
+            self.submit()
+
+class Reader:
+    ''' OUT endpoint reader; keeps a read submitted (into a preallocated buffer)
+    callback(view) receives each transfer (the view's only valid during the call)
+    '''
+    def __init__(self, ep, size, callback, aio):
+        self.ep = ep
+        self.fd = ep.fileno()
+        self.aio = aio
+        self.buffer = (ctypes.c_char * size)()
+        self.view = memoryview(self.buffer).cast('B')
+        self.callback = callback
+        self.busy = False
+
+    def submit(self):
+        if not self.busy:
+            try:
+                self.aio.submit(self.fd, self.buffer, len(self.buffer), False, self.done)
+            except BlockingIOError:
+                return
+            self.busy = True
+
+    def done(self, res):
+        self.busy = False
+        if res < 0:
+            if res != -errno.ESHUTDOWN:
+                _logger.debug('%s: read failed (%s)', self.ep.name, os.strerror(-res))
+            return
+        self.callback(self.view[:res])
+        self.submit()
+
 class Interface:
-    def __init__(self, iface, endpoints):
+    def __init__(self, iface, endpoints, extra=None):
+        ''' iface: interface descriptor
+        endpoints: endpoint descriptors
+        extra: class-specific descriptors (ex. HID; they follow the interface descriptor)
+        '''
         self.iface = iface
-        self.endpoint = endpoints
+        self.endpoints = endpoints
+        self.extra = extra if extra is not None else []
         super(Interface, self).__init__()
 
-    
+    def descriptors(self):
+        return [self.iface] + self.extra + self.endpoints
+
+def interval(ms, speed):
+    ''' bInterval for an interrupt endpoint polled every ms '''
+    if speed == 'fs':
+        return max(1, min(255, int(ms)))
+    # high speed: 2 ** (bInterval - 1) microframes
+    frames = max(1, int(ms * 8))
+    return min(16, frames.bit_length())
+
+def os_compat(interface, compatible_id, sub_compatible_id=b''):
+    ''' extended compat id os descriptor (ex. b'XUSB10' for xinput, b'WINUSB') '''
+    compat = Descriptor.Ext.Compat(bFirstInterfaceNumber=interface, Reserved1=1)
+    compat.CompatibleID[:len(compatible_id)] = compatible_id
+    compat.SubCompatibleID[:len(sub_compatible_id)] = sub_compatible_id
+    header = Descriptor.OS.Header(
+        interface=interface,
+        dwLength=ctypes.sizeof(Descriptor.OS.Header) + ctypes.sizeof(compat),
+        bcdVersion=0x0100,
+        wIndex=0x0004,
+        wCount=1,
+    )
+    return bytes(header) + bytes(compat)
+
+# serialized descriptors & strings (by cache key)
+_cache = {}
 
 class FnFS:
+    ''' a FunctionFS function (mounted at path)
+    ep0 events are handled from the reactor (override bind, enable, setup, etc.),
+    endpoint I/O goes through AIO (SEE: writer, reader)
+    '''
     _closed = False
     _interfaces = {}
+    ep0_events = 4 # most events per ep0 read
 
     def build_descriptors(self):
-        # TODO: support other speeds
-        descs = []
+        ''' descriptors blob (v2) '''
         flags = self.flags
-        clists = []
-        dlists = []
-        kwargs = {}
-        for iface in self._interfaces:
-            descs.append(iface.iface)
-            for ep in iface.endpoints:
-                desc.append(ep)
+        counts = []
+        blobs = []
         lsts = [
-            (descs, Flag.HS_DESC, 'hs')
-            (self._os, Flag.MS_DESC, 'os')
+            (self._fs, Flags.FS_DESC),
+            (self._hs, Flags.HS_DESC),
         ]
-        for dlist, flag, pre in lsts:
-            if dlist:
-                flags |= flag   
-                dmap = OrderedDict()
-                for i, d in enumerate(dlist):
-                    dmap['desc_%s' % i] = d
-                cname = prefix + '_count'
-                dname = prefix + '_desc'
-                clists.append((cname, le32))
-                dtype = type(
-                    't_' + dname,
-                    (ctypes.LittleEndianStructure,),
-                    {   '_pack_': 1,
-                        '_fields_': [
-                            (x, type(y)) for x, y in dmap.items()
-                ]})
-                dlists.append((dname, dtype))
-                kwargs[cname] = len(dmap)
-                kwargs[dname] = dtype(**dmap)
+        for interfaces, flag in lsts:
+            descs = [d for iface in interfaces for d in iface.descriptors()]
+            if descs:
+                flags |= flag
+                counts.append(len(descs))
+                blobs.extend(bytes(d) for d in descs)
+        if self._os:
+            flags |= Flags.MS_DESC
+            counts.append(len(self._os))
+            blobs.extend(bytes(d) for d in self._os)
         # TODO: sanity-check flags
-        cls = type(
-            'Descs_0x%02x' % flags,
-            (Descriptor.FFS.Header,),
-            { '_fields_': clists + dlists }
-        )
-        return cls(
+        body = struct.pack('<%dI' % len(counts), *counts) + b''.join(blobs)
+        header = Descriptor.FFS.Header(
             magic=Magic.DESCRIPTORSV2,
-            length=ctypes.sizeof(cls),
-            flags=flags, **kwargs
+            length=ctypes.sizeof(Descriptor.FFS.Header) + len(body),
+            flags=flags,
         )
+        return bytes(header) + body
 
-    def build_strings():
-        lst = []
-        kwargs = {}
+    def build_strings(self):
+        ''' strings blob '''
+        blobs = []
         try:
             count = len(next(iter(self._langs.values())))
-        except:
+        except StopIteration:
             count = 0
-        else:
-            for lang, strings in self._langs.items():
-                if len(strings) != count:
-                    raise ValueError('Uneven strings count! (%s)' % lang)
-                sid = 's_%04x' % lang
-                bstrings = b'\x00'.join(x.encode('utf8') for x in strings) + b'\x00'
-                ftype = type(
-                    'String',
-                    (Lang,),
-                    { '_fields_':[
-                        ('strings', ctypes.c_char * len(bstrings)),
-                ]})
-                lst.append((sid, ftype))
-                kwargs[sid] = ftype(lang=lang,strings=bstrings)
-        cls = type(
-            'Strings',
-            (Strings,),
-            { '_fields_': lst }
-        )
-        return cls(
+        for lang, strings in self._langs.items():
+            if len(strings) != count:
+                raise ValueError('Uneven strings count! (%s)' % lang)
+            blobs.append(bytes(Lang(lang=lang)))
+            blobs.extend(x.encode('utf8') + b'\x00' for x in strings)
+        body = b''.join(blobs)
+        header = Strings(
             magic=Magic.STRINGS,
-            length=ctypes.sizeof(cls),
+            length=ctypes.sizeof(Strings) + len(body),
             str_count=count,
             lang_count=len(self._langs),
-            **kwargs,
         )
+        return bytes(header) + body
 
-    def serialize(self, s):
-        return (ctypes.c_char * ctypes.sizeof(s)).from_address(ctypes.addressof(s))
+    def serialize(self):
+        ''' (descriptors, strings); built once per cache key '''
+        key = (self._key, self.flags)
+        if self._key is None or key not in _cache:
+            blobs = (self.build_descriptors(), self.build_strings())
+            if self._key is None:
+                return blobs
+            _cache[key] = blobs
+        return _cache[key]
 
-    def __init__(self, path, interfaces, os=None, langs=None, ctl_all=False, setup_early=False):
+    def __init__(self, path, interfaces, hs_interfaces=None, os_descs=None, langs=None,
+            ctl_all=False, setup_early=False, key=None, aio_depth=8):
         ''' create an fs function
         path: path to dir containing ep0
-        interfaces: list of Interfaces
-        os: os descriptors list
+        interfaces: list of Interfaces (full speed)
+        hs_interfaces: high speed Interfaces (defaults to interfaces)
+        os_descs: os descriptors list (SEE: os_compat)
         langs: langs list ex: {0x0409: ['Product']}
         ctl_all: handle all ctl operations (default pending)
         setup_early: receive control messages before configuration begins
+        key: cache key for the serialized descriptors (ex. the profile's code)
+        aio_depth: endpoint transfers in flight (SEE: AIO); 0 = no AIO: writes block the loop until the host
+            polls, and OUT endpoints can't be read (SEE: reader); only for hosts that never stop polling
         '''
         self._path = path
+        self._fs = interfaces
+        self._hs = hs_interfaces if hs_interfaces is not None else interfaces
         self._interfaces = interfaces
-        self._os = os if os is not None else []
-        self._langs = langs if lans is not None else []
-        self.e0 = Endpoint(os.path.join(path, 'ep0'), 'r+')
+        self._os = os_descs if os_descs is not None else []
+        self._langs = langs if langs is not None else {}
+        self._key = key
         self.flags = 0
         if ctl_all:
             self.flags |= Flags.ALL_CTRL_RECIP
         if setup_early:
-            self.flags |= Flags.SETUP 
-        descriptors = self.build_descriptors()    
-        self.e0.write(self.serialize(descriptors))
-        strings = self.build_strings()
-        self.e0.write(self.serialize(strings))
-        # TODO: populate endpoints and put them to work!
+            self.flags |= Flags.SETUP
+        self.enabled = False
+        self.endpoints = []
+        self.readers = []
+        self.aio = None
+        self.e0 = Endpoint(os.path.join(path, 'ep0'), 'r+')
+        try:
+            descriptors, strings = self.serialize()
+            self.e0.write(descriptors)
+            self.e0.write(strings)
+            # ep files appear (numbered in descriptor order) once ep0's been written
+            for i in range(sum(len(iface.endpoints) for iface in self._fs)):
+                fd = os.open(os.path.join(path, 'ep%d' % (i + 1)), os.O_RDWR | os.O_NONBLOCK | os.O_CLOEXEC)
+                self.endpoints.append(Endpoint(fd, 'r+'))
+            if aio_depth:
+                try:
+                    self.aio = AIO(aio_depth)
+                except OSError as e:
+                    # (without it, a host that stops polling would stall every device & timer)
+                    _logger.error('AIO unavailable (%s); refusing to block on endpoint writes', e)
+                    raise
+            os.set_blocking(self.e0.fileno(), False)
+            self.ebuffer = (Event.Event * self.ep0_events)()
+            self.eview = memoryview(self.ebuffer).cast('B')
+            reactor = Reactor()
+            reactor.add_reader(self.e0, self.recv_events)
+            if self.aio is not None:
+                reactor.add_reader(self.aio, self.aio.reap)
+        except:
+            # don't hold on to any fds; the kernel may deadlock
+            self.close()
+            raise
+
+    def writer(self, index, size):
+        ''' writer for (IN) endpoint ep<index> '''
+        return Writer(self.endpoints[index - 1], size, self.aio)
+
+    def reader(self, index, size, callback):
+        ''' reader for (OUT) endpoint ep<index> (submitted once the function's enabled) '''
+        if self.aio is None:
+            raise OSError(errno.ENOSYS, 'AIO unavailable')
+        reader = Reader(self.endpoints[index - 1], size, callback, self.aio)
+        self.readers.append(reader)
+        return reader
+
+    def recv_events(self):
+        ''' handle pending ep0 events '''
+        try:
+            n = self.e0.readinto(self.eview)
+        except OSError as e:
+            _logger.warning('ep0: %s', e)
+            return
+        if not n:
+            return
+        for i in range(n // ctypes.sizeof(Event.Event)):
+            evt = self.ebuffer[i]
+            try:
+                etype = Event.Type(evt.type)
+            except ValueError:
+                _logger.debug('ep0: unknown event (%s)', evt.type)
+                continue
+            if etype == Event.Type.SETUP:
+                self.setup(evt.setup.setup)
+            else:
+                getattr(self, etype.name.lower())()
+
+    # ep0 events
+    def bind(self):
+        _logger.debug('bound')
+
+    def unbind(self):
+        self.enabled = False
+
+    def enable(self):
+        self.enabled = True
+        for reader in self.readers:
+            reader.submit()
+
+    def disable(self):
+        self.enabled = False
+
+    def setup(self, request):
+        ''' handle a control request; unhandled ones are stalled '''
+        _logger.debug('ep0: unhandled request 0x%02x 0x%02x 0x%04x 0x%04x (%d)', request.bRequestType,
+            request.bRequest, request.wValue, request.wIndex, request.wLength)
+        self.stall(request)
+
+    def suspend(self):
+        pass
+
+    def resume(self):
+        pass
+
+    # control request replies
+    def reply(self, request, data):
+        ''' answer an IN (device to host) request '''
+        os.write(self.e0.fileno(), bytes(data[:request.wLength]))
+
+    def receive(self, request):
+        ''' read an OUT (host to device) request's data (and acknowledge it) '''
+        return os.read(self.e0.fileno(), request.wLength)
+
+    def stall(self, request):
+        self.e0.halt(request.bRequestType)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        reactor = Reactor()
+        if self.aio is not None:
+            reactor.remove_reader(self.aio)
+            self.aio.close()
+        for ep in self.endpoints:
+            ep.close()
+        if not self.e0.closed:
+            reactor.remove_reader(self.e0)
+            self.e0.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,370 @@
+#!/usr/bin/python3
+
+''' HID report descriptor parser & input report compiler
+Descriptors are parsed once into fields, and each input report is compiled into
+an extraction plan (byte/bit offsets) and a generated extractor:
+decoding a report is then a single unpack_from plus a few shifts and masks,
+with no descriptor interpretation per report.
+Plans are cached on disk per vendor/product/descriptor hash.
+Profiles go the other way: their report_desc is compiled into a Packer (SEE: Packer).
+'''
+
+import os
+import json
+import struct
+import hashlib
+import logging
+from collections import namedtuple
+
+_logger = logging.getLogger(__name__)
+
+plan_version = 1
+cache_dir = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'asopimx', 'hid'
+)
+
+class ItemType:
+    main = 0
+    glob = 1 # global
+    local = 2
+    long = 3
+
+class Main:
+    input = 0x8
+    output = 0x9
+    feature = 0xb
+    collection = 0xa
+    end_collection = 0xc
+
+class Global:
+    usage_page = 0x0
+    logical_min = 0x1
+    logical_max = 0x2
+    report_size = 0x7
+    report_id = 0x8
+    report_count = 0x9
+    push = 0xa
+    pop = 0xb
+
+class Local:
+    usage = 0x0
+    usage_min = 0x1
+    usage_max = 0x2
+
+# main item data bits
+CONSTANT = 0x01
+VARIABLE = 0x02
+
+kinds = {Main.input: 'input', Main.output: 'output', Main.feature: 'feature'}
+
+usage_names = {
+    0x01: { # generic desktop
+        0x01: 'pointer', 0x30: 'x', 0x31: 'y', 0x32: 'z', 0x33: 'rx', 0x34: 'ry', 0x35: 'rz',
+        0x36: 'slider', 0x37: 'dial', 0x38: 'wheel', 0x39: 'hat', 0x3d: 'start', 0x3e: 'select',
+        0x90: 'dpad_up', 0x91: 'dpad_down', 0x92: 'dpad_right', 0x93: 'dpad_left',
+    },
+    0x02: { # simulation
+        0xc4: 'accelerator', 0xc5: 'brake',
+    },
+}
+
+Item = namedtuple('Item', 'type tag size value')
+Field = namedtuple('Field', 'kind report_id name page usage offset size signed constant')
+
+def items(desc):
+    ''' yield descriptor items (value is unsigned; SEE: signed) '''
+    i = 0
+    n = len(desc)
+    while i < n:
+        prefix = desc[i]
+        if prefix == 0xfe: # long item; nothing standard uses these
+            i += 3 + desc[i + 1]
+            continue
+        size = (0, 1, 2, 4)[prefix & 0x03]
+        value = int.from_bytes(bytes(desc[i + 1:i + 1 + size]), 'little')
+        yield Item((prefix >> 2) & 0x03, prefix >> 4, size, value)
+        i += 1 + size
+
+def signed(item):
+    if item.size and item.value & (1 << (item.size * 8 - 1)):
+        return item.value - (1 << (item.size * 8))
+    return item.value
+
+def usage_name(page, usage):
+    if usage is None:
+        return 'v%x' % page
+    if page == 0x09: # buttons
+        return 'b%d' % usage
+    return usage_names.get(page, {}).get(usage, 'u%x_%x' % (page, usage))
+
+def parse(desc):
+    ''' parse a report descriptor into fields (one per report slot)
+    offsets are in bits, from the start of the report's data (excluding its id)
+    '''
+    fields = []
+    state = dict(usage_page=0, logical_min=0, logical_max=0, report_size=0, report_id=0, report_count=0)
+    stack = []
+    usages = []
+    usage_min = None
+    offsets = {} # (kind, report_id): bit offset
+    for item in items(desc):
+        if item.type == ItemType.glob:
+            if item.tag == Global.usage_page:
+                state['usage_page'] = item.value
+            elif item.tag == Global.logical_min:
+                state['logical_min'] = signed(item)
+            elif item.tag == Global.logical_max:
+                # only signed when the minimum is (0..255 is often encoded as 0xff)
+                state['logical_max'] = signed(item) if state['logical_min'] < 0 else item.value
+            elif item.tag == Global.report_size:
+                state['report_size'] = item.value
+            elif item.tag == Global.report_id:
+                state['report_id'] = item.value
+            elif item.tag == Global.report_count:
+                state['report_count'] = item.value
+            elif item.tag == Global.push:
+                stack.append(dict(state))
+            elif item.tag == Global.pop:
+                state = stack.pop()
+        elif item.type == ItemType.local:
+            value = item.value
+            if item.size == 4: # extended usage (page in the high word)
+                page, value = value >> 16, value & 0xffff
+            else:
+                page = None
+            if item.tag == Local.usage:
+                usages.append((page, value))
+            elif item.tag == Local.usage_min:
+                usage_min = (page, value)
+            elif item.tag == Local.usage_max and usage_min is not None:
+                usages.extend((usage_min[0], u) for u in range(usage_min[1], value + 1))
+                usage_min = None
+        elif item.type == ItemType.main:
+            kind = kinds.get(item.tag)
+            if kind is not None:
+                key = (kind, state['report_id'])
+                offset = offsets.get(key, 0)
+                size = state['report_size']
+                count = state['report_count']
+                constant = bool(item.value & CONSTANT)
+                variable = bool(item.value & VARIABLE)
+                for i in range(count):
+                    if constant or not usages:
+                        page, usage = state['usage_page'], None
+                    elif variable:
+                        page, usage = usages[min(i, len(usages) - 1)]
+                    else: # array; slots hold usage indexes
+                        page, usage = usages[0]
+                    page = state['usage_page'] if page is None else page
+                    fields.append(Field(
+                        kind, state['report_id'], usage_name(page, usage), page, usage,
+                        offset + i * size, size, state['logical_min'] < 0, constant,
+                    ))
+                offsets[key] = offset + count * size
+            usages = []
+            usage_min = None
+    return fields
+
+def plan(fields, kind='input'):
+    ''' compile fields into per-report extraction plans '''
+    reports = {}
+    for f in fields:
+        if f.kind == kind:
+            reports.setdefault(f.report_id, []).append(f)
+    numbered = any(reports)
+    plans = []
+    for rid, rfields in sorted(reports.items()):
+        base = 8 if numbered else 0
+        length = (base + max(f.offset + f.size for f in rfields) + 7) // 8
+        names = {}
+        slots = []
+        for f in rfields:
+            if f.constant:
+                continue
+            n = names.get(f.name, 0)
+            names[f.name] = n + 1
+            name = f.name if not n else '%s_%d' % (f.name, n)
+            slots.append((name, base + f.offset, f.size, f.signed))
+        # byte-aligned 8/16/32 bit fields go through one struct; anything else is shifted out
+        fmt = '<'
+        pos = 0
+        aligned = []
+        bits = []
+        for name, offset, size, sign in slots:
+            if offset % 8 == 0 and size in (8, 16, 32) and offset // 8 >= pos:
+                gap = offset // 8 - pos
+                if gap:
+                    fmt += '%dx' % gap
+                fmt += {8: 'b', 16: 'h', 32: 'i'}[size] if sign else {8: 'B', 16: 'H', 32: 'I'}[size]
+                pos = offset // 8 + size // 8
+                aligned.append(name)
+            else:
+                bits.append((name, offset // 8, offset % 8, size, sign))
+        plans.append({
+            'id': rid, 'length': length, 'fields': [s[0] for s in slots],
+            'format': fmt, 'aligned': aligned, 'bits': bits,
+        })
+    return plans
+
+def build(plan, State):
+    ''' generate a plan's extractor: extract(report) -> State '''
+    local = dict((name, 'f%d' % i) for i, name in enumerate(plan['fields']))
+    src = ['def extract(d, _unpack=_unpack, State=State, _int=int.from_bytes):']
+    if plan['aligned']:
+        src.append('    %s, = _unpack(d, 0)' % ', '.join(local[n] for n in plan['aligned']))
+    for name, byte, shift, size, sign in plan['bits']:
+        nbytes = (shift + size + 7) // 8
+        v = 'd[%d]' % byte if nbytes == 1 else "_int(d[%d:%d], 'little')" % (byte, byte + nbytes)
+        if shift:
+            v = '(%s >> %d)' % (v, shift)
+        if size != nbytes * 8:
+            v = '%s & %#x' % (v, (1 << size) - 1)
+        if sign:
+            sb = 1 << (size - 1)
+            v = '((%s) ^ %#x) - %#x' % (v, sb, sb)
+        src.append('    %s = %s' % (local[name], v))
+    src.append('    return State(%s)' % ', '.join(local[n] for n in plan['fields']))
+    ns = {'_unpack': struct.Struct(plan['format']).unpack_from, 'State': State}
+    exec(compile('\n'.join(src), '<hid report %#x>' % plan['id'], 'exec'), ns)
+    return ns['extract']
+
+class Report:
+    ''' compiled input report '''
+    def __init__(self, plan):
+        self.plan = plan
+        self.id = plan['id']
+        self.length = plan['length']
+        self.State = namedtuple('State', plan['fields'], rename=True)
+        self.extract = build(plan, self.State)
+
+class Decoder:
+    ''' decodes a device's input reports into (per-report) fixed-slot States '''
+    def __init__(self, plans):
+        self.reports = dict((p['id'], Report(p)) for p in plans)
+        self.numbered = any(self.reports)
+
+    def decode(self, data):
+        ''' decode a raw report (including its id, if the device numbers them); None if unknown '''
+        report = self.reports.get(data[0] if self.numbered else 0)
+        if report is None or len(data) < report.length:
+            return None
+        return report.extract(data)
+
+def report_lengths(fields, kind='input'):
+    ''' report_id: length (in bytes, including the id if reports are numbered) '''
+    ends = {}
+    for f in fields:
+        if f.kind == kind:
+            ends[f.report_id] = max(ends.get(f.report_id, 0), f.offset + f.size)
+    base = 8 if any(ends) else 0
+    return dict((rid, (base + end + 7) // 8) for rid, end in ends.items())
+
+def report_length(desc, max_packet=64):
+    ''' the hid function's report_length: its longest input/output report (capped at max_packet) '''
+    fields = parse(desc)
+    lengths = list(report_lengths(fields, 'input').values()) + list(report_lengths(fields, 'output').values())
+    if not lengths:
+        raise ValueError('report descriptor has no input or output reports')
+    return min(max(lengths), max_packet)
+
+class Packer:
+    ''' packs a profile's State into one of its input reports with a single pack_into
+    layout: (struct code, value) per item, in report order, where value is either a State field
+    name or a constant (baked into the generated packer);
+    it's checked against the descriptor when compiled (at import), not on the wire
+    '''
+    def __init__(self, desc, layout, report_id=0):
+        fields = parse(desc)
+        length = report_lengths(fields).get(report_id)
+        if length is None:
+            raise ValueError('no input report %#x in descriptor' % report_id)
+        self.struct = struct.Struct('<' + ''.join(code for code, value in layout))
+        if self.struct.size != length:
+            raise ValueError('layout packs %s bytes; input report %#x is %s' % (
+                self.struct.size, report_id, length))
+        base = 8 if report_id else 0
+        data = [(base + f.offset, base + f.offset + f.size) for f in fields
+            if f.kind == 'input' and f.report_id == report_id and not f.constant]
+        offset = 0
+        self.fields = []
+        args = []
+        for code, value in layout:
+            size = struct.calcsize('<' + code)
+            if isinstance(value, str):
+                start, end = offset * 8, (offset + size) * 8
+                if (offset or not report_id) and not any(s < end and start < e for s, e in data):
+                    raise ValueError('%s (byte %s) only covers padding in input report %#x' % (
+                        value, offset, report_id))
+                self.fields.append((value, offset))
+                args.append('s.%s' % value)
+            else:
+                if offset == 0 and report_id and value != report_id:
+                    raise ValueError('report starts with %r; expected its id (%#x)' % (value, report_id))
+                args.append(repr(value))
+            offset += size
+        self.report_id = report_id
+        self.size = length
+        self.buffer = bytearray(length)
+        src = 'def pack(s, buf, _pack_into=_pack_into):\n    _pack_into(buf, 0, %s)\n    return buf' % ', '.join(args)
+        ns = {'_pack_into': self.struct.pack_into}
+        exec(compile(src, '<hid packer %#x>' % report_id, 'exec'), ns)
+        self.pack_into = ns['pack']
+
+    def pack(self, state):
+        ''' pack state into (and return) the packer's reusable buffer '''
+        return self.pack_into(state, self.buffer)
+
+def cache_path(desc, vendor_id, product_id):
+    digest = hashlib.sha1(bytes(desc)).hexdigest()[:16]
+    return os.path.join(cache_dir, '%04x_%04x_%s.json' % (vendor_id, product_id, digest))
+
+def load(path):
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('version') != plan_version:
+        return None
+    return cached['plans']
+
+def save(path, plans):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%s' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'version': plan_version, 'plans': plans}, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        _logger.warning('unable to cache report plans (%s): %s', path, e)
+
+def decoder(desc, vendor_id=0, product_id=0, cache=True):
+    ''' get a Decoder for a report descriptor (from the plan cache, if possible) '''
+    path = cache_path(desc, vendor_id, product_id)
+    plans = load(path) if cache else None
+    if plans is None:
+        plans = plan(parse(desc))
+        if cache:
+            save(path, plans)
+    return Decoder(plans)
+
+def from_device(device, cache=True):
+    ''' get a Decoder for a hidraw device (file obj / fileno) '''
+    from asopimx.tools.ioctl import HID
+    dev = HID(device)
+    info = dev.get_info()
+    return decoder(dev.get_report_desc(), info.vendor_id, info.product_id, cache)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Prints the compiled input report layout of a hidraw device')
+    parser.add_argument('file', help='Device File (ex. /dev/hidraw0')
+    parser.add_argument('-n', '--no-cache', help="Don't use (or update) the plan cache", action='store_true')
+    args = parser.parse_args()
+
+    with open(args.file, 'rb') as f:
+        d = from_device(f, not args.no_cache)
+    for rid, report in sorted(d.reports.items()):
+        print('report %#x (%s bytes): %s' % (rid, report.length, report.plan['format']))
+        for name in report.plan['fields']:
+            print('  %s' % name)
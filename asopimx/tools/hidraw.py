@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+''' direct hidraw I/O (a drop-in for the parts of hidapi we use)
+Reads go straight into a reusable buffer (SEE: device.readinto), feature reports
+through tools.ioctl.HID, and devices expose their fd (for the reactor).
+cython-hidapi is optional; it allocates a list per read, and its hidraw backend can't be picked at runtime anyway.
+'''
+
+import io
+import os
+import errno
+import select
+import logging
+
+from asopimx.tools.ioctl import HID
+
+_logger = logging.getLogger(__name__)
+
+sysfs = '/sys/class/hidraw'
+
+def uevent(name):
+    ''' read a hidraw node's (parent) hid device uevent '''
+    info = {}
+    with open(os.path.join(sysfs, name, 'device/uevent')) as f:
+        for line in f:
+            k, _, v = line.strip().partition('=')
+            info[k] = v
+    return info
+
+def enumerate(vendor_id=0, product_id=0):
+    ''' list hid devices (as hidapi.enumerate does; paths are bytes) '''
+    devices = []
+    try:
+        names = sorted(os.listdir(sysfs), key=lambda n: int(n[6:]) if n[6:].isdigit() else -1)
+    except FileNotFoundError:
+        return devices
+    for name in names:
+        try:
+            info = uevent(name)
+            bus, vid, pid = (int(v, 16) for v in info['HID_ID'].split(':'))
+        except (OSError, KeyError, ValueError) as e:
+            _logger.debug('%s: skipping (%s)', name, e)
+            continue
+        if (vendor_id and vid != vendor_id) or (product_id and pid != product_id):
+            continue
+        devices.append({
+            'path': os.path.join('/dev', name).encode('utf8'),
+            'vendor_id': vid,
+            'product_id': pid,
+            'serial_number': info.get('HID_UNIQ', ''),
+            'release_number': 0,
+            'manufacturer_string': '',
+            'product_string': info.get('HID_NAME', ''),
+            'usage_page': 0,
+            'usage': 0,
+            'interface_number': -1,
+            'bus_type': bus,
+        })
+    return devices
+
+class device:
+    ''' a hidraw device (hidapi.device compatible) '''
+    def __init__(self):
+        self.fd = None
+        self.blocking = True
+        self.buffer = None
+
+    def open_path(self, path):
+        if isinstance(path, bytes):
+            path = path.decode('utf8')
+        self.path = path
+        # always non-blocking underneath; blocking reads wait on poll (SEE: wait)
+        self.fd = os.open(path, os.O_RDWR | os.O_NONBLOCK | os.O_CLOEXEC)
+        self.file = io.FileIO(self.fd, 'rb', closefd=False)
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
+        self.hid = HID(self.fd)
+
+    def open(self, vendor_id, product_id, serial_number=None):
+        for d in enumerate(vendor_id, product_id):
+            if serial_number is None or d['serial_number'] == serial_number:
+                return self.open_path(d['path'])
+        raise IOError('open failed')
+
+    def fileno(self):
+        return self.fd
+
+    def set_nonblocking(self, v):
+        self.blocking = not v
+        return 0
+
+    def wait(self, timeout_ms):
+        ''' wait for a report (timeout_ms: 0 = don't, < 0 = forever) '''
+        if timeout_ms == 0:
+            return
+        self.poller.poll(None if timeout_ms < 0 else timeout_ms)
+
+    def readinto(self, buf, timeout_ms=0):
+        ''' read a report into buf; returns its size (0 if there wasn't one)
+        timeout_ms: how long to wait for one (0 = don't, < 0 = forever)
+        '''
+        self.wait(timeout_ms)
+        n = self.file.readinto(buf)
+        if n is None: # nothing pending
+            return 0
+        if n == 0: # hidraw only reports eof once the device is gone
+            raise OSError(errno.ENODEV, 'device removed', self.path)
+        return n
+
+    def read(self, max_length, timeout_ms=0):
+        ''' read a report (bytes; empty if there wasn't one) '''
+        if self.buffer is None or len(self.buffer) < max_length:
+            self.buffer = bytearray(max_length)
+        # hidapi: 0 = blocking unless set_nonblocking
+        timeout_ms = timeout_ms if timeout_ms > 0 else (-1 if self.blocking else 0)
+        n = self.readinto(memoryview(self.buffer)[:max_length], timeout_ms)
+        return bytes(self.buffer[:n])
+
+    def write(self, data):
+        ''' write an output report (first byte is the report id) '''
+        return os.write(self.fd, bytes(data))
+
+    def send_feature_report(self, data):
+        data = bytes(data)
+        self.hid.send_report(data[1:], data[0])
+        return len(data)
+
+    def get_feature_report(self, report_num, max_length):
+        return list(self.hid.get_report(report_num, max_length - 1))
+
+    def get_product_string(self):
+        return self.hid.get_name()
+
+    def get_serial_number_string(self):
+        return self.hid.get_address()
+
+    def close(self):
+        if self.fd is not None:
+            self.file.close()
+            os.close(self.fd)
+            self.fd = None
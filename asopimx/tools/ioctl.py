@@ -3,7 +3,7 @@
 ''' pure-python IOCTL and HID helpers (to extract HID report descriptors, dev. info, etc.)
 # TODO: make this requests-level awesome
 because everything else is a PITA (painful, lacks features, license-incompatible, or has no python api)
-# TODO: add our own descriptor parser
+(report descriptors are parsed & compiled in hiddesc)
 '''
 
 import ctypes
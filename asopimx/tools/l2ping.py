@@ -11,8 +11,15 @@ import socket
 from ctypes import *
 import struct
 import select
+from collections import deque
 from datetime import datetime
 import time
+import logging
+
+from asopimx.metrics import Metrics
+from asopimx.governor import Governor
+
+_logger = logging.getLogger(__name__)
 
 # this really should be defined elsewhere
 # (we really don't need all this, but might was well supply 'em to learn what's all there)
@@ -123,6 +130,149 @@ class l2cap:
 # defaults
 ident = 200
 
+def echo_data(size):
+    data = bytearray()
+    for i in range(0,size):
+        data.append(i % 40 + ord('A'))
+    return data
+
+class Link:
+    ''' echo state for a single remote device '''
+    def __init__(self, addr, window=64):
+        self.addr = addr
+        self.sock = None
+        self.ident = ident
+        self.sent_on = None # outstanding echo
+        self.sent = 0
+        self.recvd = 0
+        self.rtts = deque(maxlen=window) # rolling window (seconds)
+
+    def percentile(self, pct):
+        if not self.rtts:
+            return None
+        rtts = sorted(self.rtts)
+        return rtts[min(len(rtts) - 1, int(len(rtts) * pct / 100))]
+
+    def loss(self):
+        return 100 * (self.sent - self.recvd) / self.sent if self.sent else 0
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+class LinkMonitor:
+    ''' low-duty l2ping of connected devices, driven by the reactor
+    RTT percentiles (over the last window replies) and loss are published as metrics gauges
+    (bt_rtt_p50, bt_rtt_p95, bt_rtt_max, bt_loss) per device address
+    '''
+    percentiles = ((50, 'bt_rtt_p50'), (95, 'bt_rtt_p95'), (100, 'bt_rtt_max'))
+
+    def __init__(self, reactor, interval=1, size=4, window=64, device=None):
+        self.reactor = reactor
+        self.interval = interval # also the echo timeout
+        self.size = size
+        self.window = window
+        self.device = device # local adapter address (None: any)
+        self.data = bytes(echo_data(size))
+        self.links = {}
+        self.timer = None
+        self.metrics = Metrics()
+
+    def add(self, addr):
+        if addr in self.links:
+            return self.links[addr]
+        if not hasattr(socket, 'AF_BLUETOOTH'): # (python built without bluetooth support)
+            return None
+        link = Link(addr, self.window)
+        sock = None
+        try:
+            sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, proto=socket.BTPROTO_L2CAP)
+            sock.bind((socket.BDADDR_ANY if self.device is None else self.device, 0))
+            sock.connect((addr, 0))
+            sock.setblocking(False)
+        except OSError as e:
+            if sock is not None:
+                sock.close()
+            _logger.warning('%s: unable to monitor link: %s', addr, e)
+            return None
+        link.sock = sock
+        self.links[addr] = link
+        self.reactor.add_reader(sock, self.recv, link)
+        if self.timer is None:
+            self.timer = Governor().manage(self.reactor.call_every(self.interval, self.ping, delay=0))
+        return link
+
+    def remove(self, addr):
+        link = self.links.pop(addr, None)
+        if link is None:
+            return
+        self.reactor.remove_reader(link.sock)
+        link.close()
+        self.metrics.drop(addr)
+        if not self.links and self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def clear(self):
+        for addr in list(self.links):
+            self.remove(addr)
+
+    def ping(self):
+        now = time.monotonic()
+        for link in list(self.links.values()):
+            if link.sent_on is not None: # previous echo timed out
+                link.sent_on = None
+                self.publish(link)
+            link.ident = link.ident + 1 if link.ident < 254 else ident
+            hdr = l2cap.cmd_hdr(code=l2cap.echo_req, ident=link.ident, len=self.size)
+            try:
+                link.sock.send(bytes(hdr) + self.data)
+            except OSError as e:
+                _logger.warning('%s: echo failed (%s); no longer monitoring', link.addr, e)
+                self.remove(link.addr)
+                continue
+            link.sent_on = now
+            link.sent += 1
+
+    def recv(self, link):
+        now = time.monotonic()
+        try:
+            r = link.sock.recv(l2cap.cmd_hdr_size + self.size)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            _logger.warning('%s: link lost (%s)', link.addr, e)
+            self.remove(link.addr)
+            return
+        if len(r) < l2cap.cmd_hdr_size:
+            return
+        rhdr = l2cap.cmd_hdr.from_buffer_copy(r)
+        if rhdr.code != l2cap.echo_rsp or rhdr.ident != link.ident or link.sent_on is None:
+            return # not ours (or too late)
+        rtt = now - link.sent_on
+        link.sent_on = None
+        link.recvd += 1
+        link.rtts.append(rtt)
+        self.metrics.latency('bt_rtt').record(rtt)
+        self.publish(link)
+
+    def publish(self, link):
+        for pct, name in self.percentiles:
+            value = link.percentile(pct)
+            if value is not None:
+                self.metrics.gauge(name, value, link.addr)
+        self.metrics.gauge('bt_loss', link.loss(), link.addr)
+
+    def stats(self, addr):
+        link = self.links.get(addr)
+        if link is None:
+            return None
+        return dict(
+            [(name, link.percentile(pct)) for pct, name in self.percentiles],
+            bt_loss=link.loss(), sent=link.sent, recvd=link.recvd,
+        )
+
 
 def ping(args):
     # stats
@@ -142,13 +292,12 @@ def ping(args):
     # get local address
     addr = socks.getsockname()
 
-    send_data = bytearray()
-    for i in range(0,args.size):
-        send_data.append(i % 40 + ord('A'))
+    send_data = echo_data(args.size)
+    rtts = []
 
     id = ident
     try:
-        while args.count <= 0:
+        while args.count != 0:
             if args.count > 0:
                 args.count -= 1
             send_cmd = l2cap.cmd_hdr()
@@ -179,9 +328,10 @@ def ping(args):
                     break
 
                 explen = l2cap.cmd_hdr_size + args.size
-                r = socks.recv(l2cap.cmd_hdr_size)
+                r = socks.recv(explen)
 
                 rhdr = l2cap.cmd_hdr.from_buffer_copy(r)
+                recv_data = r[l2cap.cmd_hdr_size:]
                 # check for our id
                 if rhdr.ident != id:
                     continue
@@ -199,6 +349,7 @@ def ping(args):
                 recvd += 1
                 recvd_on = datetime.now()
                 delta = recvd_on - sent_on
+                rtts.append(delta.total_seconds())
             
                 if args.verify:
                     # check payload len
@@ -213,10 +364,10 @@ def ping(args):
                         return
 
                 print('%s bytes from %s id %s time %s' % (rhdr.len, args.addr, id - ident, delta))
-                if args.delay:
+                if args.delay and not args.flood:
                     time.sleep(args.delay)
             else:
-                print('no response from s: id %s' % (args.addr, id - ident))
+                print('no response from %s: id %s' % (args.addr, id - ident))
 
             id += 1
             if id > 254:
@@ -225,8 +376,12 @@ def ping(args):
     except KeyboardInterrupt:
         print() # skip keyboard entry line
         
-    loss = sent if (sent - recvd)/(sent/100) else 0
+    loss = (sent - recvd) * 100 / sent if sent else 0
     print('%s sent, %s received, %s%% loss' % (sent, recvd, loss))
+    if rtts:
+        print('rtt min/avg/max = %.3f/%.3f/%.3f ms' % (
+            min(rtts) * 1000, sum(rtts) * 1000 / len(rtts), max(rtts) * 1000
+        ))
 
 if __name__ == '__main__':
     import argparse
@@ -5,8 +5,14 @@ SEE: linux/rfkill.h
 '''
 
 from collections import namedtuple
+import os
 import select
 import struct
+import logging
+
+from asopimx.tools import Singleton
+
+_logger = logging.getLogger(__name__)
 
 
 class Type:
@@ -28,13 +34,99 @@ Event = namedtuple('Event', ['idx', 'type', 'op', 'softblock', 'hardblock'])
 class Device(Event):
     pass # methods defined further down
 
+class Monitor(metaclass=Singleton):
+    ''' keeps /dev/rfkill open and tracks radio state from its events
+    (attach it to the reactor to pick up events as they happen)
+    '''
+    path = '/dev/rfkill'
+
+    def __init__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+        self.devices = {} # idx: Device
+        self.listeners = []
+        self.reactor = None
+        self.update() # the kernel queues an add event for every existing device
+
+    def fileno(self):
+        return self.fd
+
+    def attach(self, reactor):
+        if self.reactor is None:
+            self.reactor = reactor
+            reactor.add_reader(self.fd, self.update)
+
+    def subscribe(self, fn):
+        ''' fn(Device) is called whenever a device is added, changed or removed '''
+        self.listeners.append(fn)
+
+    def update(self):
+        ''' apply pending events; returns the number applied '''
+        applied = 0
+        while True:
+            try:
+                data = os.read(self.fd, event_size)
+            except BlockingIOError:
+                break
+            if len(data) < event_size:
+                break
+            evt = Device(*struct.unpack(event_format, data))
+            self.apply(evt)
+            applied += 1
+        return applied
+
+    def apply(self, evt):
+        if evt.op == Op.rm:
+            self.devices.pop(evt.idx, None)
+        elif evt.op == Op.change_all:
+            for idx, d in list(self.devices.items()):
+                if evt.type in (Type.all, d.type):
+                    self.devices[idx] = d._replace(softblock=evt.softblock)
+        else: # add, change
+            self.devices[evt.idx] = evt
+        for fn in self.listeners:
+            try:
+                fn(evt)
+            except Exception as e:
+                _logger.warning('rfkill listener failed: %s', e)
+
+    def list(self, type=None):
+        if self.reactor is None:
+            self.update() # not watched; catch up
+        return [d for d in self.devices.values() if type is None or d.type == type]
+
+    def get(self, idx):
+        if self.reactor is None:
+            self.update()
+        return self.devices.get(idx)
+
+    def switch(self, idx, block=None):
+        ''' (soft)block/unblock a device; only writes on a real transition '''
+        c = self.get(idx)
+        if c is None:
+            raise Exception('Unable to update controller: %s not found' % idx)
+        if block is None: # behave like a switch
+            block = 0 if c.softblock else 1
+        if bool(block) == bool(c.softblock):
+            return False # nothing to do
+        os.write(self.fd, struct.pack(
+            event_format, idx, c.type,
+            Op.change, block, c.hardblock
+        ))
+        # assume it took; the change event will confirm it
+        self.devices[idx] = c._replace(softblock=block)
+        return True
+
 def rflist():
+    return Monitor().list()
+
+def rfscan():
+    ''' one-shot scan (without keeping /dev/rfkill open) '''
     with open('/dev/rfkill', 'rb') as f:
         controllers = []
         p = select.poll()
         p.register(f)
         while True:
-           rs = p.poll()
+           rs = p.poll(0)
            readable = 0
            for r in rs:
                fd, event = r
@@ -49,19 +141,10 @@ def rflist():
     return controllers
 
 def switch(idx, block=None):
-    cs = rflist() # find our target; we want to get the type right
     if isinstance(idx, Event):
         idx = idx.idx
     try:
-        c = [i for i in cs if i.idx == idx][0]
-        if block is None: # behave like a switch
-            block = 0 if c.softblock else 1
-        with open('/dev/rfkill', 'wb') as f:
-            f.write(struct.pack(
-                event_format, idx, c.type,
-                Op.change, block, c.hardblock
-            ))
-            f.flush()
+        return Monitor().switch(idx, block)
     except Exception as e:
         raise Exception('Unable to update controller: %s' % e)
 
@@ -111,9 +194,7 @@ class Device(Event):
 class wlan(rfkill):
     @staticmethod
     def list():
-        cs = rflist()
-        wlans = [c for c in cs if c.type == Type.wlan]
-        return wlans
+        return Monitor().list(Type.wlan)
 
     @staticmethod
     def first():
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+''' hot path tracing
+Call sites check the module flag first, so while tracing's off they cost a lookup and a branch:
+    if trace.enabled:
+        trace.record(trace.READ, device, data)
+While it's on, records (stage, device, timestamp & up to 52 bytes of the report) are packed
+into a preallocated ring; nothing's formatted until it's dumped & rendered (SEE: __main__).
+
+dump format (little-endian):
+    4s magic (b'AMXT'), u16 version, u16 record size, u32 records, u32 device names size
+    device names (utf8, NUL separated; record device n = name n)
+    records (oldest first): u64 ns (CLOCK_MONOTONIC), u8 stage, u8 device, u16 length, data (52 bytes)
+'''
+
+import time
+import struct
+import logging
+
+from asopimx.tools import phexlify
+
+_logger = logging.getLogger(__name__)
+
+enabled = False
+ring = None
+
+# stages
+READ, MALFORMED, UNMAPPED, UPDATE, REPACK, SEND, FEEDBACK = range(7)
+stages = ('read', 'malformed', 'unmapped', 'update', 'repack', 'send', 'feedback')
+
+magic = b'AMXT'
+version = 1
+dump_header = struct.Struct('<4sHHII')
+record_header = struct.Struct('<QBBH')
+record_size = 64
+payload = record_size - record_header.size
+
+class Ring:
+    ''' fixed size binary trace records (the oldest are overwritten) '''
+    def __init__(self, size=4096):
+        self.size = size
+        self.buffer = bytearray(size * record_size)
+        self.view = memoryview(self.buffer)
+        self.index = 0 # next record
+        self.count = 0
+        self.devices = {} # name: id
+        self.clock = time.monotonic_ns
+
+    def device(self, name):
+        d = self.devices.get(name)
+        if d is None:
+            d = self.devices[name] = len(self.devices) & 0xFF
+        return d
+
+    def record(self, stage, device, data=b''):
+        offset = self.index * record_size
+        n = min(len(data), payload)
+        record_header.pack_into(self.buffer, offset, self.clock(), stage, self.device(device), len(data))
+        self.view[offset + record_header.size:offset + record_header.size + n] = data[:n]
+        self.index = (self.index + 1) % self.size
+        self.count += 1
+
+    def records(self):
+        ''' recorded (oldest first) '''
+        if self.count < self.size:
+            return self.view[:self.index * record_size]
+        return self.view[self.index * record_size:].tobytes() + self.view[:self.index * record_size].tobytes()
+
+    def dump(self, path):
+        names = '\0'.join(str(n) for n in self.devices).encode()
+        records = self.records()
+        with open(path, 'wb') as f:
+            f.write(dump_header.pack(magic, version, record_size, len(records) // record_size, len(names)))
+            f.write(names)
+            f.write(records)
+
+def enable(size=4096):
+    global enabled, ring
+    if ring is None or ring.size != size:
+        ring = Ring(size)
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def record(stage, device, data=b''):
+    ring.record(stage, device, data)
+
+def dump(path):
+    if ring is not None:
+        ring.dump(path)
+        _logger.info('trace: %s records dumped to %s', min(ring.count, ring.size), path)
+
+def load(path):
+    ''' read a dump; returns [(ns, stage, device, length, data)] '''
+    with open(path, 'rb') as f:
+        m, v, size, count, names = dump_header.unpack(f.read(dump_header.size))
+        if m != magic or v != version:
+            raise ValueError('%s: not a (version %s) trace dump' % (path, version))
+        devices = f.read(names).decode().split('\0')
+        records = []
+        for _ in range(count):
+            r = f.read(size)
+            ns, stage, device, length = record_header.unpack_from(r)
+            data = r[record_header.size:record_header.size + min(length, size - record_header.size)]
+            records.append((ns, stages[stage], devices[device], length, data))
+    return records
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Render a trace dump')
+    parser.add_argument('path')
+    parser.add_argument('-s', '--stage', default=None, help='Only show this stage (ex. read)')
+    args = parser.parse_args()
+    records = load(args.path)
+    start = records[0][0] if records else 0
+    for ns, stage, device, length, data in records:
+        if args.stage and stage != args.stage:
+            continue
+        print('%12.6f %-9s %-16s %3d %s' % ((ns - start) / 1e9, stage, device, length, phexlify(data)))
@@ -4,12 +4,14 @@
 NOTE: For better performance, tweak I2C core to run @ 1Mhz:
 Add the following to /boot/config.txt:
     dtparam=i2c_baudrate=1000000
+Input is handled via GPIO edge events and the display is only redrawn when its content changes;
+(slow) I2C transfers happen on a separate thread so they never hold up the input pipeline.
 '''
 
 import RPi.GPIO as gpio
-import time
 import enum
 import sys
+import threading
 import traceback
 import logging
 
@@ -19,7 +21,7 @@ import Adafruit_SSD1306
 from PIL import Image, ImageDraw, ImageFont
 
 import asopimx.tools.rfkill as rfkill
-from asopimx.scheduler import Scheduler
+from asopimx.reactor import Reactor
 
 _logger = logging.getLogger(__name__ if __name__ != '__main__' else __file__)
 
@@ -40,6 +42,41 @@ for p in Pins:
 # reset pin
 rst = None # not required
 
+class Renderer(threading.Thread):
+    ''' pushes frames to the display (only the latest pending frame is drawn) '''
+    def __init__(self, disp):
+        super(Renderer, self).__init__(daemon=True)
+        self.disp = disp
+        self.frame = None
+        self.running = True
+        self.cond = threading.Condition()
+
+    def push(self, image):
+        with self.cond:
+            self.frame = image
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.frame is None and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                frame, self.frame = self.frame, None
+            try:
+                self.disp.image(frame)
+                self.disp.display()
+            except Exception:
+                _logger.warning(traceback.format_exc())
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.is_alive():
+            self.join()
+
 class AsopiUI:
     fonts_dir =  '/usr/share/fonts/truetype/freefont/'
     class Color:
@@ -56,10 +93,13 @@ class AsopiUI:
         self.image = Image.new('1', (self.width, self.height))
         self.draw = ImageDraw.Draw(self.image)
         self.font('FreeMono.ttf')
-        self.wifi_toggled = False
-        self.refresh_rate = 1
-        self.scheduler = Scheduler()
+        self.bouncetime = 200 # ms
+        self.reactor = Reactor()
+        self.rfkill = rfkill.Monitor()
         self.screen = None
+        self.content = None # last drawn content
+        self.wifi = None # cached wifi state
+        self.renderer = Renderer(self.disp)
 
     def font(self, font, size=16):
         # using freemono:
@@ -83,8 +123,12 @@ class AsopiUI:
         # self.display()
 
     def display(self):
-        self.disp.image(self.image)
-        self.disp.display()
+        # hand off a copy; we keep drawing on ours
+        if self.renderer.is_alive():
+            self.renderer.push(self.image.copy())
+        else:
+            self.disp.image(self.image)
+            self.disp.display()
 
     def text(self, x=0, y=0, text=None, color=None, font=None):
         ''' draw text (only white and black is supported) '''
@@ -104,70 +148,84 @@ class AsopiUI:
         self.display()
 
     def display_status(self):
-        self.clear_image()
         banner = 'AsoPiMX'.ljust(self.twidth-1)
-        if self.wifi_enabled(): # wifi enabled
+        if self.wifi: # wifi enabled
             # banner[-1] = 'W' # stupid immutable string  :)
             banner += 'W'
         else:
             banner += ' '
+        content = (self.screen, banner)
+        if content == self.content:
+            return # nothing's changed
+        self.content = content
+        self.clear_image()
         self.text(0,0, banner)
         self.display()
 
-    def check_input(self):
-        ''' checks input; if something changes, do something '''
-        if not gpio.input(Pins.a): # button pressed
+    def on_press(self, pin):
+        ''' (reactor thread) a button was pressed '''
+        if pin == Pins.a:
             pass
-        if not gpio.input(Pins.b): # button pressed
-            if not self.wifi_toggled:
-                self.toggle_wifi()
-                self.wifi_toggled = True
-        else:
-            if self.wifi_toggled:
-                self.wifi_toggled = False
+        elif pin == Pins.b:
+            self.toggle_wifi()
+
+    def on_edge(self, channel):
+        ''' (gpio thread) hand presses over to the reactor '''
+        self.reactor.call_soon_threadsafe(self.on_press, Pins(channel))
+
+    def update_wifi(self, evt=None):
+        wifi = self.wifi_enabled()
+        if wifi != self.wifi:
+            self.wifi = wifi
+            self.display_status()
 
     def wifi_status(self):
-        for c in rfkill.rflist():
-            if c.type == rfkill.Type.wlan:
-                return c
+        for c in self.rfkill.list(rfkill.Type.wlan):
+            return c
     
     def wifi_enabled(self):
         status = self.wifi_status()
+        if status is None:
+            return False
         return not status.softblock
         return True if status.softblock == 0 else False
 
     def toggle_wifi(self):
         rfkill.toggle(self.wifi_status())
-
-    def refresh(self):
-        self.check_input()
-        self.display_status()
-        if self.scheduler:
-            self.scheduler.enter(self.refresh_rate, 1, self.refresh)
+        self.update_wifi()
 
     def start(self):
         self.screen = 'status'
-        self.refresh()
+        self.reactor.enable_wakeup()
+        self.renderer.start()
+        for p in (Pins.a, Pins.b):
+            gpio.add_event_detect(p.value, gpio.FALLING, callback=self.on_edge, bouncetime=self.bouncetime)
+        # radio state changes come in as rfkill events
+        self.rfkill.attach(self.reactor)
+        self.rfkill.subscribe(self.update_wifi)
+        self.update_wifi()
+        self.display_status()
+
+    def stop(self):
+        for p in (Pins.a, Pins.b):
+            gpio.remove_event_detect(p.value)
+        self.renderer.stop()
 
     def listen(self):
         try:
-            self.screen = 'status'
-            self.display_status()
-            while True:
-                # TODO: only call display_status() when something's changed
-                self.check_input()
-                self.display_status()
-                # restricts excessive refresh rate & pin read bouncing
-                time.sleep(self.refresh_rate) # .01 takes up too much cpu time
+            self.start()
+            self.reactor.run()
         except Exception as e:
             print(traceback.format_exc())
         finally: # clear display
+            self.stop()
             self.clear()
 
     def __enter__(self):
         return self
 
     def __exit__(self, etype, val, tb):
+        self.stop()
         self.clear()
 
 if __name__ == '__main__':
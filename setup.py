@@ -19,13 +19,18 @@ setup(
     #url='https://www.example.com',
     #packages=['asopimx', 'asopimx.ui', 'asopimx.tools', 'asopimx.devices'],
     packages=find_packages(),
+    python_requires='>=3.7', # (--shard: 3.8+; SEE: README)
     # TODO: fill out requirements
     install_requires=[
-        'hidapi', 'numpy', 'path', 'rpi.gpio',
+        'numpy>=1.17', # (unpackbits' bitorder)
+        'path', 'rpi.gpio',
         'adafruit-blinka','adafruit-SSD1306', # hw ui
         'bluew>0.4.6', # if this DNE, pull git master: https://github.com/nullp0tr/bluew.git
         'lxml',
     ],
+    extras_require={
+        'hidapi': ['hidapi'], # only used by hidr (hid devices are read via hidraw directly)
+    },
     scripts=['scripts/asopimx'],
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -37,9 +42,11 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
         'Operating System :: POSIX :: Linux',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Programming Language :: Python :: Implementation :: CPython',
         # 'Programming Language :: Python :: Implementation :: PyPy', # this would be nice
         'Topic :: Games/Entertainment',